@@ -2,6 +2,7 @@
 # The webapp is built using Dash (https://dash.plotly.com/), which is a Python framework for building webapps.
 import math
 import time
+import threading
 import tomllib
 import types
 import dash
@@ -56,6 +57,13 @@ if __name__ == '__main__':
     session_host = config["session_host"]
     default_sensor_values = config["default_sensor_values"]
     max_logical_cores = config["max_logical_cores"]
+    exclusion_height_surrogate_tables = config.get("exclusion_height_surrogate_tables", False)
+    live_measurement_update_interval = config.get("live_measurement_update_interval", 2)
+    sensorgram_cache_size = config.get("sensorgram_cache_size", 20)
+    progressive_sensorgram_min_scans = config.get("progressive_sensorgram_min_scans", 5000)
+    progressive_sensorgram_step = config.get("progressive_sensorgram_step", 16)
+    spectral_data_dtype = SPECTRAL_DATA_DTYPES[config.get("spectral_data_precision", 'double')]
+    sensorgram_angle_margin = config.get("angle_window_margin", 1.0) if config.get("crop_spectra_to_angle_windows", False) else None
     evanescent_decay_length = config["evanescent_decay_length"]
     instrument_SPR_sensitivity = config["instrument_SPR_sensitivity"]
     instrument_TIR_sensitivity = config["instrument_TIR_sensitivity"]
@@ -107,11 +115,13 @@ if __name__ == '__main__':
             # Load measurement data
             try:
                 current_data_path, scanspeed, time_df, angles_df, ydata_df, reflectivity_df = load_csv_data(
-                    path=current_session.current_data_path, default_data_folder=default_data_folder)
+                    path=current_session.current_data_path, default_data_folder=default_data_folder, dtype=spectral_data_dtype)
             except FileNotFoundError:
-                current_data_path, scanspeed, time_df, angles_df, ydata_df, reflectivity_df = load_csv_data(prompt='Select the original data file matching '+current_session.current_data_path)
+                current_data_path, scanspeed, time_df, angles_df, ydata_df, reflectivity_df = load_csv_data(prompt='Select the original data file matching '+current_session.current_data_path, dtype=spectral_data_dtype)
 
-            sensorgram_df = calculate_sensorgram(time_df, angles_df, ydata_df, current_session.SPR_TIR_fitting_parameters)
+            # The sensorgram is calculated from the angle windows only (if enabled), the full spectra are read when needed
+            sensorgram_angles_df, sensorgram_ydata_df = sensorgram_spectra(angles_df, ydata_df, current_session.SPR_TIR_fitting_parameters, angle_margin=sensorgram_angle_margin)
+            sensorgram_df = load_or_calculate_sensorgram(current_session.location + '/Sensorgram cache', current_data_path, time_df, sensorgram_angles_df, sensorgram_ydata_df, current_session.SPR_TIR_fitting_parameters, logical_cores=logical_cores, cache_size=sensorgram_cache_size, scan_step=progressive_sensorgram_step if len(time_df) >= progressive_sensorgram_min_scans else 1)
 
             # Offset to start at 0 degrees at 0 minutes
             sensorgram_df_selection = copy.deepcopy(sensorgram_df)
@@ -144,7 +154,7 @@ if __name__ == '__main__':
 
         # Prompt user for initial measurement data
         print('Please wait...')
-        current_data_path, scanspeed, time_df, angles_df, ydata_df, reflectivity_df = load_csv_data(default_data_folder=default_data_folder)
+        current_data_path, scanspeed, time_df, angles_df, ydata_df, reflectivity_df = load_csv_data(default_data_folder=default_data_folder, dtype=spectral_data_dtype)
 
         SPR_TIR_fitting_parameters = {}
 
@@ -166,6 +176,8 @@ if __name__ == '__main__':
         SPR_TIR_fitting_parameters['points_below_TIR_peak_scanspeed_10'] = int(TIR_default_parameters['points_below_TIR_peak_scanspeed_10'])
         SPR_TIR_fitting_parameters['TIR fit points'] = int(TIR_default_parameters['TIR_fit_points'])
         SPR_TIR_fitting_parameters['SPR fit points'] = int(SPR_default_parameters['SPR_fit_points'])
+        SPR_TIR_fitting_parameters['SPR tracker'] = SPR_default_parameters.get('SPR_tracker', SENSORGRAM_PARAMETER_DEFAULTS['SPR tracker'])
+        SPR_TIR_fitting_parameters['SPR centroid threshold'] = validate_centroid_threshold(SPR_default_parameters.get('SPR_centroid_threshold', SENSORGRAM_PARAMETER_DEFAULTS['SPR centroid threshold']))
 
         # Select active TIR fitting parameters based on scanspeed
         if scanspeed <= 5:
@@ -181,7 +193,9 @@ if __name__ == '__main__':
         current_session = Session(version, SPR_TIR_fitting_parameters, directory=default_session_folder, current_data_path=current_data_path)
 
         # Calculate sensorgram (assume air or liquid medium for TIR calculation based on number of scans)
-        sensorgram_df = calculate_sensorgram(time_df, angles_df, ydata_df, current_session.SPR_TIR_fitting_parameters)
+        # The sensorgram is calculated from the angle windows only (if enabled), the full spectra are read when needed
+        sensorgram_angles_df, sensorgram_ydata_df = sensorgram_spectra(angles_df, ydata_df, current_session.SPR_TIR_fitting_parameters, angle_margin=sensorgram_angle_margin)
+        sensorgram_df = load_or_calculate_sensorgram(current_session.location + '/Sensorgram cache', current_data_path, time_df, sensorgram_angles_df, sensorgram_ydata_df, current_session.SPR_TIR_fitting_parameters, logical_cores=logical_cores, cache_size=sensorgram_cache_size, scan_step=progressive_sensorgram_step if len(time_df) >= progressive_sensorgram_min_scans else 1)
 
         # Offset to start at 0 degrees at 0 minutes
         sensorgram_df_selection = copy.deepcopy(sensorgram_df)
@@ -216,6 +230,18 @@ if __name__ == '__main__':
         current_fresnel_analysis = None
         current_exclusion_height_analysis = None
 
+    # File position of the last scan read when following a measurement that is still running, and the FrameBuffers the
+    # new scans and their sensorgram are appended to
+    live_measurement_byte_offset = None
+    live_measurement_buffers = {}
+
+    # Only one refinement pass of a progressive sensorgram runs at a time, even if the refinement interval fires again
+    sensorgram_refinement_lock = threading.Lock()
+
+    # Held by every callback that replaces the sensorgram globals (sensorgram_df and the data it is calculated from), as
+    # Dash runs callbacks in parallel threads
+    sensorgram_lock = threading.Lock()
+
     # Dash app
     app = dash.Dash(name='SPRpy', title='SPRpy', external_stylesheets=[dash_app_theme], compress=True)
     app._favicon = 'icon.ico'
@@ -255,11 +281,15 @@ if __name__ == '__main__':
     sensorgram_fig.update_xaxes(mirror=True, showline=True)
     sensorgram_fig.update_yaxes(mirror=True, showline=True)
 
-    TIR_fitting_fig = px.line(x=sensorgram_df_selection['TIR deriv x'].iloc[-1], y=sensorgram_df_selection['TIR deriv y'].iloc[-1])
+    # Scans not calculated yet in a progressive sensorgram are bridged
+    sensorgram_fig.update_traces(connectgaps=sensorgram_df.attrs.get('scan step', 1) > 1)
+
+    TIR_deriv_x, TIR_deriv_y, TIR_deriv_fit_x, TIR_deriv_fit_y, SPR_fit_x, SPR_fit_y = sensorgram_fit_curves(sensorgram_df, -1, angles_df, ydata_df.iloc[-1], current_session.SPR_TIR_fitting_parameters)
+    TIR_fitting_fig = px.line(x=TIR_deriv_x, y=TIR_deriv_y)
     TIR_fitting_fig['data'][0]['showlegend'] = True
     TIR_fitting_fig['data'][0]['name'] = 'Derivative'
-    TIR_fitting_fig.add_trace(go.Scatter(x=sensorgram_df_selection['TIR deriv fit x'].iloc[-1],
-                                        y=sensorgram_df_selection['TIR deriv fit y'].iloc[-1],
+    TIR_fitting_fig.add_trace(go.Scatter(x=TIR_deriv_fit_x,
+                                        y=TIR_deriv_fit_y,
                                         name='Fit'))
     TIR_fitting_fig.update_layout(xaxis_title=r'$\large{\text{Incident angle [ }^{\circ}\text{ ]}}$',
                                  yaxis_title=r'$\large{\text{TIR angular derivative}\text{}}$',
@@ -277,8 +307,8 @@ if __name__ == '__main__':
     SPR_fitting_fig = px.line(x=reflectivity_df_selection_x, y=reflectivity_df_selection_y)
     SPR_fitting_fig['data'][0]['showlegend'] = True
     SPR_fitting_fig['data'][0]['name'] = 'SPR angle'
-    SPR_fitting_fig.add_trace(go.Scatter(x=sensorgram_df_selection['SPR fit x'].iloc[-1],
-                                         y=sensorgram_df_selection['SPR fit y'].iloc[-1],
+    SPR_fitting_fig.add_trace(go.Scatter(x=SPR_fit_x,
+                                         y=SPR_fit_y,
                                          name='Fit'))
     SPR_fitting_fig.update_layout(xaxis_title=r'$\large{\text{Incident angle [ }^{\circ}\text{ ]}}$',
                                    yaxis_title=r'$\large{\text{Reflectivity [a.u.]}}$',
@@ -609,11 +639,21 @@ if __name__ == '__main__':
                                 dash.dcc.Graph(id='quantification-sensorgram-graph',
                                                figure=sensorgram_fig,
                                                mathjax=True),
+                                dash.dcc.Interval(id='live-measurement-interval',
+                                                  interval=live_measurement_update_interval * 1000,
+                                                  disabled=True),
+                                dash.dcc.Interval(id='sensorgram-refinement-interval',
+                                                  interval=100,
+                                                  disabled=sensorgram_df.attrs.get('scan step', 1) == 1),
                                 dbc.ButtonGroup([
                                     dbc.Switch(
                                         id='hover-selection-switch',
                                         label='Stop mouse hover updates',
                                         value=False),
+                                    dbc.Switch(
+                                        id='live-measurement-switch',
+                                        label='Follow running measurement',
+                                        value=False),
                                     dbc.Switch(label='Show TIR/SPR fitting parameters',
                                                id='quantification-show-SPR-TIR-fit-options-switch',
                                                value=False),
@@ -697,6 +737,22 @@ if __name__ == '__main__':
                                                     ])
                                                 ], width=7)
                                             ]),
+                                            dbc.Row([
+                                                dbc.Col([
+                                                    dbc.InputGroup([
+                                                        dbc.Label('SPR tracker:', width='auto'),
+                                                        dash.dcc.Dropdown(id='SPR-fit-option-tracker',
+                                                                          options=[{'label': tracker, 'value': tracker} for tracker in SPR_TRACKERS],
+                                                                          value=current_session.SPR_TIR_fitting_parameters.get('SPR tracker', SENSORGRAM_PARAMETER_DEFAULTS['SPR tracker']),
+                                                                          clearable=False,
+                                                                          style={'width': '150px'}),
+                                                        dbc.Label('centroid threshold (fraction of dip depth)', width='auto'),
+                                                        dbc.Input(id='SPR-fit-option-centroid-threshold',
+                                                                  value=current_session.SPR_TIR_fitting_parameters.get('SPR centroid threshold', SENSORGRAM_PARAMETER_DEFAULTS['SPR centroid threshold']),
+                                                                  type='number', min=0.05, max=0.95, step=0.05)
+                                                    ])
+                                                ], width=7)
+                                            ]),
                                             dbc.Button('Apply TIR/SPR fit options',
                                                        id='quantification-apply-fitting-SPR-TIR-button',
                                                        n_clicks=0,
@@ -1510,50 +1566,58 @@ if __name__ == '__main__':
         global angles_df
         global ydata_df
         global reflectivity_df
+        global sensorgram_angles_df
+        global sensorgram_ydata_df
         global sensorgram_df
         global sensorgram_df_selection
         global corrected_sensorgram_df_selection
         global TIR_default_parameters
         global default_data_folder
+        global live_measurement_byte_offset
 
         if 'load-data' == dash.ctx.triggered_id:
             # Get the folder location of the last loaded datafile
             previous_path = os.path.dirname(current_data_path)
 
-            # Load measurement data and update session current data path
-            current_data_path, scanspeed, time_df, angles_df, ydata_df, reflectivity_df = load_csv_data(default_data_folder=previous_path)
-            current_session.current_data_path = current_data_path
+            with sensorgram_lock:
+                # Load measurement data and update session current data path
+                current_data_path, scanspeed, time_df, angles_df, ydata_df, reflectivity_df = load_csv_data(default_data_folder=previous_path, dtype=spectral_data_dtype)
+                current_session.current_data_path = current_data_path
+                live_measurement_byte_offset = None
+                live_measurement_buffers.clear()
 
-            # Calculate sensorgram (assume air or liquid medium for TIR calculation based on number of scans)
-            if ydata_df.shape[0] > 50:
-                current_session.SPR_TIR_fitting_parameters['TIR range'] = TIR_default_parameters['TIR_range_water_or_long_measurement']
-            else:
-                current_session.SPR_TIR_fitting_parameters['TIR range'] = TIR_default_parameters['TIR_range_air_or_few_scans']
+                # Calculate sensorgram (assume air or liquid medium for TIR calculation based on number of scans)
+                if ydata_df.shape[0] > 50:
+                    current_session.SPR_TIR_fitting_parameters['TIR range'] = TIR_default_parameters['TIR_range_water_or_long_measurement']
+                else:
+                    current_session.SPR_TIR_fitting_parameters['TIR range'] = TIR_default_parameters['TIR_range_air_or_few_scans']
 
-            # Select active TIR fitting parameters based on scanspeed
-            if scanspeed <= 5:
-                current_session.SPR_TIR_fitting_parameters['TIR window count'] = current_session.SPR_TIR_fitting_parameters['window_count_scanspeeds_1_5']
-                current_session.SPR_TIR_fitting_parameters['points_above_TIR_peak'] = current_session.SPR_TIR_fitting_parameters['points_above_TIR_peak_scanspeed_1_5']
-                current_session.SPR_TIR_fitting_parameters['points_below_TIR_peak'] = current_session.SPR_TIR_fitting_parameters['points_below_TIR_peak_scanspeed_1_5']
-            else:
-                current_session.SPR_TIR_fitting_parameters['TIR window count'] = current_session.SPR_TIR_fitting_parameters['window_count_scanspeeds_10']
-                current_session.SPR_TIR_fitting_parameters['points_above_TIR_peak'] = current_session.SPR_TIR_fitting_parameters['points_above_TIR_peak_scanspeed_10']
-                current_session.SPR_TIR_fitting_parameters['points_below_TIR_peak'] = current_session.SPR_TIR_fitting_parameters['points_below_TIR_peak_scanspeed_10']
+                # Select active TIR fitting parameters based on scanspeed
+                if scanspeed <= 5:
+                    current_session.SPR_TIR_fitting_parameters['TIR window count'] = current_session.SPR_TIR_fitting_parameters['window_count_scanspeeds_1_5']
+                    current_session.SPR_TIR_fitting_parameters['points_above_TIR_peak'] = current_session.SPR_TIR_fitting_parameters['points_above_TIR_peak_scanspeed_1_5']
+                    current_session.SPR_TIR_fitting_parameters['points_below_TIR_peak'] = current_session.SPR_TIR_fitting_parameters['points_below_TIR_peak_scanspeed_1_5']
+                else:
+                    current_session.SPR_TIR_fitting_parameters['TIR window count'] = current_session.SPR_TIR_fitting_parameters['window_count_scanspeeds_10']
+                    current_session.SPR_TIR_fitting_parameters['points_above_TIR_peak'] = current_session.SPR_TIR_fitting_parameters['points_above_TIR_peak_scanspeed_10']
+                    current_session.SPR_TIR_fitting_parameters['points_below_TIR_peak'] = current_session.SPR_TIR_fitting_parameters['points_below_TIR_peak_scanspeed_10']
 
-            current_session.save_session()
+                current_session.save_session()
 
-            sensorgram_df = calculate_sensorgram(time_df, angles_df, ydata_df, current_session.SPR_TIR_fitting_parameters)
+                # The sensorgram is calculated from the angle windows only (if enabled), the full spectra are read when needed
+                sensorgram_angles_df, sensorgram_ydata_df = sensorgram_spectra(angles_df, ydata_df, current_session.SPR_TIR_fitting_parameters, angle_margin=sensorgram_angle_margin)
+                sensorgram_df = load_or_calculate_sensorgram(current_session.location + '/Sensorgram cache', current_data_path, time_df, sensorgram_angles_df, sensorgram_ydata_df, current_session.SPR_TIR_fitting_parameters, logical_cores=logical_cores, cache_size=sensorgram_cache_size, scan_step=progressive_sensorgram_step if len(time_df) >= progressive_sensorgram_min_scans else 1)
 
-            # Offset to start at 0 degrees at 0 minutes
-            sensorgram_df_selection = copy.deepcopy(sensorgram_df)
-            sensorgram_df_selection['SPR angle'] = sensorgram_df_selection['SPR angle'] - \
-                                                   sensorgram_df_selection['SPR angle'][0]
-            sensorgram_df_selection['TIR angle'] = sensorgram_df_selection['TIR angle'] - \
-                                                   sensorgram_df_selection['TIR angle'][0]
+                # Offset to start at 0 degrees at 0 minutes
+                sensorgram_df_selection = copy.deepcopy(sensorgram_df)
+                sensorgram_df_selection['SPR angle'] = sensorgram_df_selection['SPR angle'] - \
+                                                       sensorgram_df_selection['SPR angle'][0]
+                sensorgram_df_selection['TIR angle'] = sensorgram_df_selection['TIR angle'] - \
+                                                       sensorgram_df_selection['TIR angle'][0]
 
-            # Calculate bulk correction
-            corrected_sensorgram_df_selection = sensorgram_df_selection['SPR angle'] - sensorgram_df_selection[
-                'TIR angle'] * instrument_SPR_sensitivity[current_data_path[-9:-6]] / instrument_TIR_sensitivity * math.exp(-2 * 0 / evanescent_decay_length[current_data_path[-9:-6]])
+                # Calculate bulk correction
+                corrected_sensorgram_df_selection = sensorgram_df_selection['SPR angle'] - sensorgram_df_selection[
+                    'TIR angle'] * instrument_SPR_sensitivity[current_data_path[-9:-6]] / instrument_TIR_sensitivity * math.exp(-2 * 0 / evanescent_decay_length[current_data_path[-9:-6]])
 
             return 'signal', ['Current measurement file:    ', current_data_path.split('/')[-1]], dash.no_update
 
@@ -1978,7 +2042,7 @@ if __name__ == '__main__':
 
         # This adds a trace to the reflectivity plot from a separate measurement file. The trace data is not stored.
         elif 'quantification-reflectivity-add-data-trace' == dash.ctx.triggered_id:
-            _, _, _, _, _, trace_reflectivity_df = load_csv_data(default_data_folder=os.path.dirname(current_data_path))
+            _, trace_reflectivity_df = load_csv_scan(default_data_folder=os.path.dirname(current_data_path))
             figure_object.add_trace(go.Scatter(x=trace_reflectivity_df['angles'],
                                                y=trace_reflectivity_df['ydata'],
                                                mode='lines',
@@ -1987,16 +2051,13 @@ if __name__ == '__main__':
 
         # This adds a fresnel calculation trace to the reflectivity plot
         elif 'quantification-reflectivity-add-fresnel-trace' == dash.ctx.triggered_id:
-            fresnel_coefficients = fresnel_calculation(None,
-                                                       angles=reflectivity_df['angles'],
-                                                       fitted_layer_index=current_sensor.fitted_layer_index,
-                                                       wavelength=current_sensor.wavelength,
-                                                       layer_thicknesses=current_sensor.layer_thicknesses,
-                                                       n_re=current_sensor.refractive_indices,
-                                                       n_im=current_sensor.extinction_coefficients,
-                                                       ydata=None,
-                                                       ydata_type=current_sensor.data_type,
-                                                       polarization=1.0)
+            fresnel_coefficients = cached_fresnel_calculation(angles=reflectivity_df['angles'],
+                                                              wavelength=current_sensor.wavelength,
+                                                              layer_thicknesses=current_sensor.layer_thicknesses,
+                                                              n_re=current_sensor.refractive_indices,
+                                                              n_im=current_sensor.extinction_coefficients,
+                                                              ydata_type=current_sensor.data_type,
+                                                              polarization=1.0)
             figure_object.add_trace(go.Scatter(x=reflectivity_df['angles'],
                                                y=fresnel_coefficients,
                                                mode='lines',
@@ -2134,6 +2195,7 @@ if __name__ == '__main__':
                                              uirevision=True)
             new_sensorgram_fig.update_xaxes(mirror=True, showline=True)
             new_sensorgram_fig.update_yaxes(mirror=True, showline=True)
+            new_sensorgram_fig.update_traces(connectgaps=sensorgram_df.attrs.get('scan step', 1) > 1)
 
             return new_sensorgram_fig
 
@@ -2201,6 +2263,7 @@ if __name__ == '__main__':
                                              uirevision=True)
             new_sensorgram_fig.update_xaxes(mirror=True, showline=True)
             new_sensorgram_fig.update_yaxes(mirror=True, showline=True)
+            new_sensorgram_fig.update_traces(connectgaps=sensorgram_df.attrs.get('scan step', 1) > 1)
 
             return new_sensorgram_fig
 
@@ -2212,6 +2275,216 @@ if __name__ == '__main__':
     def update_bulk_correction_parameters(signal):
         return instrument_SPR_sensitivity[current_data_path[-9:-6]], evanescent_decay_length[current_data_path[-9:-6]]
 
+    # Fill in the scans of a progressive sensorgram that have not been calculated yet, one refinement pass at a time
+    @dash.callback(
+        dash.Output('sensorgram-refinement-interval', 'disabled', allow_duplicate=True),
+        dash.Input('loaded-new-measurement', 'data'),
+        prevent_initial_call=True)
+    def start_sensorgram_refinement(signal):
+        return sensorgram_df.attrs.get('scan step', 1) == 1
+
+    @dash.callback(
+        dash.Output('quantification-sensorgram-graph', 'figure', allow_duplicate=True),
+        dash.Output('sensorgram-refinement-interval', 'disabled', allow_duplicate=True),
+        dash.Input('sensorgram-refinement-interval', 'n_intervals'),
+        dash.State('quantification-sensorgram-graph', 'clickData'),
+        dash.State('sensorgram-correction-layer-thickness', 'value'),
+        dash.State('sensorgram-correction-layer-S_SPR', 'value'),
+        dash.State('sensorgram-correction-layer-S_TIR', 'value'),
+        dash.State('sensorgram-correction-layer-decay-length', 'value'),
+        prevent_initial_call=True)
+    def refine_sensorgram_quantification_tab(n_intervals, clickData_state, layer_thickness_state, S_SPR_state, S_TIR_state, decay_length_state):
+
+        global sensorgram_df
+        global sensorgram_df_selection
+        global corrected_sensorgram_df_selection
+
+        if sensorgram_df.attrs.get('scan step', 1) == 1:
+            return dash.no_update, True
+
+        if not sensorgram_refinement_lock.acquire(blocking=False):
+            raise dash.exceptions.PreventUpdate
+        try:
+            # The refinement pass runs on a snapshot, so that other callbacks are not blocked while it is calculated
+            with sensorgram_lock:
+                previous_sensorgram_df = sensorgram_df
+                previous_angles_df = sensorgram_angles_df
+                previous_ydata_df = sensorgram_ydata_df
+                previous_fitting_parameters = copy.deepcopy(current_session.SPR_TIR_fitting_parameters)
+            refined_sensorgram_df = refine_sensorgram(previous_sensorgram_df, previous_angles_df, previous_ydata_df, previous_fitting_parameters, logical_cores=logical_cores)
+        finally:
+            sensorgram_refinement_lock.release()
+
+        with sensorgram_lock:
+            # The result is discarded if the sensorgram was replaced in the meantime (other fitting parameters or
+            # measurement, or a partially written last scan that was read again). Scans appended by a running
+            # measurement are kept.
+            previous_length = len(previous_sensorgram_df)
+            if (sensorgram_df.attrs.get('SPR parameters') != refined_sensorgram_df.attrs['SPR parameters']
+                    or sensorgram_df.attrs.get('TIR parameters') != refined_sensorgram_df.attrs['TIR parameters']
+                    or sensorgram_df.attrs.get('scan step', 1) != previous_sensorgram_df.attrs.get('scan step', 1)
+                    or len(sensorgram_df) < previous_length
+                    or not np.array_equal(sensorgram_df['time'].to_numpy()[:previous_length], previous_sensorgram_df['time'].to_numpy())
+                    or not np.array_equal(sensorgram_df[['SPR angle', 'TIR angle']].to_numpy()[previous_length - 1], previous_sensorgram_df[['SPR angle', 'TIR angle']].to_numpy()[-1], equal_nan=True)):
+                raise dash.exceptions.PreventUpdate
+            if len(sensorgram_df) > previous_length:
+                refined_attrs = refined_sensorgram_df.attrs
+                refined_sensorgram_df = pd.concat([refined_sensorgram_df, sensorgram_df.iloc[previous_length:]], ignore_index=True)
+                refined_sensorgram_df.attrs = refined_attrs
+            sensorgram_df = refined_sensorgram_df
+
+            # Offset to start at 0 degrees at 0 minutes
+            sensorgram_df_selection = copy.deepcopy(sensorgram_df)
+            sensorgram_df_selection['SPR angle'] = sensorgram_df_selection['SPR angle'] - \
+                                                   sensorgram_df_selection['SPR angle'][0]
+            sensorgram_df_selection['TIR angle'] = sensorgram_df_selection['TIR angle'] - \
+                                                   sensorgram_df_selection['TIR angle'][0]
+
+            # Calculate bulk correction
+            corrected_sensorgram_df_selection = sensorgram_df_selection['SPR angle'] - sensorgram_df_selection[
+                'TIR angle'] * instrument_SPR_sensitivity[current_data_path[-9:-6]] / instrument_TIR_sensitivity * math.exp(-2 * 0 / evanescent_decay_length[current_data_path[-9:-6]])
+
+        refinement_done = refined_sensorgram_df.attrs.get('scan step', 1) == 1
+        if refinement_done and 'cache key' in refined_sensorgram_df.attrs and sensorgram_cache_size > 0 and len(refined_sensorgram_df) == previous_length:
+            save_cached_sensorgram(current_session.location + '/Sensorgram cache', refined_sensorgram_df.attrs['cache key'], refined_sensorgram_df, cache_size=sensorgram_cache_size)
+
+        if clickData_state:
+            offset_index = clickData_state['points'][0]['pointIndex']
+        else:
+            offset_index = 0
+
+        SPR_angle_offset = sensorgram_df_selection['SPR angle'] - sensorgram_df_selection['SPR angle'].loc[offset_index]
+        TIR_angle_offset = sensorgram_df_selection['TIR angle'] - sensorgram_df_selection['TIR angle'].loc[offset_index]
+        new_sensorgram_fig = go.Figure(go.Scatter(x=sensorgram_df_selection['time'],
+                                                  y=SPR_angle_offset,
+                                                  name='SPR angle',
+                                                  line_color='#636efa'))
+
+        new_sensorgram_fig.add_trace(go.Scatter(x=sensorgram_df_selection['time'],
+                                                y=TIR_angle_offset,
+                                                name='TIR angle',
+                                                line_color='#ef553b'))
+
+        new_sensorgram_fig.add_trace(go.Scatter(x=sensorgram_df_selection['time'],
+                                                y=SPR_angle_offset - TIR_angle_offset * S_SPR_state / S_TIR_state * math.exp(
+                                                    -2 * layer_thickness_state / decay_length_state),
+                                                name='Bulk corrected',
+                                                line_color='#00CC96'))
+
+        new_sensorgram_fig.update_layout(xaxis_title=r'$\large{\text{Time [min]}}$',
+                                         yaxis_title=r'$\large{\text{Angular shift [ }^{\circ}\text{ ]}}$',
+                                         font_family='Balto',
+                                         font_size=19,
+                                         margin_r=25,
+                                         margin_l=60,
+                                         margin_t=40,
+                                         template='simple_white',
+                                         uirevision=True)
+        new_sensorgram_fig.update_xaxes(mirror=True, showline=True)
+        new_sensorgram_fig.update_yaxes(mirror=True, showline=True)
+        new_sensorgram_fig.update_traces(connectgaps=not refinement_done)
+
+        return new_sensorgram_fig, refinement_done
+
+    @dash.callback(
+        dash.Output('live-measurement-interval', 'disabled'),
+        dash.Input('live-measurement-switch', 'value'),
+        prevent_initial_call=True)
+    def toggle_live_measurement(live_switch):
+        return not live_switch
+
+    # Follow a measurement file that is still being written. New scans are tracked and appended to the sensorgram plot.
+    @dash.callback(
+        dash.Output('quantification-sensorgram-graph', 'extendData'),
+        dash.Output('loaded-new-measurement', 'data', allow_duplicate=True),
+        dash.Input('live-measurement-interval', 'n_intervals'),
+        dash.State('quantification-sensorgram-graph', 'clickData'),
+        dash.State('sensorgram-correction-layer-thickness', 'value'),
+        dash.State('sensorgram-correction-layer-S_SPR', 'value'),
+        dash.State('sensorgram-correction-layer-S_TIR', 'value'),
+        dash.State('sensorgram-correction-layer-decay-length', 'value'),
+        prevent_initial_call=True)
+    def update_live_measurement(n_intervals, clickData_state, layer_thickness_state, S_SPR_state, S_TIR_state, decay_length_state):
+
+        global time_df
+        global ydata_df
+        global reflectivity_df
+        global sensorgram_ydata_df
+        global sensorgram_df
+        global sensorgram_df_selection
+        global corrected_sensorgram_df_selection
+        global live_measurement_byte_offset
+
+        # A sensorgram that is being replaced is not extended, the new scans are read at the next update
+        if not sensorgram_lock.acquire(blocking=False):
+            raise dash.exceptions.PreventUpdate
+        try:
+            # The new scans are appended to buffers instead of copying all scans. Buffers are recreated from data that
+            # was replaced elsewhere since the last update (for instance a new measurement or sensorgram).
+            live_frames = {'time': time_df, 'ydata': ydata_df, 'sensorgram': sensorgram_df, 'sensorgram selection': sensorgram_df_selection, 'corrected sensorgram selection': corrected_sensorgram_df_selection}
+            if sensorgram_angle_margin is not None:
+                live_frames['sensorgram ydata'] = sensorgram_ydata_df
+            for frame_name, frame in live_frames.items():
+                if frame_name not in live_measurement_buffers or live_measurement_buffers[frame_name].frame is not frame:
+                    live_measurement_buffers[frame_name] = FrameBuffer(frame)
+
+            replot_sensorgram = False
+            if live_measurement_byte_offset is None:
+                # The last scan may have been partially written when the file was loaded, so it is read again
+                new_time, new_ydata, byte_offset = read_csv_tail(current_data_path, len(time_df) - 1, dtype=spectral_data_dtype)
+                if byte_offset is None or len(new_time) == 0:
+                    raise dash.exceptions.PreventUpdate
+                if np.array_equal(new_ydata[0], ydata_df.iloc[-1].to_numpy(), equal_nan=True):
+                    new_time, new_ydata = new_time[1:], new_ydata[1:]
+                else:
+                    for frame_name in live_frames:
+                        live_measurement_buffers[frame_name].truncate(len(time_df) - 1)
+                    replot_sensorgram = True
+            else:
+                new_time, new_ydata, byte_offset = read_csv_tail(current_data_path, len(time_df), byte_offset=live_measurement_byte_offset, dtype=spectral_data_dtype)
+            live_measurement_byte_offset = byte_offset
+            if len(new_time) == 0:
+                raise dash.exceptions.PreventUpdate
+
+            # Append the new scans (the measurement data is indexed from 1)
+            time_df = live_measurement_buffers['time'].append(new_time)
+            ydata_df = live_measurement_buffers['ydata'].append(new_ydata)
+            reflectivity_df = pd.DataFrame(data={'angles': angles_df, 'ydata': ydata_df.iloc[-1, :]})
+
+            # Only the new scans are tracked, within the same angle window as the rest of the sensorgram (column labels
+            # are the angle positions counted from 1)
+            new_sensorgram_ydata = new_ydata[:, sensorgram_ydata_df.columns.to_numpy() - 1]
+            if sensorgram_angle_margin is None:
+                sensorgram_ydata_df = ydata_df
+            else:
+                sensorgram_ydata_df = live_measurement_buffers['sensorgram ydata'].append(new_sensorgram_ydata)
+            sensorgram_df, new_sensorgram_df = extend_sensorgram(live_measurement_buffers['sensorgram'], new_time, sensorgram_angles_df, new_sensorgram_ydata, current_session.SPR_TIR_fitting_parameters)
+            new_sensorgram_df_selection = new_sensorgram_df.copy()
+            new_sensorgram_df_selection['SPR angle'] = new_sensorgram_df_selection['SPR angle'] - sensorgram_df['SPR angle'][0]
+            new_sensorgram_df_selection['TIR angle'] = new_sensorgram_df_selection['TIR angle'] - sensorgram_df['TIR angle'][0]
+            sensorgram_df_selection = live_measurement_buffers['sensorgram selection'].append(new_sensorgram_df_selection[live_measurement_buffers['sensorgram selection'].columns].to_numpy())
+            corrected_sensorgram_df_selection = live_measurement_buffers['corrected sensorgram selection'].append((new_sensorgram_df_selection['SPR angle'] - new_sensorgram_df_selection[
+                'TIR angle'] * instrument_SPR_sensitivity[current_data_path[-9:-6]] / instrument_TIR_sensitivity * math.exp(-2 * 0 / evanescent_decay_length[current_data_path[-9:-6]])).to_numpy())
+        finally:
+            sensorgram_lock.release()
+
+        # A partially written scan has already been plotted, so the whole sensorgram is plotted again
+        if replot_sensorgram:
+            return dash.no_update, 'signal'
+
+        # Otherwise only the new points are sent to the plotted traces
+        if clickData_state:
+            offset_index = clickData_state['points'][0]['pointIndex']
+        else:
+            offset_index = 0
+        SPR_angle_offset = new_sensorgram_df_selection['SPR angle'] - sensorgram_df_selection['SPR angle'].loc[offset_index]
+        TIR_angle_offset = new_sensorgram_df_selection['TIR angle'] - sensorgram_df_selection['TIR angle'].loc[offset_index]
+        bulk_corrected = SPR_angle_offset - TIR_angle_offset * S_SPR_state / S_TIR_state * math.exp(-2 * layer_thickness_state / decay_length_state)
+        new_time_points = new_sensorgram_df_selection['time'].tolist()
+
+        return (dict(x=[new_time_points, new_time_points, new_time_points],
+                     y=[SPR_angle_offset.tolist(), TIR_angle_offset.tolist(), bulk_corrected.tolist()]), [0, 1, 2]), dash.no_update
+
 
     # Update the reflectivity plot in the Fresnel fitting tab
     @dash.callback(
@@ -2459,7 +2732,7 @@ if __name__ == '__main__':
             current_fresnel_analysis = add_fresnel_model_object(current_session, current_sensor, current_data_path, reflectivity_df, analysis_name)
 
             # Calculate initial intensity offset from data
-            FR_y = fresnel_calculation(
+            FR_y = cached_fresnel_calculation(
                 angles=reflectivity_df['angles'].iloc[
                        reflectivity_df['ydata'].idxmin()-1:reflectivity_df['ydata'].idxmin()+2],
                 wavelength=current_fresnel_analysis.sensor_object.wavelength,
@@ -2774,8 +3047,8 @@ if __name__ == '__main__':
                 # Use the same layer structure copied from selected example sensor object
                 for file_path in batch_files:
 
-                    # Load data from measurement file using load_csv_data
-                    _, _, _, _, _, next_reflectivity_df_ = load_csv_data(path=file_path)
+                    # Load the last scan of the measurement file
+                    _, next_reflectivity_df_ = load_csv_scan(path=file_path)
 
                     # Add copy of sensor object to session and set parameters
                     next_sensor = copy_sensor_backend(current_session, example_sensor_object)
@@ -2838,8 +3111,8 @@ if __name__ == '__main__':
                 # Use the same layer structure copied from selected example sensor object
                 for file_path, sensor_id in zip(batch_files, background_sensors):
 
-                    # Load data from measurement file using load_csv_data
-                    _, batch_current_data_path, _, batch_ydata_df, _, next_reflectivity_df_ = load_csv_data(path=file_path)
+                    # Load the last scan of the measurement file
+                    _, next_reflectivity_df_ = load_csv_scan(path=file_path)
 
                     # Select background sensor
                     background_sensor_object = current_session.sensor_instances[sensor_id]
@@ -3276,9 +3549,11 @@ if __name__ == '__main__':
         dash.State('SPR-fit-option-points', 'value'),
         dash.State('SPR-fit-option-below-peak', 'value'),
         dash.State('SPR-fit-option-above-peak', 'value'),
+        dash.State('SPR-fit-option-tracker', 'value'),
+        dash.State('SPR-fit-option-centroid-threshold', 'value'),
         dash.State('quantification-show-SPR-TIR-fit-options-switch', 'value'),
         prevent_initial_call=True)
-    def SPR_TIR_fitting_parameters_update(fit_show_switch, hoverData, run_button, hover_selection_switch, TIR_range_low, TIR_range_high, TIR_window, TIR_fit_points, TIR_below_peak, TIR_above_peak, SPR_fit_points, SPR_below_peak, SPR_above_peak, fit_show_switch_state):
+    def SPR_TIR_fitting_parameters_update(fit_show_switch, hoverData, run_button, hover_selection_switch, TIR_range_low, TIR_range_high, TIR_window, TIR_fit_points, TIR_below_peak, TIR_above_peak, SPR_fit_points, SPR_below_peak, SPR_above_peak, SPR_tracker, SPR_centroid_threshold, fit_show_switch_state):
 
         global current_session
         global sensorgram_df
@@ -3286,6 +3561,8 @@ if __name__ == '__main__':
         global corrected_sensorgram_df_selection
         global ydata_df
         global reflectivity_df
+        global sensorgram_angles_df
+        global sensorgram_ydata_df
         global scanspeed
 
         if 'quantification-show-SPR-TIR-fit-options-switch' == dash.ctx.triggered_id:
@@ -3293,38 +3570,54 @@ if __name__ == '__main__':
 
         # Applying the fit settings and updating  the session object
         elif 'quantification-apply-fitting-SPR-TIR-button' == dash.ctx.triggered_id:
-            current_session.SPR_TIR_fitting_parameters['TIR range'] = [float(TIR_range_low), float(TIR_range_high)]
-            current_session.SPR_TIR_fitting_parameters['TIR window count'] = int(TIR_window)
-            current_session.SPR_TIR_fitting_parameters['TIR fit points'] = int(TIR_fit_points)
-            current_session.SPR_TIR_fitting_parameters['points_below_TIR_peak'] = int(TIR_below_peak)
-            current_session.SPR_TIR_fitting_parameters['points_above_TIR_peak'] = int(TIR_above_peak)
-            current_session.SPR_TIR_fitting_parameters['SPR fit points'] = int(SPR_fit_points)
-            current_session.SPR_TIR_fitting_parameters['sensorgram_angle_range_points'] = [int(SPR_below_peak), int(SPR_above_peak)]
-
-            # Select active TIR fitting parameters based on scanspeed
-            if scanspeed <= 5:
-                current_session.SPR_TIR_fitting_parameters['window_count_scanspeeds_1_5'] = int(TIR_window)
-                current_session.SPR_TIR_fitting_parameters['points_above_TIR_peak_scanspeed_1_5'] = int(TIR_above_peak)
-                current_session.SPR_TIR_fitting_parameters['points_below_TIR_peak_scanspeed_1_5'] = int(TIR_below_peak)
-            else:
-                current_session.SPR_TIR_fitting_parameters['window_count_scanspeeds_10'] = int(TIR_window)
-                current_session.SPR_TIR_fitting_parameters['points_above_TIR_peak_scanspeed_10'] = int(TIR_above_peak)
-                current_session.SPR_TIR_fitting_parameters['points_below_TIR_peak_scanspeed_10'] = int(TIR_below_peak)
 
-            current_session.save_session()
+            # The centroid threshold is only used by the centroid tracker. An invalid threshold is rejected before the
+            # session is modified if it is used, and otherwise the previous threshold is kept.
+            try:
+                SPR_centroid_threshold = validate_centroid_threshold(SPR_centroid_threshold)
+            except ValueError as error:
+                if SPR_tracker == 'centroid':
+                    print('Warning! ' + str(error))
+                    raise dash.exceptions.PreventUpdate
+                SPR_centroid_threshold = current_session.SPR_TIR_fitting_parameters.get('SPR centroid threshold', SENSORGRAM_PARAMETER_DEFAULTS['SPR centroid threshold'])
+
+            with sensorgram_lock:
+                current_session.SPR_TIR_fitting_parameters['TIR range'] = [float(TIR_range_low), float(TIR_range_high)]
+                current_session.SPR_TIR_fitting_parameters['TIR window count'] = int(TIR_window)
+                current_session.SPR_TIR_fitting_parameters['TIR fit points'] = int(TIR_fit_points)
+                current_session.SPR_TIR_fitting_parameters['points_below_TIR_peak'] = int(TIR_below_peak)
+                current_session.SPR_TIR_fitting_parameters['points_above_TIR_peak'] = int(TIR_above_peak)
+                current_session.SPR_TIR_fitting_parameters['SPR fit points'] = int(SPR_fit_points)
+                current_session.SPR_TIR_fitting_parameters['sensorgram_angle_range_points'] = [int(SPR_below_peak), int(SPR_above_peak)]
+                current_session.SPR_TIR_fitting_parameters['SPR tracker'] = SPR_tracker
+                current_session.SPR_TIR_fitting_parameters['SPR centroid threshold'] = SPR_centroid_threshold
+
+                # Select active TIR fitting parameters based on scanspeed
+                if scanspeed <= 5:
+                    current_session.SPR_TIR_fitting_parameters['window_count_scanspeeds_1_5'] = int(TIR_window)
+                    current_session.SPR_TIR_fitting_parameters['points_above_TIR_peak_scanspeed_1_5'] = int(TIR_above_peak)
+                    current_session.SPR_TIR_fitting_parameters['points_below_TIR_peak_scanspeed_1_5'] = int(TIR_below_peak)
+                else:
+                    current_session.SPR_TIR_fitting_parameters['window_count_scanspeeds_10'] = int(TIR_window)
+                    current_session.SPR_TIR_fitting_parameters['points_above_TIR_peak_scanspeed_10'] = int(TIR_above_peak)
+                    current_session.SPR_TIR_fitting_parameters['points_below_TIR_peak_scanspeed_10'] = int(TIR_below_peak)
 
-            sensorgram_df = calculate_sensorgram(time_df, angles_df, ydata_df, current_session.SPR_TIR_fitting_parameters)
+                current_session.save_session()
 
-            # Offset to start at 0 degrees at 0 minutes
-            sensorgram_df_selection = copy.deepcopy(sensorgram_df)
-            sensorgram_df_selection['SPR angle'] = sensorgram_df_selection['SPR angle'] - \
-                                                   sensorgram_df_selection['SPR angle'][0]
-            sensorgram_df_selection['TIR angle'] = sensorgram_df_selection['TIR angle'] - \
-                                                   sensorgram_df_selection['TIR angle'][0]
+                # Only the SPR or TIR angles whose fitting parameters changed are recalculated (the angle windows may have moved)
+                sensorgram_angles_df, sensorgram_ydata_df = sensorgram_spectra(angles_df, ydata_df, current_session.SPR_TIR_fitting_parameters, angle_margin=sensorgram_angle_margin)
+                sensorgram_df = load_or_calculate_sensorgram(current_session.location + '/Sensorgram cache', current_data_path, time_df, sensorgram_angles_df, sensorgram_ydata_df, current_session.SPR_TIR_fitting_parameters, previous_sensorgram_df=sensorgram_df, logical_cores=logical_cores, cache_size=sensorgram_cache_size)
 
-            # Calculate bulk correction
-            corrected_sensorgram_df_selection = sensorgram_df_selection['SPR angle'] - sensorgram_df_selection[
-                'TIR angle'] * instrument_SPR_sensitivity[current_data_path[-9:-6]] / instrument_TIR_sensitivity * math.exp(-2 * 0 / evanescent_decay_length[current_data_path[-9:-6]])
+                # Offset to start at 0 degrees at 0 minutes
+                sensorgram_df_selection = copy.deepcopy(sensorgram_df)
+                sensorgram_df_selection['SPR angle'] = sensorgram_df_selection['SPR angle'] - \
+                                                       sensorgram_df_selection['SPR angle'][0]
+                sensorgram_df_selection['TIR angle'] = sensorgram_df_selection['TIR angle'] - \
+                                                       sensorgram_df_selection['TIR angle'][0]
+
+                # Calculate bulk correction
+                corrected_sensorgram_df_selection = sensorgram_df_selection['SPR angle'] - sensorgram_df_selection[
+                    'TIR angle'] * instrument_SPR_sensitivity[current_data_path[-9:-6]] / instrument_TIR_sensitivity * math.exp(-2 * 0 / evanescent_decay_length[current_data_path[-9:-6]])
 
             return dash.no_update, dash.no_update, dash.no_update, 'signal'
 
@@ -3335,11 +3628,12 @@ if __name__ == '__main__':
                 time_index = hoverData['points'][0]['pointIndex']
                 reflectivity_ydata = ydata_df.loc[time_index + 1]
 
-                TIR_fitting_figure = px.line(x=sensorgram_df_selection['TIR deriv x'].iloc[time_index], y=sensorgram_df_selection['TIR deriv y'].iloc[time_index])
+                TIR_deriv_x, TIR_deriv_y, TIR_deriv_fit_x, TIR_deriv_fit_y, SPR_fit_x, SPR_fit_y = sensorgram_fit_curves(sensorgram_df, time_index, angles_df, reflectivity_ydata, current_session.SPR_TIR_fitting_parameters)
+                TIR_fitting_figure = px.line(x=TIR_deriv_x, y=TIR_deriv_y)
                 TIR_fitting_figure['data'][0]['showlegend'] = True
                 TIR_fitting_figure['data'][0]['name'] = 'Derivative'
-                TIR_fitting_figure.add_trace(go.Scatter(x=sensorgram_df_selection['TIR deriv fit x'].iloc[time_index],
-                                                     y=sensorgram_df_selection['TIR deriv fit y'].iloc[time_index],
+                TIR_fitting_figure.add_trace(go.Scatter(x=TIR_deriv_fit_x,
+                                                     y=TIR_deriv_fit_y,
                                                      name='Fit'))
                 TIR_fitting_figure.update_layout(xaxis_title=r'$\large{\text{Incident angle [ }^{\circ}\text{ ]}}$',
                                               yaxis_title=r'$\large{\text{TIR angular derivative}\text{}}$',
@@ -3365,8 +3659,8 @@ if __name__ == '__main__':
                 SPR_fitting_figure = px.line(x=reflectivity_df_selection_x, y=reflectivity_df_selection_y)
                 SPR_fitting_figure['data'][0]['showlegend'] = True
                 SPR_fitting_figure['data'][0]['name'] = 'SPR angle'
-                SPR_fitting_figure.add_trace(go.Scatter(x=sensorgram_df_selection['SPR fit x'].iloc[time_index],
-                                                     y=sensorgram_df_selection['SPR fit y'].iloc[time_index],
+                SPR_fitting_figure.add_trace(go.Scatter(x=SPR_fit_x,
+                                                     y=SPR_fit_y,
                                                      name='Fit'))
                 SPR_fitting_figure.update_layout(xaxis_title=r'$\large{\text{Incident angle [ }^{\circ}\text{ ]}}$',
                                               yaxis_title=r'$\large{\text{Reflectivity [a.u.]}}$',
@@ -3767,42 +4061,42 @@ if __name__ == '__main__':
                 buffer_prism_val = current_exclusion_height_analysis.d_n_pair_dfs[active_page_state - 1].loc[dnpair_hoverdata['points'][0]['pointIndex'], 'buffer prism k']
                 probe_prism_val = current_exclusion_height_analysis.d_n_pair_dfs[active_page_state - 1].loc[dnpair_hoverdata['points'][0]['pointIndex'], 'probe prism k']
 
-            buffer_ext_coefficients = copy.deepcopy(current_exclusion_height_analysis.sensor_object.extinction_coefficients)
-            buffer_ext_coefficients[0] = buffer_prism_val
-
-            probe_ext_coefficients = copy.deepcopy(current_exclusion_height_analysis.sensor_object.extinction_coefficients)
-            probe_ext_coefficients[0] = probe_prism_val
-
-            buffer_ref_indices = copy.deepcopy(current_exclusion_height_analysis.sensor_object.refractive_indices)
-            buffer_ref_indices[-1] = current_exclusion_height_analysis.buffer_bulk_RIs[active_page_state-1]
-            buffer_ref_indices[current_exclusion_height_analysis.sensor_object.fitted_layer_index[0]] = float(buffer_RI_val)
-
-            buffer_layer_thicknesses = copy.deepcopy(current_exclusion_height_analysis.sensor_object.layer_thicknesses)
-            buffer_layer_thicknesses[current_exclusion_height_analysis.sensor_object.fitted_layer_index[0]] = float(height_val)
-
-            probe_ref_indices = copy.deepcopy(current_exclusion_height_analysis.sensor_object.refractive_indices)
-            probe_ref_indices[-1] = current_exclusion_height_analysis.probe_bulk_RIs[int((active_page_state-1)/2)]
-            probe_ref_indices[current_exclusion_height_analysis.sensor_object.fitted_layer_index[0]] = float(
-                probe_RI_val)
-
-            probe_layer_thicknesses = copy.deepcopy(current_exclusion_height_analysis.sensor_object.layer_thicknesses)
-            probe_layer_thicknesses[current_exclusion_height_analysis.sensor_object.fitted_layer_index[0]] = float(
-                height_val)
-
-            buffer_fresnel_coefficients = fresnel_calculation(angles=buffer_angles_inj_step,
-                                                              wavelength=current_exclusion_height_analysis.sensor_object.wavelength,
-                                                              layer_thicknesses=buffer_layer_thicknesses,
-                                                              n_re=buffer_ref_indices,
-                                                              n_im=buffer_ext_coefficients,
-                                                              ydata_offset=buffer_offset_val,
-                                                              )
-            probe_fresnel_coefficients = fresnel_calculation(angles=probe_angles_inj_step,
-                                                             wavelength=current_exclusion_height_analysis.sensor_object.wavelength,
-                                                             layer_thicknesses=probe_layer_thicknesses,
-                                                             n_re=probe_ref_indices,
-                                                             n_im=probe_ext_coefficients,
-                                                             ydata_offset=probe_offset_val,
-                                                             )
+            # Buffer (first row) and probe (second row) layers, np.stack creates new arrays so the sensor layers are left unchanged
+            inj_step_layer_thicknesses = np.stack((current_exclusion_height_analysis.sensor_object.layer_thicknesses,) * 2)
+            inj_step_layer_thicknesses[:, current_exclusion_height_analysis.sensor_object.fitted_layer_index[0]] = float(height_val)
+
+            inj_step_ref_indices = np.stack((current_exclusion_height_analysis.sensor_object.refractive_indices,) * 2)
+            inj_step_ref_indices[:, -1] = [current_exclusion_height_analysis.buffer_bulk_RIs[active_page_state-1], current_exclusion_height_analysis.probe_bulk_RIs[int((active_page_state-1)/2)]]
+            inj_step_ref_indices[:, current_exclusion_height_analysis.sensor_object.fitted_layer_index[0]] = [float(buffer_RI_val), float(probe_RI_val)]
+
+            inj_step_ext_coefficients = np.stack((current_exclusion_height_analysis.sensor_object.extinction_coefficients,) * 2)
+            inj_step_ext_coefficients[:, 0] = [buffer_prism_val, probe_prism_val]
+
+            # Buffer and probe traces are calculated together in one batched call when their angle windows have the same
+            # length, the windows may be clipped differently near the edges of the scan
+            if np.shape(buffer_angles_inj_step) == np.shape(probe_angles_inj_step):
+                buffer_fresnel_coefficients, probe_fresnel_coefficients = cached_fresnel_calculation(angles=np.stack((buffer_angles_inj_step, probe_angles_inj_step)),
+                                                                                                     wavelength=current_exclusion_height_analysis.sensor_object.wavelength,
+                                                                                                     layer_thicknesses=inj_step_layer_thicknesses,
+                                                                                                     n_re=inj_step_ref_indices,
+                                                                                                     n_im=inj_step_ext_coefficients,
+                                                                                                     ydata_offset=np.array([buffer_offset_val, probe_offset_val]),
+                                                                                                     )
+            else:
+                buffer_fresnel_coefficients = cached_fresnel_calculation(angles=buffer_angles_inj_step,
+                                                                         wavelength=current_exclusion_height_analysis.sensor_object.wavelength,
+                                                                         layer_thicknesses=inj_step_layer_thicknesses[0],
+                                                                         n_re=inj_step_ref_indices[0],
+                                                                         n_im=inj_step_ext_coefficients[0],
+                                                                         ydata_offset=buffer_offset_val,
+                                                                         )
+                probe_fresnel_coefficients = cached_fresnel_calculation(angles=probe_angles_inj_step,
+                                                                        wavelength=current_exclusion_height_analysis.sensor_object.wavelength,
+                                                                        layer_thicknesses=inj_step_layer_thicknesses[1],
+                                                                        n_re=inj_step_ref_indices[1],
+                                                                        n_im=inj_step_ext_coefficients[1],
+                                                                        ydata_offset=probe_offset_val,
+                                                                        )
             
             # Plot mean reflectivity figure with fitted fresnel traces
             mean_reflectivity_figure = go.Figure(
@@ -4815,7 +5109,10 @@ if __name__ == '__main__':
             current_exclusion_height_analysis.mean_exclusion_RI_result = [np.nan]
 
             # Run exclusion height calculations
-            process_all_exclusion_heights(current_exclusion_height_analysis, logical_cores)
+            if exclusion_height_surrogate_tables:
+                process_all_exclusion_heights(current_exclusion_height_analysis, logical_cores, surrogate_folder=current_session.location + '/Surrogate tables')
+            else:
+                process_all_exclusion_heights(current_exclusion_height_analysis, logical_cores)
 
             # Wait for all results to be in
             while 0 in current_exclusion_height_analysis.all_exclusion_results:
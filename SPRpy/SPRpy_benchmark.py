@@ -0,0 +1,288 @@
+# Run this script to benchmark the fresnel transfer-matrix engine and the fitting entry points that depend on it.
+# All measurement data is synthetic, so no data files are needed. Sensor defaults and fitting parameters are read from
+# config.toml.
+# Results are printed and written to a .json file (named after the computer and the time of the run unless --output is
+# given). Compare two result files from the same computer with --compare to see how engine changes affect performance.
+# Example: python SPRpy_benchmark.py --compare "SPRpy_benchmark_MYPC_26-10-17_12-00-00.json"
+
+import argparse
+import json
+import os
+import platform
+import time
+import timeit
+import tomllib
+import types
+import scipy
+import numpy as np
+import pandas as pd
+import SPRpy_classes
+from datetime import datetime
+from __about__ import version
+from fresnel_transfer_matrix import fresnel_calculation, fresnel_calculation_batch, FresnelLeastSquares
+
+LAYER_COUNTS = [2, 3, 5, 10, 20, 50]
+ANGLE_COUNTS = [100, 1000, 10000]
+BATCH_SIZES = [1, 10, 100, 1000]
+BATCH_ANGLE_COUNTS = [100, 1000]
+BATCH_LAYER_COUNT = 5
+
+
+def time_call(function, repeats=5, min_time=0.2):
+
+    """
+    Times a function call with timeit. The number of calls per repeat is chosen automatically so that each repeat takes
+    at least min_time seconds, and the fastest repeat is reported (the least disturbed by other processes).
+
+    :param function: callable without arguments
+    :param repeats: int, number of timed repeats
+    :param min_time: float, minimum duration of each repeat in seconds
+    :return: dict with time per call (seconds) and calls per second
+    """
+
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    number = max(number, int(np.ceil(number * min_time / 0.2)))
+    best_time = min(timer.repeat(repeat=repeats, number=number)) / number
+
+    return {'time_per_call_s': best_time, 'calls_per_s': 1 / best_time}
+
+
+class LeastSquaresCounter:
+
+    """
+    Context manager counting the function (nfev) and jacobian (njev) evaluations of all scipy.optimize.least_squares
+    calls made within it, and the transfer-matrix calculations they needed (residuals and Jacobian of the same
+    variables are calculated together by FresnelLeastSquares).
+    """
+
+    def __init__(self):
+        self.fits = 0
+        self.nfev = 0
+        self.njev = 0
+        self.calculations = 0
+        self.least_squares = None
+
+    def __enter__(self):
+        self.least_squares = scipy.optimize.least_squares
+
+        def counted_least_squares(*args, **kwargs):
+            result = self.least_squares(*args, **kwargs)
+            self.fits += 1
+            njev = result['njev'] if result['njev'] is not None else 0
+            self.nfev += result['nfev']
+            self.njev += njev
+            fresnel_fit = getattr(args[0], '__self__', None)
+            self.calculations += fresnel_fit.calculations if isinstance(fresnel_fit, FresnelLeastSquares) else result['nfev'] + njev
+            return result
+
+        scipy.optimize.least_squares = counted_least_squares
+        return self
+
+    def __exit__(self, *exc_info):
+        scipy.optimize.least_squares = self.least_squares
+        return False
+
+
+def layer_structure(layer_count, wavelength=670):
+
+    """
+    Synthetic layer structure with the requested total number of layers (including prism and bulk). The layers between
+    the prism and the bulk alternate between absorbing metal-like and dielectric layers.
+
+    :param layer_count: int, at least 2
+    :param wavelength: int
+    :return: tuple of ndarrays (layer_thicknesses, n_re, n_im)
+    """
+
+    layer_thicknesses = np.full(layer_count, np.nan)
+    n_re = np.full(layer_count, 1.4)
+    n_im = np.zeros(layer_count)
+    n_re[0] = 1.5202
+    n_re[-1] = 1.333
+    for layer in range(1, layer_count - 1):
+        if layer % 2:
+            layer_thicknesses[layer] = 50 / np.ceil((layer_count - 2) / 2)
+            n_re[layer] = 0.2238
+            n_im[layer] = 3.88
+        else:
+            layer_thicknesses[layer] = 5
+
+    return layer_thicknesses, n_re, n_im
+
+
+def benchmark_engine(repeats):
+
+    results = []
+
+    # Single curves over layer and angle counts
+    for layer_count in LAYER_COUNTS:
+        layer_thicknesses, n_re, n_im = layer_structure(layer_count)
+        for angle_count in ANGLE_COUNTS:
+            angles = np.linspace(40, 80, angle_count)
+            timing = time_call(lambda: fresnel_calculation(angles=angles, layer_thicknesses=layer_thicknesses, n_re=n_re, n_im=n_im), repeats=repeats)
+            results.append({'benchmark': 'fresnel_calculation', 'layers': layer_count, 'angles': angle_count, 'batch_size': 1, **timing})
+            print('fresnel_calculation        layers: {0:3d}  angles: {1:6d}  {2:10.1f} calls/s'.format(layer_count, angle_count, timing['calls_per_s']))
+
+    # Many layer configurations in one call
+    layer_thicknesses, n_re, n_im = layer_structure(BATCH_LAYER_COUNT)
+    for batch_angle_count in BATCH_ANGLE_COUNTS:
+        angles = np.linspace(40, 80, batch_angle_count)
+        for batch_size in BATCH_SIZES:
+            batch_thicknesses = np.tile(layer_thicknesses, (batch_size, 1))
+            batch_thicknesses[:, -2] = np.linspace(1, 50, batch_size)
+            timing = time_call(lambda: fresnel_calculation_batch(angles, 670, batch_thicknesses, n_re, n_im), repeats=repeats)
+            timing['curves_per_s'] = batch_size * timing['calls_per_s']
+            results.append({'benchmark': 'fresnel_calculation_batch', 'layers': BATCH_LAYER_COUNT, 'angles': batch_angle_count, 'batch_size': batch_size, **timing})
+            print('fresnel_calculation_batch  layers: {0:3d}  angles: {1:6d}  batch: {2:5d}  {3:10.1f} curves/s'.format(BATCH_LAYER_COUNT, batch_angle_count, batch_size, timing['curves_per_s']))
+
+    return results
+
+
+def benchmark_fresnel_fit(config, SPR_TIR_fitting_parameters, repeats):
+
+    """
+    Times FresnelModel.model_reflectivity_trace() fitting the gold layer thickness and reflectivity offset of a
+    synthetic, noisy gold sensor measurement in water.
+    """
+
+    session = types.SimpleNamespace(SPR_TIR_fitting_parameters=SPR_TIR_fitting_parameters)
+    sensor = SPRpy_classes.Sensor('benchmark_L1_670nm.csv', 1, config['default_sensor_values'])
+    sensor.fitted_layer_index = (2, 1)
+    sensor.refractive_indices[-1] = 1.333
+    true_layer_thicknesses = sensor.layer_thicknesses.copy()
+    true_refractive_indices = sensor.refractive_indices.copy()
+    true_extinction_coefficients = sensor.extinction_coefficients.copy()
+
+    angles = np.linspace(58, 80, 1800)
+    ydata = fresnel_calculation(angles=angles, wavelength=670, layer_thicknesses=true_layer_thicknesses, n_re=true_refractive_indices, n_im=true_extinction_coefficients, ydata_offset=0.01)
+    ydata = ydata + np.random.default_rng(1).normal(0, 1e-4, len(angles))
+    reflectivity_df = pd.DataFrame({'angles': angles, 'ydata': ydata})
+
+    fresnel_model = SPRpy_classes.FresnelModel(session, sensor, 'benchmark_L1_670nm.csv', reflectivity_df, 1, 'Benchmark')
+    minimum_index = int(np.argmin(ydata))
+    fresnel_model.angle_range = [angles[minimum_index - SPR_TIR_fitting_parameters['Fresnel_angle_range_points'][0]], angles[minimum_index + SPR_TIR_fitting_parameters['Fresnel_angle_range_points'][1]]]
+    fresnel_model.ini_guess = np.array([45.0, 0.0])
+    fresnel_model.bounds = [(fresnel_model.ini_guess[0] / 4, -np.inf), (fresnel_model.ini_guess[0] * 2, np.inf)]
+
+    def fit():
+        # Every fit starts from the same sensor layers
+        sensor.layer_thicknesses[:] = true_layer_thicknesses
+        sensor.refractive_indices[:] = true_refractive_indices
+        sensor.extinction_coefficients[:] = true_extinction_coefficients
+        fresnel_model.model_reflectivity_trace()
+
+    with LeastSquaresCounter() as counter:
+        fit()
+    timing = time_call(fit, repeats=repeats, min_time=0.5)
+    result = {'benchmark': 'FresnelModel.model_reflectivity_trace', 'angles': len(fresnel_model.fitted_data), 'time_per_fit_s': timing['time_per_call_s'],
+              'fits_per_s': timing['calls_per_s'], 'nfev': counter.nfev, 'njev': counter.njev,
+              'calculations': counter.calculations, 'fitted_result': fresnel_model.fitted_result.tolist()}
+    print('FresnelModel fit           {0:10.2f} ms/fit  nfev: {1}  njev: {2}  transfer-matrix calculations: {3}'.format(1000 * result['time_per_fit_s'], result['nfev'], result['njev'], result['calculations']))
+
+    return result
+
+
+def benchmark_exclusion_height(config, SPR_TIR_fitting_parameters, repeats, height_step_count=50):
+
+    """
+    Times calculate_exclusion_height() for one synthetic buffer injection step of a swollen surface layer on gold.
+    """
+
+    session = types.SimpleNamespace(SPR_TIR_fitting_parameters=SPR_TIR_fitting_parameters)
+    sensor = SPRpy_classes.Sensor('benchmark_L1_670nm.csv', 1, config['default_sensor_values'])
+    sensor.layer_thicknesses = np.array([np.nan, sensor.layer_thicknesses[1], sensor.layer_thicknesses[2], 30, np.nan])
+    sensor.refractive_indices = np.array([sensor.refractive_indices[0], sensor.refractive_indices[1], sensor.refractive_indices[2], 1.36, 1.333])
+    sensor.extinction_coefficients = np.array([sensor.extinction_coefficients[0], sensor.extinction_coefficients[1], sensor.extinction_coefficients[2], 0, 0])
+    sensor.fitted_layer_index = (3, 2)
+
+    angles = np.linspace(64, 76, 300)
+    ydata = fresnel_calculation(angles=angles, wavelength=670, layer_thicknesses=sensor.layer_thicknesses, n_re=sensor.refractive_indices, n_im=sensor.extinction_coefficients)
+    ydata = ydata + np.random.default_rng(2).normal(0, 1e-4, len(angles))
+    reflectivity_df = pd.DataFrame({'angles': angles, 'ydata': ydata})
+
+    fresnel_model = SPRpy_classes.FresnelModel(session, sensor, 'benchmark_L1_670nm.csv', reflectivity_df, 1, 'Benchmark')
+    fresnel_model.ini_guess = np.array([1.36, 0.0])
+    fresnel_model.y_offset = 0
+    exclusion_height = SPRpy_classes.ExclusionHeight(session, fresnel_model, pd.DataFrame(np.zeros((1, 3))), 'benchmark_L1_670nm.csv', 1, 'Benchmark')
+    exclusion_height.fit_offset = True
+    exclusion_height.height_steps = np.linspace(10, 60, height_step_count)
+    exclusion_height.buffer_reflectivity_dfs = [pd.DataFrame({'angles': angles, 'reflectivity': ydata})]
+    exclusion_height.buffer_bulk_RIs = [1.333]
+
+    with LeastSquaresCounter() as counter:
+        SPRpy_classes.calculate_exclusion_height(exclusion_height, 'buffer', 0)
+    timing = time_call(lambda: SPRpy_classes.calculate_exclusion_height(exclusion_height, 'buffer', 0), repeats=repeats, min_time=0.5)
+    result = {'benchmark': 'calculate_exclusion_height', 'angles': len(angles), 'height_steps': height_step_count, 'time_per_call_s': timing['time_per_call_s'],
+              'time_per_fit_s': timing['time_per_call_s'] / counter.fits, 'nfev': counter.nfev, 'njev': counter.njev, 'nfev_per_fit': counter.nfev / counter.fits,
+              'calculations': counter.calculations}
+    print('calculate_exclusion_height {0:10.2f} ms/fit  nfev: {1}  njev: {2}  transfer-matrix calculations: {3}  ({4} height steps)'.format(1000 * result['time_per_fit_s'], result['nfev'], result['njev'], result['calculations'], height_step_count))
+
+    return result
+
+
+def compare_results(results, previous_results):
+
+    """
+    Prints the speed of each benchmark relative to a previous run (>1 means faster now).
+    """
+
+    def key(entry):
+        return tuple((label, entry[label]) for label in ('benchmark', 'layers', 'angles', 'batch_size', 'height_steps') if label in entry)
+
+    previous_entries = {key(entry): entry for entry in previous_results['results']}
+    print('\nSpeedup relative to {0}:'.format(previous_results['timestamp']))
+    for entry in results['results']:
+        if key(entry) not in previous_entries:
+            continue
+        timing_label = 'time_per_fit_s' if 'time_per_fit_s' in entry else 'time_per_call_s'
+        speedup = previous_entries[key(entry)][timing_label] / entry[timing_label]
+        print('{0:75s} {1:6.2f}x'.format(', '.join('{0}: {1}'.format(label, value) for label, value in key(entry)), speedup))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the SPRpy fresnel transfer-matrix engine.')
+    parser.add_argument('--output', default=None, help='Result file (.json)')
+    parser.add_argument('--compare', default=None, help='Previous result file (.json) to compare against')
+    parser.add_argument('--repeats', type=int, default=5, help='Number of timed repeats of each benchmark (fastest is reported)')
+    arguments = parser.parse_args()
+
+    # Read configuration parameters
+    with open('config.toml', 'r') as f:
+        config = tomllib.loads(f.read())
+
+    SPR_TIR_fitting_parameters = {'TIR range': [float(i) for i in config['TIR_fitting_parameters']['TIR_range_water_or_long_measurement']],
+                                  'Fresnel_angle_range_points': [int(i) for i in config['SPR_fitting_parameters']['Fresnel_angle_range_points']],
+                                  'TIR window count': int(config['TIR_fitting_parameters']['window_count_scanspeeds_1_5']),
+                                  'points_above_TIR_peak': int(config['TIR_fitting_parameters']['points_above_TIR_peak_scanspeed_1_5']),
+                                  'points_below_TIR_peak': int(config['TIR_fitting_parameters']['points_below_TIR_peak_scanspeed_1_5']),
+                                  'TIR fit points': int(config['TIR_fitting_parameters']['TIR_fit_points']),
+                                  'SPR fit points': int(config['SPR_fitting_parameters']['SPR_fit_points'])}
+
+    benchmark_results = {'SPRpy_version': version,
+                         'timestamp': datetime.now().isoformat(timespec='seconds'),
+                         'machine': {'node': platform.node(),
+                                     'processor': platform.processor(),
+                                     'logical_cores': os.cpu_count(),
+                                     'platform': platform.platform(),
+                                     'python': platform.python_version(),
+                                     'numpy': np.__version__,
+                                     'scipy': scipy.__version__},
+                         'results': []}
+
+    start_time = time.perf_counter()
+    benchmark_results['results'] += benchmark_engine(arguments.repeats)
+    benchmark_results['results'].append(benchmark_fresnel_fit(config, SPR_TIR_fitting_parameters, arguments.repeats))
+    benchmark_results['results'].append(benchmark_exclusion_height(config, SPR_TIR_fitting_parameters, arguments.repeats))
+    benchmark_results['duration_s'] = time.perf_counter() - start_time
+
+    if arguments.output is None:
+        arguments.output = 'SPRpy_benchmark_{node}_{time}.json'.format(node=platform.node(), time=datetime.now().strftime('%y-%m-%d_%H-%M-%S'))
+    with open(arguments.output, 'w') as f:
+        json.dump(benchmark_results, f, indent=2)
+    print('\nResults written to ' + arguments.output)
+
+    if arguments.compare is not None:
+        with open(arguments.compare, 'r') as f:
+            compare_results(benchmark_results, json.load(f))
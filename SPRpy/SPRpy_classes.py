@@ -9,7 +9,7 @@ import bottleneck
 import multiprocessing
 import numpy as np
 from SPRpy_functions import *
-from fresnel_transfer_matrix import fresnel_calculation
+from fresnel_transfer_matrix import fresnel_calculation, fresnel_calculation_batch, cached_fresnel_calculation, FresnelLeastSquares, apply_fitted_var, LayerStack, ReflectivitySurrogate
 
 
 class Session:
@@ -404,7 +404,7 @@ class FresnelModel:
 
         # Selecting a range of measurement data to use for fitting, and including an offset in reflectivity (iterated 3 times)
         selection_xdata_ = xdata_[(xdata_ >= self.angle_range[0]) & (xdata_ <= self.angle_range[1])]
-        selection_ydata_ = ydata_[(xdata_ >= self.angle_range[0]) & (xdata_ <= self.angle_range[1])]
+        selection_ydata_ = ydata_[(xdata_ >= self.angle_range[0]) & (xdata_ <= self.angle_range[1])].astype(np.float64)
 
         # Weighing options
         weights = None
@@ -417,21 +417,29 @@ class FresnelModel:
         # weights = np.ones(len(selection_ydata_))
         # weights[selection_ydata_.argmin():-1] = 2
 
+        # The layers below the fitted layer are fixed during the fit unless the prism extinction value is fitted
+        if len(np.atleast_1d(self.ini_guess)) < 3:
+            layer_stack = LayerStack.from_sensor(self.sensor_object, selection_xdata_, polarization=self.polarization)
+        else:
+            layer_stack = None
+
         # Perform the first fitting
-        result = scipy.optimize.least_squares(fresnel_calculation,
+        fresnel_fit = FresnelLeastSquares(fitted_layer_index=self.sensor_object.fitted_layer_index,
+                                          wavelength=self.sensor_object.wavelength,
+                                          layer_thicknesses=self.sensor_object.layer_thicknesses,
+                                          n_re=self.sensor_object.refractive_indices,
+                                          n_im=self.sensor_object.extinction_coefficients,
+                                          angles=selection_xdata_,
+                                          ydata=selection_ydata_,
+                                          weights=weights,
+                                          ydata_type=self.sensor_object.data_type,
+                                          polarization=self.polarization,
+                                          ydata_offset=self.y_offset,
+                                          layer_stack=layer_stack)
+        result = scipy.optimize.least_squares(fresnel_fit.fun,
                                               self.ini_guess,
+                                              jac=fresnel_fit.jac,
                                               bounds=self.bounds,
-                                              kwargs={'fitted_layer_index': self.sensor_object.fitted_layer_index,
-                                                      'wavelength': self.sensor_object.wavelength,
-                                                      'layer_thicknesses': self.sensor_object.layer_thicknesses,
-                                                      'n_re': self.sensor_object.refractive_indices,
-                                                      'n_im': self.sensor_object.extinction_coefficients,
-                                                      'angles': selection_xdata_,
-                                                      'ydata': selection_ydata_,
-                                                      'weights': weights,
-                                                      'ydata_type': self.sensor_object.data_type,
-                                                      'polarization': self.polarization,
-                                                      'ydata_offset': self.y_offset},
                                               loss='huber',
                                               ftol=1e-12,
                                               xtol=1e-12,
@@ -440,6 +448,16 @@ class FresnelModel:
         # Collect the results from least_squares object and calculate corresponding fresnel coefficients
         self.fitted_result = np.array(result['x'])
 
+        # Write the fitted layer variable (and prism extinction value) back to the sensor layers
+        fitted_layer_thicknesses, fitted_refractive_indices, fitted_extinction_coefficients, _ = apply_fitted_var(self.fitted_result,
+                                                                                                                  self.sensor_object.fitted_layer_index,
+                                                                                                                  self.sensor_object.layer_thicknesses,
+                                                                                                                  self.sensor_object.refractive_indices,
+                                                                                                                  self.sensor_object.extinction_coefficients)
+        self.sensor_object.layer_thicknesses[:] = fitted_layer_thicknesses
+        self.sensor_object.refractive_indices[:] = fitted_refractive_indices
+        self.sensor_object.extinction_coefficients[:] = fitted_extinction_coefficients
+
         if self.fit_offset:
             self.y_offset = self.fitted_result[1]
         else:
@@ -605,13 +623,55 @@ class ExclusionHeight:
         return
 
 
-def calculate_exclusion_height(exclusion_height_analysis_object_copy, buffer_or_probe_flag, data_frame_index):
+def exclusion_height_surrogate(exclusion_height_analysis_object, buffer_or_probe_flag, data_frame_index, surrogate_folder):
+    """
+    Loads or calculates the precomputed reflectivity table (ReflectivitySurrogate) of the surface layer over all height
+    steps and refractive indices within the bounds for a single injection step
+
+    :param exclusion_height_analysis_object: object containing all parameters and data
+    :param buffer_or_probe_flag: either 'buffer' or 'probe'
+    :param data_frame_index: index of dataframe and buffer or probe RI bulk value
+    :param surrogate_folder: string, folder the table is loaded from or saved to
+    :return: ReflectivitySurrogate, or None if the prism extinction value is fitted
+    """
+
+    if exclusion_height_analysis_object.fit_prism:
+        return None
+
+    if buffer_or_probe_flag == 'buffer':
+        reflectivity_df = exclusion_height_analysis_object.buffer_reflectivity_dfs[data_frame_index]
+        bulk_RI = exclusion_height_analysis_object.buffer_bulk_RIs[data_frame_index]
+    elif buffer_or_probe_flag == 'probe':
+        reflectivity_df = exclusion_height_analysis_object.probe_reflectivity_dfs[data_frame_index]
+        bulk_RI = exclusion_height_analysis_object.probe_bulk_RIs[data_frame_index]
+    else:
+        raise ValueError('Only buffer or probe allowed')
+
+    refractive_indices = exclusion_height_analysis_object.sensor_object.refractive_indices.copy()
+    refractive_indices[-1] = bulk_RI
+
+    return ReflectivitySurrogate.load_or_calculate(surrogate_folder,
+                                                   reflectivity_df['angles'].to_numpy(),
+                                                   exclusion_height_analysis_object.sensor_object.wavelength,
+                                                   exclusion_height_analysis_object.sensor_object.layer_thicknesses,
+                                                   refractive_indices,
+                                                   exclusion_height_analysis_object.sensor_object.extinction_coefficients,
+                                                   exclusion_height_analysis_object.height_steps,
+                                                   np.linspace(exclusion_height_analysis_object.RI_bounds[0], exclusion_height_analysis_object.RI_bounds[1], 41),
+                                                   varied_layer_index=-2,
+                                                   ydata_type=exclusion_height_analysis_object.sensor_object.data_type,
+                                                   polarization=exclusion_height_analysis_object.polarization)
+
+
+def calculate_exclusion_height(exclusion_height_analysis_object_copy, buffer_or_probe_flag, data_frame_index, surrogate=None):
     """
     This function calculates the exclusion height for a single injection step
 
     :param exclusion_height_analysis_object_copy: object containing all parameters and data
     :param buffer_or_probe_flag: either 'buffer' or 'probe'
     :param data_frame_index: index of dataframe and buffer or probe RI bulk value
+    :param surrogate: ReflectivitySurrogate (default None), if provided the initial guess of each height step is taken
+                      from this precomputed reflectivity table (see exclusion_height_surrogate())
     :return RI_results: list of calculated RI results for each height step
     """
 
@@ -624,13 +684,13 @@ def calculate_exclusion_height(exclusion_height_analysis_object_copy, buffer_or_
         exclusion_new_fresnel_bounds = exclusion_height_analysis_object_copy.RI_bounds
 
     elif exclusion_height_analysis_object_copy.fit_offset and not exclusion_height_analysis_object_copy.fit_prism:
-        exclusion_new_fresnel_ini_guess = exclusion_height_analysis_object_copy.fresnel_object.ini_guess[0:2]
+        exclusion_new_fresnel_ini_guess = np.array(exclusion_height_analysis_object_copy.fresnel_object.ini_guess[0:2], dtype=np.float64)
         exclusion_new_fresnel_ini_guess[0] = exclusion_height_analysis_object_copy.RI_initial_guess  # Swollen layer estimated hydration
         exclusion_new_fresnel_bounds = [(exclusion_height_analysis_object_copy.RI_bounds[0], -np.inf), (exclusion_height_analysis_object_copy.RI_bounds[1], np.inf)]
 
     elif exclusion_height_analysis_object_copy.fit_offset and exclusion_height_analysis_object_copy.fit_prism:
         if len(exclusion_height_analysis_object_copy.fresnel_object.ini_guess) == 3:
-            exclusion_new_fresnel_ini_guess = exclusion_height_analysis_object_copy.fresnel_object.ini_guess
+            exclusion_new_fresnel_ini_guess = np.array(exclusion_height_analysis_object_copy.fresnel_object.ini_guess, dtype=np.float64)
         elif len(exclusion_height_analysis_object_copy.fresnel_object.ini_guess) == 2:
             exclusion_new_fresnel_ini_guess = [exclusion_height_analysis_object_copy.fresnel_object.ini_guess, 0.01]
         exclusion_new_fresnel_ini_guess[0] = exclusion_height_analysis_object_copy.RI_initial_guess # Swollen layer estimated hydration
@@ -639,29 +699,51 @@ def calculate_exclusion_height(exclusion_height_analysis_object_copy, buffer_or_
     # Check if calculations should be performed on buffer or probe data
     if buffer_or_probe_flag == 'buffer':
 
-        # Add bulk RI to layers
-        refractive_indices = exclusion_height_analysis_object_copy.sensor_object.refractive_indices
+        # Add bulk RI to layers (local copies, the sensor object itself is not modified)
+        refractive_indices = exclusion_height_analysis_object_copy.sensor_object.refractive_indices.copy()
         refractive_indices[-1] = exclusion_height_analysis_object_copy.buffer_bulk_RIs[data_frame_index]
+        layer_thicknesses = exclusion_height_analysis_object_copy.sensor_object.layer_thicknesses.copy()
+
+        # Only the surface layer and bulk change between the height steps, unless the prism extinction value is fitted
+        if not exclusion_height_analysis_object_copy.fit_prism:
+            layer_stack = LayerStack(exclusion_height_analysis_object_copy.buffer_reflectivity_dfs[data_frame_index]['angles'].to_numpy(),
+                                     exclusion_height_analysis_object_copy.sensor_object.wavelength,
+                                     layer_thicknesses,
+                                     refractive_indices,
+                                     exclusion_height_analysis_object_copy.sensor_object.extinction_coefficients,
+                                     varied_layer_index=-2,
+                                     polarization=exclusion_height_analysis_object_copy.polarization)
+        else:
+            layer_stack = None
+
 
         for height in exclusion_height_analysis_object_copy.height_steps:
 
-            exclusion_height_analysis_object_copy.sensor_object.layer_thicknesses[-2] = height  # Surface layer height should be updated to current height step
+            layer_thicknesses[-2] = height  # Surface layer height should be updated to current height step
+
+            # Start from the refractive index estimated from the surrogate table
+            if surrogate is not None:
+                exclusion_new_fresnel_ini_guess = np.array(np.atleast_1d(exclusion_new_fresnel_ini_guess), dtype=np.float64)
+                exclusion_new_fresnel_ini_guess[0] = surrogate.estimate_n(exclusion_height_analysis_object_copy.buffer_reflectivity_dfs[data_frame_index]['reflectivity'].to_numpy(dtype=np.float64),
+                                                                          height,
+                                                                          ydata_offset=exclusion_height_analysis_object_copy.fresnel_object.y_offset)
 
             # Perform the fitting
-            result = scipy.optimize.least_squares(fresnel_calculation,
+            fresnel_fit = FresnelLeastSquares(fitted_layer_index=(-2, 2),  # Should always be the RI of the surface layer
+                                              wavelength=exclusion_height_analysis_object_copy.sensor_object.wavelength,
+                                              layer_thicknesses=layer_thicknesses,
+                                              n_re=refractive_indices,
+                                              n_im=exclusion_height_analysis_object_copy.sensor_object.extinction_coefficients,
+                                              angles=exclusion_height_analysis_object_copy.buffer_reflectivity_dfs[data_frame_index]['angles'].to_numpy(),
+                                              ydata=exclusion_height_analysis_object_copy.buffer_reflectivity_dfs[data_frame_index]['reflectivity'].to_numpy(dtype=np.float64),
+                                              ydata_type=exclusion_height_analysis_object_copy.sensor_object.data_type,
+                                              ydata_offset=exclusion_height_analysis_object_copy.fresnel_object.y_offset,
+                                              polarization=exclusion_height_analysis_object_copy.polarization,
+                                              layer_stack=layer_stack)
+            result = scipy.optimize.least_squares(fresnel_fit.fun,
                                                   exclusion_new_fresnel_ini_guess,
-                                                  bounds=exclusion_new_fresnel_bounds,
-                                                  kwargs={'fitted_layer_index': (-2, 2),  # Should always be the RI of the surface layer
-                                                          'wavelength': exclusion_height_analysis_object_copy.sensor_object.wavelength,
-                                                          'layer_thicknesses': exclusion_height_analysis_object_copy.sensor_object.layer_thicknesses,
-                                                          'n_re': refractive_indices,
-                                                          'n_im': exclusion_height_analysis_object_copy.sensor_object.extinction_coefficients,
-                                                          'angles': exclusion_height_analysis_object_copy.buffer_reflectivity_dfs[data_frame_index]['angles'].to_numpy(),
-                                                          'ydata': exclusion_height_analysis_object_copy.buffer_reflectivity_dfs[data_frame_index]['reflectivity'].to_numpy(),
-                                                          'ydata_type': exclusion_height_analysis_object_copy.sensor_object.data_type,
-                                                          'ydata_offset': exclusion_height_analysis_object_copy.fresnel_object.y_offset,
-                                                          'polarization': exclusion_height_analysis_object_copy.polarization}
-                                                  )
+                                                  jac=fresnel_fit.jac,
+                                                  bounds=exclusion_new_fresnel_bounds)
             # Collect the results from least_squares object
             RI_results.append(result['x'][0])
 
@@ -676,28 +758,50 @@ def calculate_exclusion_height(exclusion_height_analysis_object_copy, buffer_or_
 
     elif buffer_or_probe_flag == 'probe':
 
-        # Add bulk RI to layers
-        refractive_indices = exclusion_height_analysis_object_copy.sensor_object.refractive_indices
+        # Add bulk RI to layers (local copies, the sensor object itself is not modified)
+        refractive_indices = exclusion_height_analysis_object_copy.sensor_object.refractive_indices.copy()
         refractive_indices[-1] = exclusion_height_analysis_object_copy.probe_bulk_RIs[data_frame_index]
+        layer_thicknesses = exclusion_height_analysis_object_copy.sensor_object.layer_thicknesses.copy()
+
+        # Only the surface layer and bulk change between the height steps, unless the prism extinction value is fitted
+        if not exclusion_height_analysis_object_copy.fit_prism:
+            layer_stack = LayerStack(exclusion_height_analysis_object_copy.probe_reflectivity_dfs[data_frame_index]['angles'].to_numpy(),
+                                     exclusion_height_analysis_object_copy.sensor_object.wavelength,
+                                     layer_thicknesses,
+                                     refractive_indices,
+                                     exclusion_height_analysis_object_copy.sensor_object.extinction_coefficients,
+                                     varied_layer_index=-2,
+                                     polarization=exclusion_height_analysis_object_copy.polarization)
+        else:
+            layer_stack = None
 
-        for height in exclusion_height_analysis_object_copy.height_steps:
 
-            exclusion_height_analysis_object_copy.sensor_object.layer_thicknesses[-2] = height
+        for height in exclusion_height_analysis_object_copy.height_steps:
 
-            result = scipy.optimize.least_squares(fresnel_calculation,
+            layer_thicknesses[-2] = height
+
+            # Start from the refractive index estimated from the surrogate table
+            if surrogate is not None:
+                exclusion_new_fresnel_ini_guess = np.array(np.atleast_1d(exclusion_new_fresnel_ini_guess), dtype=np.float64)
+                exclusion_new_fresnel_ini_guess[0] = surrogate.estimate_n(exclusion_height_analysis_object_copy.probe_reflectivity_dfs[data_frame_index]['reflectivity'].to_numpy(dtype=np.float64),
+                                                                          height,
+                                                                          ydata_offset=exclusion_height_analysis_object_copy.fresnel_object.y_offset)
+
+            fresnel_fit = FresnelLeastSquares(fitted_layer_index=(-2, 2),  # Should always be the RI of the surface layer
+                                              wavelength=exclusion_height_analysis_object_copy.sensor_object.wavelength,
+                                              layer_thicknesses=layer_thicknesses,
+                                              n_re=refractive_indices,
+                                              n_im=exclusion_height_analysis_object_copy.sensor_object.extinction_coefficients,
+                                              angles=exclusion_height_analysis_object_copy.probe_reflectivity_dfs[data_frame_index]['angles'].to_numpy(),
+                                              ydata=exclusion_height_analysis_object_copy.probe_reflectivity_dfs[data_frame_index]['reflectivity'].to_numpy(dtype=np.float64),
+                                              ydata_type=exclusion_height_analysis_object_copy.sensor_object.data_type,
+                                              ydata_offset=exclusion_height_analysis_object_copy.fresnel_object.y_offset,
+                                              polarization=exclusion_height_analysis_object_copy.polarization,
+                                              layer_stack=layer_stack)
+            result = scipy.optimize.least_squares(fresnel_fit.fun,
                                                   exclusion_new_fresnel_ini_guess,
-                                                  bounds=exclusion_new_fresnel_bounds,
-                                                  kwargs={'fitted_layer_index': (-2, 2),  # Should always be the RI of the surface layer
-                                                          'wavelength': exclusion_height_analysis_object_copy.sensor_object.wavelength,
-                                                          'layer_thicknesses': exclusion_height_analysis_object_copy.sensor_object.layer_thicknesses,
-                                                          'n_re': refractive_indices,
-                                                          'n_im': exclusion_height_analysis_object_copy.sensor_object.extinction_coefficients,
-                                                          'angles': exclusion_height_analysis_object_copy.probe_reflectivity_dfs[data_frame_index]['angles'].to_numpy(),
-                                                          'ydata': exclusion_height_analysis_object_copy.probe_reflectivity_dfs[data_frame_index]['reflectivity'].to_numpy(),
-                                                          'ydata_type': exclusion_height_analysis_object_copy.sensor_object.data_type,
-                                                          'ydata_offset': exclusion_height_analysis_object_copy.fresnel_object.y_offset,
-                                                          'polarization': exclusion_height_analysis_object_copy.polarization}
-                                                  )
+                                                  jac=fresnel_fit.jac,
+                                                  bounds=exclusion_new_fresnel_bounds)
             # Collect the results from least_squares object
             RI_results.append(result['x'][0])
 
@@ -714,7 +818,7 @@ def calculate_exclusion_height(exclusion_height_analysis_object_copy, buffer_or_
         raise ValueError('Only buffer or probe allowed')
 
 
-def exclusion_height_process(exclusion_height_analysis_object_copy, buffer_or_probe_flag, data_frame_index, connection):
+def exclusion_height_process(exclusion_height_analysis_object_copy, buffer_or_probe_flag, data_frame_index, connection, surrogate=None):
     """
     This function initiates the calculations and sends back the result
 
@@ -722,15 +826,25 @@ def exclusion_height_process(exclusion_height_analysis_object_copy, buffer_or_pr
     :param buffer_or_probe_flag: either 'buffer' or 'probe'
     :param data_frame_index: index of dataframe
     :param connection: child pipe connection object from multiprocessing.Pipe()
+    :param surrogate: ReflectivitySurrogate (default None), precomputed reflectivity table of the injection step
     :return: None
     """
 
-    result = calculate_exclusion_height(exclusion_height_analysis_object_copy, buffer_or_probe_flag, data_frame_index)
+    result = calculate_exclusion_height(exclusion_height_analysis_object_copy, buffer_or_probe_flag, data_frame_index, surrogate=surrogate)
     connection.send(result)
     connection.close()
 
 
-def process_all_exclusion_heights(exclusion_height_analysis_object, logical_cores):
+def process_all_exclusion_heights(exclusion_height_analysis_object, logical_cores, surrogate_folder=None):
+
+    # Surrogate tables are loaded or calculated here once, before the processes are started, so that processes do not
+    # calculate and write the same table file at the same time
+    if surrogate_folder is not None:
+        buffer_surrogates = [exclusion_height_surrogate(exclusion_height_analysis_object, 'buffer', buffer_index, surrogate_folder) for buffer_index in range(len(exclusion_height_analysis_object.buffer_reflectivity_dfs))]
+        probe_surrogates = [exclusion_height_surrogate(exclusion_height_analysis_object, 'probe', probe_index, surrogate_folder) for probe_index in range(len(exclusion_height_analysis_object.probe_reflectivity_dfs))]
+    else:
+        buffer_surrogates = [None] * len(exclusion_height_analysis_object.buffer_reflectivity_dfs)
+        probe_surrogates = [None] * len(exclusion_height_analysis_object.probe_reflectivity_dfs)
 
     buffer_connections = []
     probe_connections = []
@@ -747,7 +861,7 @@ def process_all_exclusion_heights(exclusion_height_analysis_object, logical_core
         # Setup buffer process
         buffer_parent_conn, buffer_child_conn = multiprocessing.Pipe()
         buffer_connections.append(buffer_parent_conn)
-        buffer_process = multiprocessing.Process(target=exclusion_height_process, args=(copy.deepcopy(exclusion_height_analysis_object), 'buffer', buffer_index, buffer_child_conn))
+        buffer_process = multiprocessing.Process(target=exclusion_height_process, args=(exclusion_height_analysis_object, 'buffer', buffer_index, buffer_child_conn, buffer_surrogates[buffer_index]))
         buffer_processes.append(buffer_process)
         buffer_process.start()
         buffer_index += 1
@@ -757,7 +871,7 @@ def process_all_exclusion_heights(exclusion_height_analysis_object, logical_core
         if buffer_index % 2 == 0:
             probe_parent_conn, probe_child_conn = multiprocessing.Pipe()
             probe_connections.append(probe_parent_conn)
-            probe_process = multiprocessing.Process(target=exclusion_height_process, args=(copy.deepcopy(exclusion_height_analysis_object), 'probe', probe_index, probe_child_conn))
+            probe_process = multiprocessing.Process(target=exclusion_height_process, args=(exclusion_height_analysis_object, 'probe', probe_index, probe_child_conn, probe_surrogates[probe_index]))
             probe_processes.append(probe_process)
             probe_process.start()
             probe_index += 1
@@ -771,7 +885,7 @@ def process_all_exclusion_heights(exclusion_height_analysis_object, logical_core
         # Setup buffer process
         buffer_parent_conn, buffer_child_conn = multiprocessing.Pipe()
         buffer_connections.append(buffer_parent_conn)
-        buffer_process = multiprocessing.Process(target=exclusion_height_process, args=(copy.deepcopy(exclusion_height_analysis_object), 'buffer', buffer_index, buffer_child_conn))
+        buffer_process = multiprocessing.Process(target=exclusion_height_process, args=(exclusion_height_analysis_object, 'buffer', buffer_index, buffer_child_conn, buffer_surrogates[buffer_index]))
         buffer_processes.append(buffer_process)
         buffer_process.start()
         buffer_index += 1
@@ -783,7 +897,7 @@ def process_all_exclusion_heights(exclusion_height_analysis_object, logical_core
             # Setup probe process
             probe_parent_conn, probe_child_conn = multiprocessing.Pipe()
             probe_connections.append(probe_parent_conn)
-            probe_process = multiprocessing.Process(target=exclusion_height_process, args=(copy.deepcopy(exclusion_height_analysis_object), 'probe', probe_index, probe_child_conn))
+            probe_process = multiprocessing.Process(target=exclusion_height_process, args=(exclusion_height_analysis_object, 'probe', probe_index, probe_child_conn, probe_surrogates[probe_index]))
             probe_processes.append(probe_process)
             probe_process.start()
             probe_index += 1
@@ -4,8 +4,43 @@ import numpy as np
 import tkinter
 from tkinter.filedialog import askopenfilename, askopenfilenames, askdirectory, asksaveasfilename
 import pandas as pd
+import os
 import re
-from fresnel_transfer_matrix import TIR_determination
+import io
+import copy
+import json
+import hashlib
+import multiprocessing
+import traceback
+from multiprocessing import shared_memory
+from fresnel_transfer_matrix import TIR_determination, TIR_determination_batch, TIR_derivative, cubic_extremum, cubic_fit_curve
+
+# Sensorgram columns holding the fit parameters and fitting window of each scan. The TIR derivative fits are cubic
+# polynomials (highest power first), while the meaning of the SPR fit parameters depends on the SPR tracker the
+# sensorgram was calculated with (stored as 'SPR tracker' in the 'SPR parameters' attribute, see SPR_TRACKERS)
+SENSORGRAM_SPR_FIT_COLUMNS = ['SPR fit p0', 'SPR fit p1', 'SPR fit p2', 'SPR fit p3', 'SPR fit low', 'SPR fit high']
+SENSORGRAM_TIR_FIT_COLUMNS = ['TIR deriv fit c3', 'TIR deriv fit c2', 'TIR deriv fit c1', 'TIR deriv fit c0', 'TIR deriv fit low', 'TIR deriv fit high']
+
+# SPR_TIR_fitting_parameters that the SPR and TIR angles of a sensorgram depend on (the fit points only affect plotting)
+SENSORGRAM_SPR_PARAMETERS = ['sensorgram_angle_range_points', 'SPR tracker', 'SPR centroid threshold']
+SENSORGRAM_TIR_PARAMETERS = ['TIR range', 'TIR window count', 'points_below_TIR_peak', 'points_above_TIR_peak']
+
+# Values of sensorgram parameters missing from sessions created before they were introduced
+SENSORGRAM_PARAMETER_DEFAULTS = {'SPR tracker': 'cubic', 'SPR centroid threshold': 0.5}
+
+# Smallest number of scans per process when calculating sensorgrams in parallel
+SENSORGRAM_SCANS_PER_PROCESS = 2000
+
+# Layout of the sensorgrams saved in the sensorgram cache of a session (increment the version if the layout changes)
+SENSORGRAM_CACHE_COLUMNS = ['time', 'SPR angle', 'TIR angle'] + SENSORGRAM_SPR_FIT_COLUMNS + SENSORGRAM_TIR_FIT_COLUMNS
+SENSORGRAM_CACHE_VERSION = 2
+
+# Layout version of the binary sidecar files saved next to measurement .csv files (see load_measurement())
+MEASUREMENT_SIDECAR_VERSION = 1
+
+# Storage precision of the measured reflectivity, selected with 'spectral_data_precision' in config.toml. Times and
+# angles are always double precision, and the fitting functions upcast the data they fit to double precision.
+SPECTRAL_DATA_DTYPES = {'double': np.float64, 'single': np.float32}
 
 
 def select_folder(prompt, prompt_folder=None):
@@ -44,91 +79,1209 @@ def save_file(prompt, prompt_folder=None, file_types=[('CSV files', '*.csv')], d
     return save_file
 
 
-def load_csv_data(path=False, default_data_folder=None, prompt='Select the measurement data file (.csv)'):
+class Measurement:
+
+    """
+    Measurement data of one converted .csv file, stored as contiguous arrays (float64 times and angles, reflectivity in
+    one of SPECTRAL_DATA_DTYPES). DataFrame views of the data are available in the same layout as returned by
+    load_csv_data() (indexed from 1).
+    """
+
+    def __init__(self, path, scanspeed, time, angles, ydata):
+
+        """
+        :param path: string, path to the .csv file
+        :param scanspeed: int
+        :param time: ndarray, shape (n_scans,), measurement times
+        :param angles: ndarray, shape (n_angles,), measured angles
+        :param ydata: ndarray, shape (n_scans, n_angles), measured reflectivity (float64 or float32)
+        """
+
+        self.path = path
+        self.scanspeed = scanspeed
+        self.time = time
+        self.angles = angles
+        self.ydata = ydata
+
+        # Wavelength and channel from the file name given by SPRpy_spr2_to_csv.py, for instance "...-L1_670nm.csv"
+        try:
+            self.wavelength = int(path[-9:-6])
+        except ValueError:
+            self.wavelength = None
+        self.channel = path[-12:-4].replace('_', ' ')
+
+    @property
+    def time_df(self):
+        return pd.Series(self.time, index=pd.RangeIndex(1, len(self.time) + 1), copy=False)
+
+    @property
+    def angles_df(self):
+        return pd.Series(self.angles, index=pd.RangeIndex(1, len(self.angles) + 1), copy=False)
+
+    @property
+    def ydata_df(self):
+        return pd.DataFrame(self.ydata, index=pd.RangeIndex(1, self.ydata.shape[0] + 1), columns=pd.RangeIndex(1, self.ydata.shape[1] + 1), copy=False)
+
+    def reflectivity_df(self, scan_index=-1):
+
+        """
+        :param scan_index: int (default -1), position of the scan
+        :return: pd.DataFrame with the angles and reflectivity of one scan
+        """
+
+        return pd.DataFrame(data={'angles': self.angles, 'ydata': self.ydata[scan_index]}, index=pd.RangeIndex(1, len(self.angles) + 1))
+
+
+def measurement_file_signature(path, hashed_bytes=65536):
+
+    """
+    Identifies the content of a measurement file from its size, modification time and a hash of its first and last
+    bytes, without reading the whole file. This assumes that a file is not edited in the middle while keeping both its
+    size and modification time (see sensorgram_cache_size in config.toml).
+
+    :param path: string
+    :param hashed_bytes: int (default 65536), number of bytes hashed at each end of the file
+    :return: dict
+    """
+
+    file_stat = os.stat(path)
+    key_hash = hashlib.sha1()
+    with open(path, 'rb') as file:
+        key_hash.update(file.read(hashed_bytes))
+        if file_stat.st_size > hashed_bytes:
+            file.seek(max(file_stat.st_size - hashed_bytes, hashed_bytes))
+            key_hash.update(file.read())
+
+    return {'size': file_stat.st_size, 'mtime': file_stat.st_mtime_ns, 'hash': key_hash.hexdigest()}
+
+
+def load_measurement_sidecar(path, dtype=None):
+
+    """
+    Loads the binary sidecar of a measurement .csv file (see save_measurement_sidecar()) if it matches the file. The
+    reflectivity is memory-mapped, so only the scans that are used are read from disk and several SPRpy instances share
+    the operating system page cache.
+
+    :param path: string, path to the .csv file
+    :param dtype: numpy dtype (default None, the dtype of the sidecar), reflectivity dtype. A double precision sidecar
+                  is converted when single precision is requested, a single precision sidecar is not used when double
+                  precision is requested.
+    :return: Measurement, or None if there is no matching sidecar
+    """
+
+    if not (os.path.exists(path + '.json') and os.path.exists(path + '.npy')):
+        return None
+
+    try:
+        with open(path + '.json', 'r') as description_file:
+            description = json.load(description_file)
+
+        # Sidecars of an earlier version of the .csv file are stale
+        if description['version'] != MEASUREMENT_SIDECAR_VERSION or description['file'] != measurement_file_signature(path):
+            return None
+
+        ydata = np.load(path + '.npy', mmap_mode='r')
+        time = np.array(description['time'], dtype=np.float64)
+        angles = np.array(description['angles'], dtype=np.float64)
+        if ydata.shape != (len(time), len(angles)):
+            return None
+        if dtype is not None and ydata.dtype != dtype:
+            if np.finfo(ydata.dtype).precision < np.finfo(dtype).precision:
+                return None
+            ydata = ydata.astype(dtype)
+
+    except (OSError, ValueError, KeyError):
+        print('Warning! Could not read the binary copy of the measurement data, reading the .csv file instead.')
+        return None
+
+    return Measurement(path, description['scanspeed'], time, angles, ydata)
+
+
+def save_measurement_sidecar(measurement, file_signature):
+
+    """
+    Saves the reflectivity of a measurement as a .npy file (in the dtype of measurement.ydata) next to its .csv file,
+    together with a .json file holding the times, angles, scanspeed and the signature of the .csv file it was read
+    from.
+
+    :param measurement: Measurement
+    :param file_signature: dict, measurement_file_signature() of the .csv file before it was read
+    :return: None
+    """
+
+    # Save under temporary names first, so that a partially written sidecar is never read
+    temporary_path = measurement.path + '.{pid}.tmp'.format(pid=os.getpid())
+    try:
+        with open(temporary_path + '.npy', 'wb') as data_file:
+            np.save(data_file, measurement.ydata)
+        with open(temporary_path + '.json', 'w') as description_file:
+            json.dump({'version': MEASUREMENT_SIDECAR_VERSION, 'file': file_signature, 'scanspeed': measurement.scanspeed,
+                       'time': measurement.time.tolist(), 'angles': measurement.angles.tolist()}, description_file)
+        os.replace(temporary_path + '.npy', measurement.path + '.npy')
+        os.replace(temporary_path + '.json', measurement.path + '.json')
+    except OSError:
+        # For instance a read-only data folder, or a sidecar still memory-mapped by another SPRpy instance
+        for leftover_path in (temporary_path + '.npy', temporary_path + '.json'):
+            if os.path.exists(leftover_path):
+                os.remove(leftover_path)
+
+
+def load_measurement(path, use_sidecar=True, dtype=np.float64):
+
+    """
+    Loads a converted measurement .csv file in a single pass over the file. The first time a complete file is loaded, a
+    binary sidecar (.csv.npy and .csv.json) is saved next to it. The sidecar is memory-mapped from then on (also by
+    later loads instead of parsing the text again), so scans are only read from disk when they are used.
+
+    :param path: string, path to the .csv file
+    :param use_sidecar: bool (default True), load from and save to the binary sidecar
+    :param dtype: numpy dtype (default np.float64), storage dtype of the reflectivity, see SPECTRAL_DATA_DTYPES
+    :return: Measurement
+    """
+
+    if use_sidecar:
+        measurement = load_measurement_sidecar(path, dtype=dtype)
+        if measurement is not None:
+            return measurement
+        file_signature = measurement_file_signature(path)
+
+    with open(path, 'rb') as file:
+
+        #  Determine the scanning speed/step length if present in the file
+        try:
+            step_length_pattern = re.compile(r'=\d{1,2}')
+            scanspeed = int(step_length_pattern.search(file.readline().decode(errors='replace')).group().strip('='))
+        except AttributeError:  # .search() returns None
+            scanspeed = 5  # Assuming medium scanspeed if legacy spr2 to csv converter was used
+
+        # The angles are in the first row and the times in the first column
+        data_start = file.tell()
+        complete_rows = True
+        try:
+            data = np.loadtxt(file, delimiter=';', comments=None, dtype=np.float64, ndmin=2)
+        except ValueError:
+            # Rows of different length (for instance a scan that is still being written) are padded with NaN
+            file.seek(data_start)
+            data = pd.read_csv(file, delimiter=';', header=None, float_precision='round_trip').to_numpy(dtype=np.float64)
+            complete_rows = False
+
+    measurement = Measurement(path, scanspeed, np.ascontiguousarray(data[1:, 0]), np.ascontiguousarray(data[0, 1:]), np.ascontiguousarray(data[1:, 1:], dtype=dtype))
+
+    # Files still being written are not saved, their sidecar would be outdated right away
+    if use_sidecar and complete_rows:
+        save_measurement_sidecar(measurement, file_signature)
+        measurement = load_measurement_sidecar(path, dtype=dtype) or measurement
+
+    return measurement
+
+
+def load_csv_data(path=False, default_data_folder=None, prompt='Select the measurement data file (.csv)', dtype=np.float64):
+    if not path:
+        print(prompt)
+        data_path_ = select_file('Select the measurement data file (.csv)', prompt_folder=default_data_folder, file_types=[('CSV files', '*.csv')])
+    else:
+        data_path_ = path
+
+    # Load in the measurement data from a .csv file
+    measurement = load_measurement(data_path_, dtype=dtype)
+
+    # Select last scan as default reflectivity plot
+    return data_path_, measurement.scanspeed, measurement.time_df, measurement.angles_df, measurement.ydata_df, measurement.reflectivity_df()
+
+
+def load_csv_scan(path=False, default_data_folder=None, prompt='Select the measurement data file (.csv)', scan_index=-1):
+
+    """
+    Loads a single scan of a measurement file, for instance to compare it with the current measurement. See
+    read_csv_scan().
+
+    :param scan_index: int (default -1, the last scan), position of the scan
+    :return: data_path_, reflectivity_df_ (same layout as from load_csv_data())
+    """
+
     if not path:
         print(prompt)
         data_path_ = select_file('Select the measurement data file (.csv)', prompt_folder=default_data_folder, file_types=[('CSV files', '*.csv')])
     else:
         data_path_ = path
 
-    #  Determine the scanning speed/step length if present in the file
+    _, angles, ydata = read_csv_scan(data_path_, scan_index=scan_index)
+    reflectivity_df_ = pd.DataFrame(data={'angles': angles, 'ydata': ydata}, index=pd.RangeIndex(1, len(angles) + 1))
+
+    return data_path_, reflectivity_df_
+
+
+def read_csv_scan(path, scan_index=-1, block_size=65536):
+
+    """
+    Reads the angles and a single scan of a measurement .csv file without parsing the whole file. The scan is taken
+    from the binary sidecar if there is a matching one (see load_measurement()). Otherwise negative scan indices are
+    found by reading the file backwards from its end, and a partially written last line is skipped.
+
+    :param path: string, path to the .csv file
+    :param scan_index: int (default -1, the last scan), position of the scan
+    :param block_size: int (default 65536), bytes read at a time when searching backwards
+    :return: time (float), angles (n_angles,), ydata (n_angles,)
+    """
+
+    measurement = load_measurement_sidecar(path)
+    if measurement is not None:
+        return measurement.time[scan_index], measurement.angles, np.array(measurement.ydata[scan_index], dtype=np.float64)
+
+    with open(path, 'rb') as file:
+
+        # Skip the header line, the angles are in the first row
+        file.readline()
+        angles = np.array(file.readline().split(b';')[1:], dtype=np.float64)
+        data_start = file.tell()
+
+        if scan_index >= 0:
+            for _ in range(scan_index):
+                file.readline()
+            line = file.readline()
+            if not line.endswith(b'\n'):
+                raise IndexError('Scan {} is not in {}'.format(scan_index, path))
+
+        else:
+            file.seek(0, os.SEEK_END)
+            position = file.tell()
+            blocks = []
+            newline_count = 0
+
+            # Read blocks backwards until the scan is known to be complete. The last newline ends the last complete
+            # line, so -scan_index + 1 newlines are needed (or the start of the data).
+            while newline_count < -scan_index + 1 and position > data_start:
+                read_size = min(block_size, position - data_start)
+                position -= read_size
+                file.seek(position)
+                blocks.append(file.read(read_size))
+                newline_count += blocks[-1].count(b'\n')
+
+            # Lines after the last newline are still being written, the first line may continue before the first block
+            lines = b''.join(reversed(blocks)).split(b'\n')[:-1]
+            if position > data_start:
+                lines = lines[1:]
+            if len(lines) < -scan_index:
+                raise IndexError('Scan {} is not in {}'.format(scan_index, path))
+            line = lines[scan_index]
+
+    row = np.array(line.split(b';'), dtype=np.float64)
+
+    return row[0], angles, row[1:]
+
+
+def read_csv_tail(path, scan_count, byte_offset=None, dtype=np.float64):
+
+    """
+    Reads the scans appended to a measurement .csv file (see load_csv_data()) that is still being written. Only complete
+    lines are parsed, a partially written last line is read at the next call.
+
+    :param path: string, path to the .csv file
+    :param scan_count: int, number of scans already read. Only used to locate the new scans if byte_offset is None.
+    :param byte_offset: int (default None), file position returned by the previous call
+    :param dtype: numpy dtype (default np.float64), dtype of the returned reflectivity
+    :return: time (n_new_scans,), ydata (n_new_scans, n_angles), byte_offset after the last complete line
+    """
+
+    with open(path, 'rb') as file:
+        if byte_offset is None:
+            # Skip the header line, the angles and the scans already read
+            byte_offset = 0
+            for _ in range(scan_count + 2):
+                line = file.readline()
+                if not line.endswith(b'\n'):
+                    return np.empty(0), np.empty((0, 0)), None
+                byte_offset += len(line)
+        file.seek(byte_offset)
+        new_data = file.read()
+
+    complete_length = new_data.rfind(b'\n') + 1
+    if complete_length == 0:
+        return np.empty(0), np.empty((0, 0)), byte_offset
+
+    data = pd.read_csv(io.BytesIO(new_data[:complete_length]), delimiter=';', header=None, float_precision='round_trip').to_numpy(dtype=np.float64)
+
+    return data[:, 0], np.ascontiguousarray(data[:, 1:], dtype=dtype), byte_offset + complete_length
+
+
+class FrameBuffer:
+
+    """
+    A pd.DataFrame or pd.Series (with a single dtype and consecutive integer index) that rows are appended to, for
+    instance the measurement data and sensorgram of a measurement that is still running. The rows are kept in a
+    preallocated array that grows by half its size when full, and frame is a view of the filled rows. Appending therefore
+    only costs time in proportion to the appended rows (amortized), instead of copying all rows like pd.concat().
+    """
+
+    def __init__(self, frame, spare_rows=1024):
+
+        """
+        :param frame: pd.DataFrame or pd.Series, initial rows (copied into the buffer)
+        :param spare_rows: int (default 1024), minimum number of rows allocated beyond the initial rows
+        """
+
+        self.is_series = isinstance(frame, pd.Series)
+        self.columns = frame.name if self.is_series else frame.columns
+        self.attrs = dict(frame.attrs)
+        self.first_index = int(frame.index[0]) if len(frame) > 0 else 0
+        self.length = len(frame)
+
+        values = frame.to_numpy().reshape(self.length, -1)
+        self.data = np.empty((self.length + max(self.length // 2, spare_rows), values.shape[1]), dtype=values.dtype)
+        self.data[:self.length] = values
+        self.frame = self._view()
+
+    def _view(self):
+        index = pd.RangeIndex(self.first_index, self.first_index + self.length)
+        if self.is_series:
+            frame = pd.Series(self.data[:self.length, 0], index=index, name=self.columns, copy=False)
+        else:
+            frame = pd.DataFrame(self.data[:self.length], index=index, columns=self.columns, copy=False)
+        frame.attrs = dict(self.attrs)
+        return frame
+
+    def append(self, rows):
+
+        """
+        :param rows: ndarray, shape (n_new_rows, n_columns), or (n_new_rows,) for a Series
+        :return: frame, view of all rows
+        """
+
+        rows = np.asarray(rows).reshape(len(rows), -1)
+        if self.length + len(rows) > len(self.data):
+            # Views returned earlier keep referring to the previous array
+            grown_data = np.empty((max(self.length + len(rows), len(self.data) * 3 // 2), self.data.shape[1]), dtype=self.data.dtype)
+            grown_data[:self.length] = self.data[:self.length]
+            self.data = grown_data
+        self.data[self.length:self.length + len(rows)] = rows
+        self.length += len(rows)
+        self.frame = self._view()
+
+        return self.frame
+
+    def truncate(self, length):
+
+        """
+        Removes the rows after the first length rows. The buffer is copied, so that rows appended later do not change
+        earlier views.
+
+        :param length: int
+        :return: frame, view of the remaining rows
+        """
+
+        self.data = self.data.copy()
+        self.length = min(length, self.length)
+        self.frame = self._view()
+
+        return self.frame
+
+
+def batched_polyfit(x_windows, y_windows, degree, weights=None):
+
+    """
+    Least squares polynomial fits of many windows in a single batched solve. The Vandermonde columns are scaled like in
+    np.polyfit() before solving.
+
+    :param x_windows: ndarray, shape (n_windows, n_points)
+    :param y_windows: ndarray, shape (n_windows, n_points)
+    :param degree: int, degree of the polynomials
+    :param weights: ndarray (default None), shape (n_windows, n_points), weights of the residuals. Points with zero
+                    weight are ignored.
+    :return: poly_c, ndarray, shape (n_windows, degree + 1), highest power first
+    """
+
+    vandermonde = np.vander(x_windows.ravel(), degree + 1).reshape(x_windows.shape + (degree + 1,))
+    if weights is not None:
+        vandermonde = vandermonde * weights[..., np.newaxis]
+        y_windows = y_windows * weights
+    column_scale = np.sqrt(np.sum(vandermonde ** 2, axis=1))
+    column_scale[column_scale == 0] = 1
+
+    return np.matmul(np.linalg.pinv(vandermonde / column_scale[:, np.newaxis, :]), y_windows[..., np.newaxis])[..., 0] / column_scale
+
+
+def SPR_fitting_windows(angles, ydata, points_below, points_above):
+
+    """
+    Gathers the points around the reflectivity minimum of every scan into one array.
+
+    :param angles: ndarray, shape (n_angles,)
+    :param ydata: ndarray, shape (n_scans, n_angles), any float dtype
+    :param points_below: int, points below the minimum
+    :param points_above: int, points above the minimum (exclusive)
+    :return: valid_scans (n_scans,) bool, x_windows and y_windows (n_valid_scans, points_below + points_above) as float64,
+             fit_range (n_valid_scans, 2) with the angles points_below below and points_above above each minimum
+    """
+
+    angle_count = ydata.shape[1]
+
+    # The fitting window around the minimum must lie within the scan and contain finite values only
+    min_indices = np.argmin(ydata, axis=1)
+    window_indices = min_indices[:, np.newaxis] + np.arange(-points_below, points_above)
+    valid_scans = (min_indices - points_below >= 0) & (min_indices + points_above < angle_count)
+    window_indices = np.clip(window_indices, 0, angle_count - 1)
+    x_windows = angles[window_indices]
+    y_windows = np.take_along_axis(ydata, window_indices, axis=1).astype(np.float64)  # Only the fitted points are upcast
+    valid_scans &= np.all(np.isfinite(x_windows), axis=1) & np.all(np.isfinite(y_windows), axis=1)
+    min_indices = min_indices[valid_scans]
+    fit_range = np.stack((angles[min_indices - points_below], angles[min_indices + points_above]), axis=1)
+
+    return valid_scans, x_windows[valid_scans], y_windows[valid_scans], fit_range
+
+
+def SPR_determination_batch(angles, ydata, SPR_TIR_fitting_parameters):
+
+    """
+    Tracks the SPR minimum of a whole block of scans at once. The points around the minimum of each scan are gathered
+    into one array and a cubic polynomial is fitted to every scan in a single batched least squares solve. Instead of
+    dense fit curves, the fit coefficients and fitting windows are returned (see cubic_fit_curve()).
+
+    :param angles: ndarray, shape (n_angles,), angles shared by all scans
+    :param ydata: ndarray, shape (n_scans, n_angles)
+    :param SPR_TIR_fitting_parameters: dict
+    :return: SPR_angles (n_scans,), poly_c (n_scans, 4), fit_range (n_scans, 2). Scans where no SPR minimum could be
+             fitted are NaN.
+    """
+
+    angles = np.asarray(angles, dtype=np.float64)
+    ydata = np.atleast_2d(np.asarray(ydata))
+    scan_count = ydata.shape[0]
+    points_below, points_above = SPR_TIR_fitting_parameters['sensorgram_angle_range_points']
+
+    SPR_angles = np.full(scan_count, np.nan)
+    SPR_poly_c = np.full((scan_count, 4), np.nan)
+    SPR_fit_range = np.full((scan_count, 2), np.nan)
+
+    valid_scans, x_windows, y_windows, fit_range = SPR_fitting_windows(angles, ydata, points_below, points_above)
+    if not np.any(valid_scans):
+        return SPR_angles, SPR_poly_c, SPR_fit_range
+
+    # Cubic fits of all scans in one batched least squares solve
+    SPR_poly_c[valid_scans] = batched_polyfit(x_windows, y_windows, 3)
+    SPR_fit_range[valid_scans] = fit_range
+
+    # Find the SPR angle from the minimum of each fit
+    SPR_angles[valid_scans] = cubic_extremum(SPR_poly_c[valid_scans], SPR_fit_range[valid_scans, 0], SPR_fit_range[valid_scans, 1], extremum='min')
+
+    return SPR_angles, SPR_poly_c, SPR_fit_range
+
+
+def SPR_parabolic_batch(angles, ydata, SPR_TIR_fitting_parameters):
+
+    """
+    Tracks the SPR minimum of a block of scans as the vertex of the parabola through the lowest point of each scan and
+    its two neighbours. Fastest of the trackers, but sensitive to noise.
+
+    :param angles: ndarray, shape (n_angles,), angles shared by all scans
+    :param ydata: ndarray, shape (n_scans, n_angles)
+    :param SPR_TIR_fitting_parameters: dict
+    :return: SPR_angles (n_scans,), poly_c (n_scans, 4) with c3 = 0, fit_range (n_scans, 2). Scans where no SPR minimum
+             could be found are NaN.
+    """
+
+    angles = np.asarray(angles, dtype=np.float64)
+    ydata = np.atleast_2d(np.asarray(ydata))
+    scan_count = ydata.shape[0]
+
+    SPR_angles = np.full(scan_count, np.nan)
+    SPR_poly_c = np.full((scan_count, 4), np.nan)
+    SPR_fit_range = np.full((scan_count, 2), np.nan)
+
+    valid_scans, x_windows, y_windows, _ = SPR_fitting_windows(angles, ydata, 1, 2)
+    if not np.any(valid_scans):
+        return SPR_angles, SPR_poly_c, SPR_fit_range
+    fit_range = x_windows[:, [0, 2]]
+
+    # The parabola through three points is solved directly (divided differences)
+    x0, x1, x2 = x_windows.T
+    y0, y1, y2 = y_windows.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a = ((y2 - y1) / (x2 - x1) - (y1 - y0) / (x1 - x0)) / (x2 - x0)
+        b = (y1 - y0) / (x1 - x0) - a * (x0 + x1)
+        c = y0 - a * x0 ** 2 - b * x0
+        vertex = -b / (2 * a)
+    found = (a > 0) & (vertex >= x0) & (vertex <= x2)
+
+    valid_indices = np.flatnonzero(valid_scans)[found]
+    SPR_angles[valid_indices] = vertex[found]
+    SPR_poly_c[valid_indices] = np.stack((np.zeros_like(a), a, b, c), axis=1)[found]
+    SPR_fit_range[valid_indices] = fit_range[found]
+
+    return SPR_angles, SPR_poly_c, SPR_fit_range
+
+
+def validate_centroid_threshold(threshold):
+
+    """
+    Checks the 'SPR centroid threshold' of the centroid SPR tracker.
+
+    :param threshold: float, fraction of the dip depth, between 0 and 1 (exclusive)
+    :return: threshold as a float
+    """
+
     try:
-        with open(data_path_, 'r') as file:
-            step_length_pattern = re.compile(r'=\d{1,2}')
-            scanspeed = int(step_length_pattern.search(file.readline()).group().strip('='))
+        threshold = float(threshold)
+    except (TypeError, ValueError):
+        raise ValueError('SPR centroid threshold must be a number between 0 and 1, got {!r}.'.format(threshold)) from None
 
-    except AttributeError:  # I think .group().strip() should return AttributeError if .search() returns None
-        scanspeed = 5  # Assuming medium scanspeed if legacy spr2 to csv converter was used
+    if not 0 < threshold < 1:
+        raise ValueError('SPR centroid threshold must be between 0 and 1 (exclusive), got {}.'.format(threshold))
 
+    return threshold
 
-    # Load in the measurement data from a .csv file
-    data_frame_ = pd.read_csv(data_path_, delimiter=';', skiprows=1, header=None)
-    time_df = data_frame_.iloc[1:, 0]
-    angles_df = data_frame_.iloc[0, 1:]
-    ydata_df = data_frame_.iloc[1:, 1:]
 
-    # Select last scan as default reflectivity plot
-    reflectivity_df_ = pd.DataFrame(data={'angles': angles_df, 'ydata': ydata_df.iloc[-1, :]})
+def SPR_centroid_batch(angles, ydata, SPR_TIR_fitting_parameters):
+
+    """
+    Tracks the SPR minimum of a block of scans as the centroid of the part of the dip below a threshold level. The level
+    lies at 'SPR centroid threshold' (fraction of the dip depth) above the minimum of the fitting window. Robust against
+    noise and asymmetric dips, but the centroid is offset from the true minimum for asymmetric dips.
+
+    :param angles: ndarray, shape (n_angles,), angles shared by all scans
+    :param ydata: ndarray, shape (n_scans, n_angles)
+    :param SPR_TIR_fitting_parameters: dict
+    :return: SPR_angles (n_scans,), poly_c (n_scans, 4) describing the threshold level, fit_range (n_scans, 2). Scans
+             where no SPR minimum could be found are NaN.
+    """
+
+    angles = np.asarray(angles, dtype=np.float64)
+    ydata = np.atleast_2d(np.asarray(ydata))
+    scan_count = ydata.shape[0]
+    points_below, points_above = SPR_TIR_fitting_parameters['sensorgram_angle_range_points']
+    threshold = validate_centroid_threshold(SPR_TIR_fitting_parameters.get('SPR centroid threshold', SENSORGRAM_PARAMETER_DEFAULTS['SPR centroid threshold']))
+
+    SPR_angles = np.full(scan_count, np.nan)
+    SPR_poly_c = np.full((scan_count, 4), np.nan)
+    SPR_fit_range = np.full((scan_count, 2), np.nan)
+
+    valid_scans, x_windows, y_windows, fit_range = SPR_fitting_windows(angles, ydata, points_below, points_above)
+    if not np.any(valid_scans):
+        return SPR_angles, SPR_poly_c, SPR_fit_range
+
+    # Each point below the threshold level is weighted by its depth below the level
+    y_min = np.min(y_windows, axis=1)
+    level = y_min + threshold * (np.max(y_windows, axis=1) - y_min)
+    depth = np.clip(level[:, np.newaxis] - y_windows, 0, None)
+    depth_sum = np.sum(depth, axis=1)
+    found = depth_sum > 0
+
+    valid_indices = np.flatnonzero(valid_scans)[found]
+    SPR_angles[valid_indices] = np.sum(depth * x_windows, axis=1)[found] / depth_sum[found]
+    SPR_poly_c[valid_indices] = 0
+    SPR_poly_c[valid_indices, 3] = level[found]
+    SPR_fit_range[valid_indices] = fit_range[found]
+
+    return SPR_angles, SPR_poly_c, SPR_fit_range
+
+
+def SPR_linearized_dip_batch(angles, ydata, SPR_TIR_fitting_parameters, line_shape):
+
+    """
+    Tracks the SPR minimum of a block of scans by fitting a Gaussian or Lorentzian dip below the maximum of the fitting
+    window. The dip is linearized so that all scans are fitted with one batched weighted quadratic least squares solve:
+    ln(depth) is quadratic for a Gaussian and 1/depth is quadratic for a Lorentzian.
+
+    :param angles: ndarray, shape (n_angles,), angles shared by all scans
+    :param ydata: ndarray, shape (n_scans, n_angles)
+    :param SPR_TIR_fitting_parameters: dict
+    :param line_shape: string, 'gaussian' or 'lorentzian'
+    :return: SPR_angles (n_scans,), poly_c (n_scans, 4) as [baseline, quadratic coefficients], fit_range (n_scans, 2).
+             Scans where no SPR minimum could be fitted are NaN.
+    """
+
+    angles = np.asarray(angles, dtype=np.float64)
+    ydata = np.atleast_2d(np.asarray(ydata))
+    scan_count = ydata.shape[0]
+    points_below, points_above = SPR_TIR_fitting_parameters['sensorgram_angle_range_points']
+
+    SPR_angles = np.full(scan_count, np.nan)
+    SPR_poly_c = np.full((scan_count, 4), np.nan)
+    SPR_fit_range = np.full((scan_count, 2), np.nan)
+
+    valid_scans, x_windows, y_windows, fit_range = SPR_fitting_windows(angles, ydata, points_below, points_above)
+    if not np.any(valid_scans):
+        return SPR_angles, SPR_poly_c, SPR_fit_range
+
+    # Depth of the dip below the highest point of each window. The weights compensate for the linearization so that
+    # all points count as in a fit of the reflectivity itself (points without depth are ignored).
+    baseline = np.max(y_windows, axis=1)
+    depth = baseline[:, np.newaxis] - y_windows
+    has_depth = depth > 0
+    safe_depth = np.where(has_depth, depth, 1)
+    match line_shape:
+        case 'gaussian':
+            poly_c = batched_polyfit(x_windows, np.log(safe_depth), 2, weights=np.where(has_depth, depth, 0))
+            found = poly_c[:, 0] < 0
+        case 'lorentzian':
+            poly_c = batched_polyfit(x_windows, 1 / safe_depth, 2, weights=np.where(has_depth, depth ** 2, 0))
+            found = poly_c[:, 0] > 0
+        case _:
+            raise ValueError('Unknown SPR dip line shape: {}'.format(line_shape))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vertex = -poly_c[:, 1] / (2 * poly_c[:, 0])
+    found &= (vertex >= fit_range[:, 0]) & (vertex <= fit_range[:, 1])
+
+    valid_indices = np.flatnonzero(valid_scans)[found]
+    SPR_angles[valid_indices] = vertex[found]
+    SPR_poly_c[valid_indices] = np.concatenate((baseline[:, np.newaxis], poly_c), axis=1)[found]
+    SPR_fit_range[valid_indices] = fit_range[found]
+
+    return SPR_angles, SPR_poly_c, SPR_fit_range
+
+
+def SPR_gaussian_batch(angles, ydata, SPR_TIR_fitting_parameters):
+
+    """
+    Tracks the SPR minimum of a block of scans with a linearized Gaussian dip fit, see SPR_linearized_dip_batch().
+    """
+
+    return SPR_linearized_dip_batch(angles, ydata, SPR_TIR_fitting_parameters, 'gaussian')
+
+
+def SPR_lorentzian_batch(angles, ydata, SPR_TIR_fitting_parameters):
+
+    """
+    Tracks the SPR minimum of a block of scans with a linearized Lorentzian dip fit, see SPR_linearized_dip_batch().
+    """
+
+    return SPR_linearized_dip_batch(angles, ydata, SPR_TIR_fitting_parameters, 'lorentzian')
+
+
+def gaussian_dip_curve(poly_c, x_low, x_high, fit_points):
+
+    """
+    Dense curve of a Gaussian dip from SPR_gaussian_batch() for plotting.
+
+    :param poly_c: ndarray, shape (4,), [baseline, quadratic coefficients of ln(depth)]
+    :param x_low: float, start of the fitting window
+    :param x_high: float, end of the fitting window
+    :param fit_points: int, number of points of the curve
+    :return: fit_x, fit_y
+    """
+
+    fit_x = np.linspace(x_low, x_high, fit_points)
+
+    return fit_x, poly_c[0] - np.exp(np.polyval(poly_c[1:], fit_x))
+
+
+def lorentzian_dip_curve(poly_c, x_low, x_high, fit_points):
+
+    """
+    Dense curve of a Lorentzian dip from SPR_lorentzian_batch() for plotting.
+
+    :param poly_c: ndarray, shape (4,), [baseline, quadratic coefficients of 1/depth]
+    :param x_low: float, start of the fitting window
+    :param x_high: float, end of the fitting window
+    :param fit_points: int, number of points of the curve
+    :return: fit_x, fit_y
+    """
+
+    fit_x = np.linspace(x_low, x_high, fit_points)
+
+    return fit_x, poly_c[0] - 1 / np.polyval(poly_c[1:], fit_x)
+
+
+# Available SPR trackers, selected per session with 'SPR tracker'. Each tracker takes (angles, ydata,
+# SPR_TIR_fitting_parameters) and returns (SPR_angles, poly_c, fit_range) for a block of scans, and its curve function
+# recreates the fit curve of one scan from poly_c and fit_range. The four poly_c values are stored in the 'SPR fit p0-p3'
+# sensorgram columns and mean:
+#   cubic, parabolic: polynomial coefficients, highest power first (the cubic coefficient of a parabola is 0)
+#   centroid: 0, 0, 0 and the threshold level
+#   gaussian, lorentzian: the baseline of the dip and the quadratic coefficients of ln(depth) or 1/depth
+SPR_TRACKERS = {
+    'cubic': (SPR_determination_batch, cubic_fit_curve),
+    'parabolic': (SPR_parabolic_batch, cubic_fit_curve),
+    'centroid': (SPR_centroid_batch, cubic_fit_curve),
+    'gaussian': (SPR_gaussian_batch, gaussian_dip_curve),
+    'lorentzian': (SPR_lorentzian_batch, lorentzian_dip_curve),
+}
+
+
+def sensorgram_angles(angles, ydata, SPR_TIR_fitting_parameters, calculate_SPR=True, calculate_TIR=True):
+
+    """
+    SPR and TIR angles and fits of a block of scans.
+
+    :param angles: ndarray, shape (n_angles,)
+    :param ydata: ndarray, shape (n_scans, n_angles)
+    :param SPR_TIR_fitting_parameters: dict
+    :param calculate_SPR: bool, if False the SPR results are None
+    :param calculate_TIR: bool, if False the TIR results are None
+    :return: SPR_angles (n_scans,), SPR_fit (n_scans, 6), TIR_angles (n_scans,), TIR_fit (n_scans, 6), with the fit
+             columns ordered as SENSORGRAM_SPR_FIT_COLUMNS and SENSORGRAM_TIR_FIT_COLUMNS
+    """
+
+    SPR_angles, SPR_fit, TIR_angles, TIR_fit = None, None, None, None
+
+    if calculate_SPR:
+        SPR_tracker = SPR_TIR_fitting_parameters.get('SPR tracker', SENSORGRAM_PARAMETER_DEFAULTS['SPR tracker'])
+        SPR_angles, SPR_poly_c, SPR_fit_range = SPR_TRACKERS[SPR_tracker][0](angles, ydata, SPR_TIR_fitting_parameters)
+        SPR_fit = np.concatenate((SPR_poly_c, SPR_fit_range), axis=1)
+
+    if calculate_TIR:
+        TIR_angles, TIR_poly_c, TIR_fit_range = TIR_determination_batch(angles, ydata, SPR_TIR_fitting_parameters)
+        TIR_fit = np.concatenate((TIR_poly_c, TIR_fit_range), axis=1)
+
+    return SPR_angles, SPR_fit, TIR_angles, TIR_fit
+
+
+def sensorgram_process(shared_memory_name, ydata_shape, ydata_dtype, scan_range, angles, SPR_TIR_fitting_parameters, calculate_SPR, calculate_TIR, connection):
+
+    """
+    Calculates the SPR and TIR angles of a chunk of scans in a separate process and sends back ('result', result), or
+    ('error', formatted traceback) if the calculation fails. The reflectivity data is read directly from shared memory.
+
+    :param shared_memory_name: string, name of the shared memory block holding all reflectivity data
+    :param ydata_shape: tuple, (n_scans, n_angles) of all reflectivity data
+    :param ydata_dtype: numpy dtype of the reflectivity data
+    :param scan_range: tuple, (first scan, last scan + 1) of the chunk
+    :param angles: ndarray
+    :param SPR_TIR_fitting_parameters: dict
+    :param calculate_SPR: bool
+    :param calculate_TIR: bool
+    :param connection: child pipe connection object from multiprocessing.Pipe()
+    :return: None
+    """
+
+    try:
+        ydata_memory = shared_memory.SharedMemory(name=shared_memory_name)
+        try:
+            ydata = np.ndarray(ydata_shape, dtype=ydata_dtype, buffer=ydata_memory.buf)
+            result = sensorgram_angles(angles, ydata[scan_range[0]:scan_range[1]], SPR_TIR_fitting_parameters, calculate_SPR=calculate_SPR, calculate_TIR=calculate_TIR)
+            del ydata
+        finally:
+            ydata_memory.close()
+        connection.send(('result', result))
+    except Exception:
+        connection.send(('error', traceback.format_exc()))
+    finally:
+        connection.close()
+
+
+def parallel_sensorgram_angles(angles, ydata, SPR_TIR_fitting_parameters, logical_cores, calculate_SPR=True, calculate_TIR=True):
+
+    """
+    sensorgram_angles() split over chunks of scans calculated in parallel processes. The reflectivity data is shared with
+    the processes through shared memory instead of being copied to each of them.
+
+    :param angles: ndarray, shape (n_angles,)
+    :param ydata: ndarray, shape (n_scans, n_angles)
+    :param SPR_TIR_fitting_parameters: dict
+    :param logical_cores: int, maximum number of simultaneous processes
+    :param calculate_SPR: bool
+    :param calculate_TIR: bool
+    :return: same as sensorgram_angles()
+    """
+
+    process_count = min(logical_cores, len(ydata) // SENSORGRAM_SCANS_PER_PROCESS)
+    if process_count < 2 or not (calculate_SPR or calculate_TIR):
+        return sensorgram_angles(angles, ydata, SPR_TIR_fitting_parameters, calculate_SPR=calculate_SPR, calculate_TIR=calculate_TIR)
+
+    ydata_memory = shared_memory.SharedMemory(create=True, size=ydata.nbytes)
+    processes = []
+    connections = []
+    try:
+        np.ndarray(ydata.shape, dtype=ydata.dtype, buffer=ydata_memory.buf)[:] = ydata
+
+        # Start one process per chunk
+        chunk_edges = np.linspace(0, len(ydata), process_count + 1).astype(int)
+        for chunk_index in range(process_count):
+            parent_connection, child_connection = multiprocessing.Pipe()
+            connections.append(parent_connection)
+            process = multiprocessing.Process(target=sensorgram_process, args=(ydata_memory.name, ydata.shape, ydata.dtype, (chunk_edges[chunk_index], chunk_edges[chunk_index + 1]), angles, SPR_TIR_fitting_parameters, calculate_SPR, calculate_TIR, child_connection))
+            processes.append(process)
+            process.start()
+
+            # Only the child process may hold the sending end, so that recv() fails instead of blocking if it dies
+            child_connection.close()
+
+        # Collect the results in order
+        chunk_results = []
+        for process, connection in zip(processes, connections):
+            try:
+                status, result = connection.recv()
+            except EOFError:
+                process.join()
+                raise RuntimeError('Sensorgram process exited without a result (exit code {}).'.format(process.exitcode))
+            if status == 'error':
+                raise RuntimeError('Sensorgram calculation failed in a separate process:\n' + result)
+            chunk_results.append(result)
+        for process in processes:
+            process.join()
+
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for connection in connections:
+            connection.close()
+        ydata_memory.close()
+        ydata_memory.unlink()
+
+    return tuple(np.concatenate(result) if result[0] is not None else None for result in zip(*chunk_results))
+
 
-    return data_path_, scanspeed, time_df, angles_df, ydata_df, reflectivity_df_
+def sensorgram_parameters(SPR_TIR_fitting_parameters):
 
+    """
+    The fitting parameters that the SPR and TIR angles of a sensorgram depend on.
 
-def calculate_sensorgram(time, angles, ydata, SPR_TIR_fitting_parameters):
+    :param SPR_TIR_fitting_parameters: dict
+    :return: SPR_parameters, TIR_parameters (dicts)
+    """
+
+    SPR_parameters = {parameter: copy.deepcopy(SPR_TIR_fitting_parameters.get(parameter, SENSORGRAM_PARAMETER_DEFAULTS.get(parameter))) for parameter in SENSORGRAM_SPR_PARAMETERS}
+    TIR_parameters = {parameter: copy.deepcopy(SPR_TIR_fitting_parameters.get(parameter, SENSORGRAM_PARAMETER_DEFAULTS.get(parameter))) for parameter in SENSORGRAM_TIR_PARAMETERS}
+
+    return SPR_parameters, TIR_parameters
+
+
+def sensorgram_spectra(angles, ydata, SPR_TIR_fitting_parameters, angle_margin=None, sampled_scans=200):
+
+    """
+    The part of the measured spectra that the sensorgram is calculated from. With an angle margin, only the angles from
+    the TIR range to the fitting windows around the SPR minima (located in a sample of the scans) are kept, widened by
+    the margin on both sides. The cropped spectra are a contiguous copy, so tracking cost and memory use scale with the
+    angle window rather than the full angular scan, and memory-mapped full spectra are read from disk only once.
+
+    :param angles: pd.Series, measured angles (indexed from 1)
+    :param ydata: pd.DataFrame, measured reflectivity (indexed from 1)
+    :param SPR_TIR_fitting_parameters: dict
+    :param angle_margin: float (default None, no cropping), degrees kept on each side of the angle window
+    :param sampled_scans: int (default 200), number of evenly spread scans used to locate the SPR minima
+    :return: angles, ydata (the cropped copies keep the index and column labels of the full spectra)
+    """
+
+    if angle_margin is None:
+        return angles, ydata
+
+    angle_array = angles.to_numpy(dtype=np.float64)
+    ydata_array = ydata.to_numpy()
+
+    # Scans that are still being written (padded with NaN) are not used to locate the SPR minima
+    sampled_ydata = ydata_array[np.unique(np.linspace(0, len(ydata_array) - 1, min(sampled_scans, len(ydata_array))).astype(int))]
+    sampled_ydata = sampled_ydata[np.all(np.isfinite(sampled_ydata), axis=1)]
+    if len(sampled_ydata) == 0:
+        return angles, ydata
+
+    # Angle window from the TIR range to the fitting windows of the lowest and highest SPR minimum
+    min_indices = np.argmin(sampled_ydata, axis=1)
+    points_below, points_above = SPR_TIR_fitting_parameters['sensorgram_angle_range_points']
+    window_low = min(angle_array[max(min_indices.min() - points_below, 0)], SPR_TIR_fitting_parameters['TIR range'][0]) - angle_margin
+    window_high = max(angle_array[min(min_indices.max() + points_above, len(angle_array) - 1)], SPR_TIR_fitting_parameters['TIR range'][1]) + angle_margin
+    kept_columns = np.flatnonzero((angle_array >= window_low) & (angle_array <= window_high))
+    window = slice(kept_columns[0], kept_columns[-1] + 1)
+
+    return angles.iloc[window].copy(), pd.DataFrame(np.ascontiguousarray(ydata_array[:, window]), index=ydata.index, columns=ydata.columns[window])
+
+
+def calculate_sensorgram(time, angles, ydata, SPR_TIR_fitting_parameters, previous_sensorgram_df=None, logical_cores=1, scan_step=1):
+
+    """
+    Calculates the SPR and TIR angles of every scan.
+
+    :param time: pd.Series, measurement times
+    :param angles: pd.Series, measured angles
+    :param ydata: pd.DataFrame, measured reflectivity, shape (n_scans, n_angles). Single precision data is kept in single
+                  precision, only the points that are fitted are upcast.
+    :param SPR_TIR_fitting_parameters: dict
+    :param previous_sensorgram_df: pd.DataFrame (default None), earlier sensorgram of the same measurement. Only the SPR
+                                   or TIR angles whose fitting parameters have changed since then are recalculated.
+    :param logical_cores: int (default 1), maximum number of processes. Long measurements (at least
+                          2*SENSORGRAM_SCANS_PER_PROCESS scans) are split over several processes.
+    :param scan_step: int (default 1), only every scan_step:th scan is calculated and the other scans are NaN. The
+                      remaining scans are filled in by refine_sensorgram().
+    :return: sensorgram_df, pd.DataFrame
+    """
 
     # Convert dataframes to numpy ndarrays
     time = time.to_numpy()
-    angles = angles.to_numpy()
+    angles = angles.to_numpy(dtype=np.float64)
     ydata = ydata.to_numpy()
 
-    # Calculating SPR and TIR angles
-    sensorgram_SPR_angles = np.empty(len(ydata))*np.nan
-    sensorgram_SPR_fit_y = [pd.Series(np.empty(SPR_TIR_fitting_parameters['SPR fit points'])*np.nan)]*len(ydata)
-    sensorgram_SPR_fit_x = [pd.Series(np.empty(SPR_TIR_fitting_parameters['SPR fit points'])*np.nan)]*len(ydata)
+    # Parameters used for each column, stored with the sensorgram
+    SPR_parameters, TIR_parameters = sensorgram_parameters(SPR_TIR_fitting_parameters)
 
-    sensorgram_TIR_angles = np.empty(len(ydata))*np.nan
-    TIR_deriv_points = len(angles[(angles >= SPR_TIR_fitting_parameters['TIR range'][0]) & (angles <= SPR_TIR_fitting_parameters['TIR range'][1])])
-    sensorgram_TIR_deriv_x = [pd.Series(np.empty(TIR_deriv_points)*np.nan)]*len(ydata)
-    sensorgram_TIR_deriv_y = [pd.Series(np.empty(TIR_deriv_points)*np.nan)]*len(ydata)
-    sensorgram_TIR_deriv_fit_x = [pd.Series(np.empty(SPR_TIR_fitting_parameters['TIR fit points']) * np.nan)] * len(ydata)
-    sensorgram_TIR_deriv_fit_y = [pd.Series(np.empty(SPR_TIR_fitting_parameters['TIR fit points']) * np.nan)] * len(ydata)
+    # Columns of an earlier sensorgram of the same data can be reused if their parameters are unchanged
+    reuse_SPR = False
+    reuse_TIR = False
+    if previous_sensorgram_df is not None and previous_sensorgram_df.attrs.get('scan step', 1) == scan_step and len(previous_sensorgram_df) == len(time) and np.array_equal(previous_sensorgram_df['time'].to_numpy(), time):
+        reuse_SPR = previous_sensorgram_df.attrs.get('SPR parameters') == SPR_parameters
+        reuse_TIR = previous_sensorgram_df.attrs.get('TIR parameters') == TIR_parameters
 
-    for ind, val in enumerate(time):
-        reflectivity_spectrum = ydata[ind-1, :]
-        min_index = np.argmin(reflectivity_spectrum)
+    # SPR and TIR angles of all scans at once
+    if scan_step == 1:
+        sensorgram_SPR_angles, SPR_fit, sensorgram_TIR_angles, TIR_fit = parallel_sensorgram_angles(angles, ydata, SPR_TIR_fitting_parameters, logical_cores, calculate_SPR=not reuse_SPR, calculate_TIR=not reuse_TIR)
+    else:
+        sensorgram_SPR_angles = np.full(len(time), np.nan)
+        SPR_fit = np.full((len(time), len(SENSORGRAM_SPR_FIT_COLUMNS)), np.nan)
+        sensorgram_TIR_angles = np.full(len(time), np.nan)
+        TIR_fit = np.full((len(time), len(SENSORGRAM_TIR_FIT_COLUMNS)), np.nan)
+        step_SPR_angles, step_SPR_fit, step_TIR_angles, step_TIR_fit = parallel_sensorgram_angles(angles, ydata[::scan_step], SPR_TIR_fitting_parameters, logical_cores, calculate_SPR=not reuse_SPR, calculate_TIR=not reuse_TIR)
+        if not reuse_SPR:
+            sensorgram_SPR_angles[::scan_step] = step_SPR_angles
+            SPR_fit[::scan_step] = step_SPR_fit
+        if not reuse_TIR:
+            sensorgram_TIR_angles[::scan_step] = step_TIR_angles
+            TIR_fit[::scan_step] = step_TIR_fit
 
-        # SPR angles
-        try:
-            y_selection = reflectivity_spectrum[min_index - SPR_TIR_fitting_parameters['sensorgram_angle_range_points'][0]:min_index + SPR_TIR_fitting_parameters['sensorgram_angle_range_points'][1]]
+    if reuse_SPR:
+        sensorgram_SPR_angles = previous_sensorgram_df['SPR angle'].to_numpy()
+        SPR_fit = previous_sensorgram_df[SENSORGRAM_SPR_FIT_COLUMNS].to_numpy()
+    else:
+        for ind in np.flatnonzero(np.isnan(sensorgram_SPR_angles[::scan_step])) * scan_step:
+            print('No SPR minimum found. Skipping measurement time point {}...'.format(time[ind]))
+
+    if reuse_TIR:
+        sensorgram_TIR_angles = previous_sensorgram_df['TIR angle'].to_numpy()
+        TIR_fit = previous_sensorgram_df[SENSORGRAM_TIR_FIT_COLUMNS].to_numpy()
+    else:
+        for ind in np.flatnonzero(np.isnan(sensorgram_TIR_angles[::scan_step])) * scan_step:
+            print('No TIR found. Skipping measurement time point {}...'.format(time[ind]))
+
+    # Only the fit coefficients are stored, the fit curves are recreated when plotted (see sensorgram_fit_curves())
+    sensorgram_df = pd.DataFrame(data={'time': time, 'SPR angle': sensorgram_SPR_angles, 'TIR angle': sensorgram_TIR_angles})
+    sensorgram_df[SENSORGRAM_SPR_FIT_COLUMNS] = SPR_fit
+    sensorgram_df[SENSORGRAM_TIR_FIT_COLUMNS] = TIR_fit
+    sensorgram_df.attrs['SPR parameters'] = SPR_parameters
+    sensorgram_df.attrs['TIR parameters'] = TIR_parameters
+    sensorgram_df.attrs['scan step'] = scan_step
+
+    return sensorgram_df
+
+
+def refine_sensorgram(sensorgram_df, angles, ydata, SPR_TIR_fitting_parameters, logical_cores=1):
+
+    """
+    Halves the scan step of a sensorgram calculated with calculate_sensorgram(scan_step=...) by calculating only the
+    scans in between the ones already calculated. Repeated calls give the full sensorgram (scan step 1).
+
+    :param sensorgram_df: pd.DataFrame from calculate_sensorgram() or refine_sensorgram()
+    :param angles: pd.Series, measured angles
+    :param ydata: pd.DataFrame, measured reflectivity, shape (n_scans, n_angles)
+    :param SPR_TIR_fitting_parameters: dict
+    :param logical_cores: int (default 1), see calculate_sensorgram()
+    :return: sensorgram_df, pd.DataFrame
+    """
+
+    scan_step = sensorgram_df.attrs.get('scan step', 1)
+    if scan_step == 1:
+        return sensorgram_df
+
+    new_scan_step = scan_step // 2
+    scans = np.arange(0, len(sensorgram_df), new_scan_step)
+    scans = scans[scans % scan_step != 0]
+    SPR_angles, SPR_fit, TIR_angles, TIR_fit = parallel_sensorgram_angles(angles.to_numpy(dtype=np.float64), ydata.to_numpy()[scans], SPR_TIR_fitting_parameters, logical_cores)
+
+    time = sensorgram_df['time'].to_numpy()
+    for ind in scans[np.isnan(SPR_angles)]:
+        print('No SPR minimum found. Skipping measurement time point {}...'.format(time[ind]))
+    for ind in scans[np.isnan(TIR_angles)]:
+        print('No TIR found. Skipping measurement time point {}...'.format(time[ind]))
+
+    refined_sensorgram_df = sensorgram_df.copy()
+    refined_sensorgram_df.iloc[scans, refined_sensorgram_df.columns.get_indexer(['SPR angle', 'TIR angle'] + SENSORGRAM_SPR_FIT_COLUMNS + SENSORGRAM_TIR_FIT_COLUMNS)] = np.column_stack((SPR_angles, TIR_angles, SPR_fit, TIR_fit))
+    refined_sensorgram_df.attrs = dict(sensorgram_df.attrs, **{'scan step': new_scan_step})
+
+    return refined_sensorgram_df
+
+
+def sensorgram_cache_key(file_signature, time, angles, ydata, SPR_TIR_fitting_parameters):
+
+    """
+    Hash identifying a sensorgram in the sensorgram cache, from the signature of the measurement file, the shape and
+    dtype of the measurement data and the fitting parameters the sensorgram depends on. The reflectivity itself is not
+    hashed, apart from its last scan (which differs while a scan is still being written). The times and angles are
+    hashed, which keeps measurements that are followed while running and spectra cropped to other angle windows apart.
+
+    :param file_signature: dict, measurement_file_signature() of the measurement file
+    :param time: ndarray, measurement times
+    :param angles: ndarray, measured angles
+    :param ydata: ndarray, measured reflectivity
+    :param SPR_TIR_fitting_parameters: dict
+    :return: string
+    """
+
+    key_hash = hashlib.sha1()
+    key_hash.update(json.dumps([SENSORGRAM_CACHE_VERSION, file_signature, ydata.shape, ydata.dtype.str, sensorgram_parameters(SPR_TIR_fitting_parameters)], sort_keys=True, default=str).encode())
+    for key_array in (time, angles, ydata[-1:]):
+        key_hash.update(np.ascontiguousarray(key_array).tobytes())
 
-            polynomial = np.polyfit(angles[min_index - SPR_TIR_fitting_parameters['sensorgram_angle_range_points'][0]:min_index + SPR_TIR_fitting_parameters['sensorgram_angle_range_points'][1]],
-                                    y_selection, 3)
-            x_selection = np.linspace(angles[min_index - SPR_TIR_fitting_parameters['sensorgram_angle_range_points'][0]],
-                                      angles[min_index + SPR_TIR_fitting_parameters['sensorgram_angle_range_points'][1]], SPR_TIR_fitting_parameters['SPR fit points'])
-            y_polyfit = np.polyval(polynomial, x_selection)
-            y_fit_min_ind = np.argmin(y_polyfit)
+    return key_hash.hexdigest()
 
-            sensorgram_SPR_angles[ind-1] = x_selection[y_fit_min_ind]
-            sensorgram_SPR_fit_x[ind-1] = pd.Series(x_selection)
-            sensorgram_SPR_fit_y[ind-1] = pd.Series(y_polyfit)
 
-        except:
-            print('No SPR minimum found. Skipping measurement time point {}...'.format(val))
+def load_cached_sensorgram(cache_folder, key, time, SPR_TIR_fitting_parameters):
 
+    """
+    Loads a sensorgram from the sensorgram cache of a session. Cached sensorgrams are memory-mapped .npy files with a
+    .json file describing them.
 
-        # TIR angles
+    :param cache_folder: string
+    :param key: string, see sensorgram_cache_key()
+    :param time: ndarray, measurement times
+    :param SPR_TIR_fitting_parameters: dict
+    :return: sensorgram_df, pd.DataFrame, or None if there is no usable entry
+    """
+
+    data_path = cache_folder + '/Sensorgram {key}.npy'.format(key=key)
+    description_path = cache_folder + '/Sensorgram {key}.json'.format(key=key)
+    if not (os.path.exists(data_path) and os.path.exists(description_path)):
+        return None
+
+    try:
+        with open(description_path, 'r') as description_file:
+            description = json.load(description_file)
+        sensorgram_data = np.load(data_path, mmap_mode='r')
+
+        # Stale entries (other layout, SPR tracker or data than expected) are replaced. The SPR fit columns are only
+        # meaningful together with the tracker they were calculated with.
+        SPR_parameters, TIR_parameters = sensorgram_parameters(SPR_TIR_fitting_parameters)
+        if description['columns'] != SENSORGRAM_CACHE_COLUMNS or description['SPR parameters'].get('SPR tracker') != SPR_parameters['SPR tracker'] or sensorgram_data.shape != (len(time), len(SENSORGRAM_CACHE_COLUMNS)) or not np.array_equal(sensorgram_data[:, 0], time):
+            print('Cached sensorgram does not match the measurement data, recalculating it.')
+            return None
+
+        # Copied out of the memory map so that the file is not kept open (the session folder may be renamed)
+        sensorgram_df = pd.DataFrame(sensorgram_data, columns=SENSORGRAM_CACHE_COLUMNS, copy=True)
+        sensorgram_df.attrs['SPR parameters'], sensorgram_df.attrs['TIR parameters'] = SPR_parameters, TIR_parameters
+        sensorgram_df.attrs['scan step'] = 1
+        sensorgram_df.attrs['cache key'] = key
+
+        # The modification time of the data file marks when the entry was last used
+        os.utime(data_path)
+
+    except (OSError, ValueError, KeyError):
+        print('Warning! Could not read cached sensorgram, recalculating it.')
+        return None
+
+    return sensorgram_df
+
+
+def save_cached_sensorgram(cache_folder, key, sensorgram_df, cache_size=20):
+
+    """
+    Saves a sensorgram to the sensorgram cache of a session. The least recently used entries are removed when the cache
+    holds more than cache_size sensorgrams.
+
+    :param cache_folder: string
+    :param key: string, see sensorgram_cache_key()
+    :param sensorgram_df: pd.DataFrame, complete sensorgram (scan step 1)
+    :param cache_size: int (default 20), maximum number of cached sensorgrams
+    :return: None
+    """
+
+    # Save under temporary names first, so that a partially written entry is never read
+    try:
+        os.makedirs(cache_folder, exist_ok=True)
+        temporary_path = cache_folder + '/Sensorgram {key}.{pid}.tmp'.format(key=key, pid=os.getpid())
+        with open(temporary_path + '.npy', 'wb') as data_file:
+            np.save(data_file, sensorgram_df[SENSORGRAM_CACHE_COLUMNS].to_numpy(dtype=np.float64))
+        with open(temporary_path + '.json', 'w') as description_file:
+            json.dump({'columns': SENSORGRAM_CACHE_COLUMNS, 'SPR parameters': sensorgram_df.attrs['SPR parameters'], 'TIR parameters': sensorgram_df.attrs['TIR parameters']}, description_file, default=str)
+        os.replace(temporary_path + '.json', cache_folder + '/Sensorgram {key}.json'.format(key=key))
+        os.replace(temporary_path + '.npy', cache_folder + '/Sensorgram {key}.npy'.format(key=key))
+    except OSError:
+        print('Warning! Could not save the sensorgram to the sensorgram cache.')
+        return
+
+    # Remove the least recently used entries (entries still memory-mapped by another session may not be removable)
+    cached_paths = sorted((entry.path for entry in os.scandir(cache_folder) if entry.name.startswith('Sensorgram ') and entry.name.endswith('.npy') and '.tmp' not in entry.name), key=os.path.getmtime)
+    for cached_path in cached_paths[:max(len(cached_paths) - cache_size, 0)]:
         try:
-            TIR_theta, TIR_xdata_filtered, deriv_ydata, TIR_theta_fit_x, TIR_theta_fit_y  = TIR_determination(angles, reflectivity_spectrum, SPR_TIR_fitting_parameters)
-            sensorgram_TIR_angles[ind-1] = TIR_theta
-            sensorgram_TIR_deriv_x[ind-1] = pd.Series(TIR_xdata_filtered)
-            sensorgram_TIR_deriv_y[ind-1] = pd.Series(deriv_ydata)
-            sensorgram_TIR_deriv_fit_x[ind-1] = pd.Series(TIR_theta_fit_x)
-            sensorgram_TIR_deriv_fit_y[ind-1] = pd.Series(TIR_theta_fit_y)
+            os.remove(cached_path)
+            os.remove(cached_path[:-4] + '.json')
+        except OSError:
+            pass
+
+
+def load_or_calculate_sensorgram(cache_folder, data_path, time, angles, ydata, SPR_TIR_fitting_parameters, previous_sensorgram_df=None, logical_cores=1, cache_size=20, scan_step=1):
 
-        except:
-            print('No TIR found. Skipping measurement time point {}...'.format(val))
+    """
+    Loads a sensorgram of the same measurement data and fitting parameters from the sensorgram cache of a session, or
+    calculates it with calculate_sensorgram() and adds it to the cache. Entries that cannot be read or do not match the
+    data are recalculated.
 
+    :param cache_folder: string, or None to only calculate the sensorgram
+    :param data_path: string, path to the measurement file the data was loaded from (identifies the data in the cache)
+    :param time: pd.Series, measurement times
+    :param angles: pd.Series, measured angles
+    :param ydata: pd.DataFrame, measured reflectivity, shape (n_scans, n_angles)
+    :param SPR_TIR_fitting_parameters: dict
+    :param previous_sensorgram_df: pd.DataFrame (default None), see calculate_sensorgram()
+    :param logical_cores: int (default 1), see calculate_sensorgram()
+    :param cache_size: int (default 20), maximum number of cached sensorgrams. 0 disables the cache.
+    :param scan_step: int (default 1), see calculate_sensorgram(). Sensorgrams calculated with a larger scan step are
+                      cached once they have been refined to scan step 1 (using save_cached_sensorgram() with their
+                      'cache key' attribute).
+    :return: sensorgram_df, pd.DataFrame
+    """
 
-    sensorgram_df = pd.DataFrame(data={'time': time, 'SPR angle': sensorgram_SPR_angles, 'TIR angle': sensorgram_TIR_angles, 'SPR fit x': sensorgram_SPR_fit_x, 'SPR fit y': sensorgram_SPR_fit_y, 'TIR deriv x': sensorgram_TIR_deriv_x, 'TIR deriv y': sensorgram_TIR_deriv_y, 'TIR deriv fit x': sensorgram_TIR_deriv_fit_x, 'TIR deriv fit y': sensorgram_TIR_deriv_fit_y})
+    try:
+        file_signature = measurement_file_signature(data_path) if cache_folder is not None and cache_size > 0 else None
+    except OSError:
+        file_signature = None
+
+    if file_signature is None:
+        return calculate_sensorgram(time, angles, ydata, SPR_TIR_fitting_parameters, previous_sensorgram_df=previous_sensorgram_df, logical_cores=logical_cores, scan_step=scan_step)
+
+    time_array = time.to_numpy(dtype=np.float64)
+    key = sensorgram_cache_key(file_signature, time_array, angles.to_numpy(dtype=np.float64), ydata.to_numpy(), SPR_TIR_fitting_parameters)
+    sensorgram_df = load_cached_sensorgram(cache_folder, key, time_array, SPR_TIR_fitting_parameters)
+    if sensorgram_df is not None:
+        return sensorgram_df
+
+    sensorgram_df = calculate_sensorgram(time, angles, ydata, SPR_TIR_fitting_parameters, previous_sensorgram_df=previous_sensorgram_df, logical_cores=logical_cores, scan_step=scan_step)
+    sensorgram_df.attrs['cache key'] = key
+    if scan_step == 1:
+        save_cached_sensorgram(cache_folder, key, sensorgram_df, cache_size=cache_size)
 
     return sensorgram_df
 
+
+def extend_sensorgram(sensorgram_buffer, time, angles, ydata, SPR_TIR_fitting_parameters):
+
+    """
+    Appends the SPR and TIR angles of new scans to a sensorgram, for instance when following a measurement that is still
+    running. Only the new scans are tracked.
+
+    :param sensorgram_buffer: FrameBuffer of a sensorgram from calculate_sensorgram()
+    :param time: ndarray, shape (n_new_scans,), measurement times of the new scans
+    :param angles: pd.Series or ndarray, measured angles
+    :param ydata: ndarray, shape (n_new_scans, n_angles), measured reflectivity of the new scans
+    :param SPR_TIR_fitting_parameters: dict
+    :return: sensorgram_df (view of all rows of the buffer), new_sensorgram_df (the new rows only)
+    """
+
+    new_sensorgram_df = calculate_sensorgram(pd.Series(time), pd.Series(angles), pd.DataFrame(ydata), SPR_TIR_fitting_parameters)
+    sensorgram_buffer.attrs = dict(new_sensorgram_df.attrs, **{'scan step': sensorgram_buffer.attrs.get('scan step', 1)})
+    new_sensorgram_df = new_sensorgram_df[sensorgram_buffer.columns]
+    new_sensorgram_df.index = pd.RangeIndex(sensorgram_buffer.first_index + sensorgram_buffer.length, sensorgram_buffer.first_index + sensorgram_buffer.length + len(new_sensorgram_df))
+
+    return sensorgram_buffer.append(new_sensorgram_df.to_numpy(dtype=sensorgram_buffer.data.dtype)), new_sensorgram_df
+
+
+def sensorgram_fit_curves(sensorgram_df, time_index, angles, reflectivity_spectrum, SPR_TIR_fitting_parameters):
+
+    """
+    Recreates the TIR and SPR fit curves of one scan of a sensorgram for plotting.
+
+    :param sensorgram_df: pd.DataFrame from calculate_sensorgram()
+    :param time_index: int, position of the scan in the sensorgram
+    :param angles: pd.Series or ndarray, measured angles
+    :param reflectivity_spectrum: pd.Series or ndarray, measured reflectivity of the scan
+    :param SPR_TIR_fitting_parameters: dict
+    :return: TIR_deriv_x, TIR_deriv_y, TIR_deriv_fit_x, TIR_deriv_fit_y, SPR_fit_x, SPR_fit_y
+    """
+
+    TIR_deriv_x, TIR_deriv_y = TIR_derivative(angles, reflectivity_spectrum, SPR_TIR_fitting_parameters)
+
+    TIR_fit = sensorgram_df[SENSORGRAM_TIR_FIT_COLUMNS].iloc[time_index].to_numpy(dtype=np.float64)
+    TIR_deriv_fit_x, TIR_deriv_fit_y = cubic_fit_curve(TIR_fit[:4], TIR_fit[4], TIR_fit[5], SPR_TIR_fitting_parameters['TIR fit points'])
+
+    # The SPR fit curve depends on the tracker the sensorgram was calculated with
+    SPR_tracker = sensorgram_df.attrs.get('SPR parameters', {}).get('SPR tracker', SENSORGRAM_PARAMETER_DEFAULTS['SPR tracker'])
+    SPR_fit = sensorgram_df[SENSORGRAM_SPR_FIT_COLUMNS].iloc[time_index].to_numpy(dtype=np.float64)
+    SPR_fit_x, SPR_fit_y = SPR_TRACKERS[SPR_tracker][1](SPR_fit[:4], SPR_fit[4], SPR_fit[5], SPR_TIR_fitting_parameters['SPR fit points'])
+
+    return TIR_deriv_x, TIR_deriv_y, TIR_deriv_fit_x, TIR_deriv_fit_y, SPR_fit_x, SPR_fit_y
+
@@ -1,9 +1,23 @@
 # Contains fresnel functions for the transfer-matrix method and curve fitting and TIR angle determination
 
+import os
+import hashlib
+import collections
 import numpy as np
 import pandas as pd
 import bottleneck
 
+# Number of (configuration, angle) points that fresnel_calculation_batch() calculates at a time. Larger arrays no longer
+# fit in the CPU caches, which makes every point slower than in separate calls.
+FRESNEL_BATCH_CHUNK_POINTS = 1024
+
+# Output fields of fresnel_calculation_channels()
+FRESNEL_CHANNELS_DTYPE = np.dtype([('R_s', np.float64), ('R_p', np.float64),
+                                   ('T_s', np.float64), ('T_p', np.float64),
+                                   ('A_s', np.float64), ('A_p', np.float64),
+                                   ('r_s', np.complex128), ('r_p', np.complex128),
+                                   ('t_s', np.complex128), ('t_p', np.complex128)])
+
 
 def fresnel_calculation(fitted_var=None,
                         fitted_layer_index=(2, 3),
@@ -17,11 +31,13 @@ def fresnel_calculation(fitted_var=None,
                         weights=None,
                         polarization=1.0,
                         ydata_offset=0,
+                        layer_stack=None,
                         ):
 
     """
     Function for calculating fresnel coefficients or for fitting angular reflectivity traces based on the residuals of
-    a measurement. By default, the function provides the thickness of a monolayer of BSA on gold in air.
+    a measurement. By default, the function provides the thickness of a monolayer of BSA on gold in air. The input
+    arrays are never modified, the fitted variables are only applied to copies of them (see apply_fitted_var()).
 
     :param fitted_var: variable to be fitted
     :param angles: ndarray
@@ -33,88 +49,22 @@ def fresnel_calculation(fitted_var=None,
     :param ydata: ndarray (default None), if provided the function will instead return residuals between the modelled intensity and measurement
     :param ydata_type: string, specify if reflectivity ('R'), transmission ('T') or absorption ('A') is fitted against
     :param polarization: int, 1 (default) or 0
+    :param layer_stack: LayerStack (default None), reuses the precalculated layers below the varied layer
     :return: ndarray(s), either the fresnel coefficients or the residuals between modelled intensity and measured intensity
     """
 
-    # Check first if fitting is performed or not
+    # Check first if fitting is performed or not (the fitted variables are applied to copies of the layer arrays)
     if fitted_var is not None:
-
-        # Selecting main layer to fit
-        match fitted_layer_index[1]:
-            case 0:
-                print('Invalid fitting variable!')
-                return 0
-            case 1:
-                layer_thicknesses[fitted_layer_index[0]] = fitted_var[0]
-            case 2:
-                n_re[fitted_layer_index[0]] = fitted_var[0]
-            case 3:
-                n_im[fitted_layer_index[0]] = fitted_var[0]
-
-        # Include fitting intensity offset
-        if len(fitted_var) >= 2:
-            ydata_offset = fitted_var[1]
-
-        # Include fitting prism extinction value
-        if len(fitted_var) == 3:
-            n_im[0] = fitted_var[2]
+        if fitted_layer_index[1] == 0:
+            print('Invalid fitting variable!')
+            return 0
+        layer_thicknesses, n_re, n_im, ydata_offset = apply_fitted_var(fitted_var, fitted_layer_index, layer_thicknesses, n_re, n_im, ydata_offset)
 
     # Merge real and imaginary refractive indices
     n = n_re + 1j * n_im
 
     # Calculate fresnel coefficients for every angle
-    fresnel_coefficients_reflection = np.zeros(len(angles))
-    fresnel_coefficients_transmission = np.zeros(len(angles))
-    fresnel_coefficients_absorption = np.zeros(len(angles))
-
-    for angle_ind, angle_val in enumerate(angles):
-
-        # Snell's law
-        theta = np.zeros(len(n), dtype=np.complex128)
-        theta[0] = angle_val * np.pi / 180
-        for a in range(len(n) - 1):
-            theta[a + 1] = np.real(np.arcsin(n[a] / n[a + 1] * np.sin(theta[a]))) - 1j * np.abs(np.imag(np.arcsin(n[a] / n[a + 1] * np.sin(theta[a]))))
-
-        # Calculating fresnel coefficients:
-        fresnel_reflection = np.zeros(len(n) - 1, dtype=np.complex128)
-        fresnel_transmission = np.zeros(len(n) - 1, dtype=np.complex128)
-
-        for a in range(len(n) - 1):
-            # formulas for s polarization
-            s_reflection = (n[a] * np.cos(theta[a]) - n[a + 1] * np.cos(theta[a + 1])) / (n[a] * np.cos(theta[a]) + n[a + 1] * np.cos(theta[a + 1]))
-            s_transmission = 2 * n[a] * np.cos(theta[a]) / (n[a] * np.cos(theta[a]) + n[a + 1] * np.cos(theta[a + 1]))
-
-            # formulas for p polarization
-            p_reflection = (n[a] * np.cos(theta[a + 1]) - n[a + 1] * np.cos(theta[a])) / (n[a] * np.cos(theta[a + 1]) + n[a + 1] * np.cos(theta[a]))
-            p_transmission = 2 * n[a] * np.cos(theta[a]) / (n[a] * np.cos(theta[a + 1]) + n[a + 1] * np.cos(theta[a]))
-
-            fresnel_reflection[a] = s_reflection*(polarization-1) + p_reflection*polarization
-            fresnel_transmission[a] = s_transmission*(polarization-1) + p_transmission*polarization
-
-        # Phase shift factors:
-        delta = np.zeros(len(n) - 2, dtype=np.complex128)
-        for a in range(len(n) - 2):
-            delta[a] = 2 * np.pi * layer_thicknesses[a + 1] / wavelength * n[a + 1] * np.cos(theta[a + 1])
-
-        # Build up transfer matrix:
-        transfer_matrix = np.array([[1, 0], [0, 1]], dtype=np.complex128)
-        for a in range(len(n) - 2):
-            transfer_matrix = np.dot(transfer_matrix, np.dot(1 / fresnel_transmission[a], np.dot(np.array([[1, fresnel_reflection[a]], [fresnel_reflection[a], 1]]), np.array([[np.exp(-1j * delta[a]), 0], [0, np.exp(1j * delta[a])]]))))
-        transfer_matrix = np.dot(transfer_matrix, np.dot(1 / fresnel_transmission[len(n) - 2], np.array([[1, fresnel_reflection[len(n) - 2]], [fresnel_reflection[len(n) - 2], 1]])))
-
-        # Total fresnel coefficients:
-        fr_tot = transfer_matrix[1, 0] / transfer_matrix[0, 0]
-        ft_tot = 1 / transfer_matrix[0, 0]
-
-        # Special case of single interface:
-        if len(n) == 2:
-            fr_tot = fresnel_reflection[0]
-            ft_tot = fresnel_transmission[0]
-
-        # Total fresnel coefficients in intensity:
-        fresnel_coefficients_reflection[angle_ind] = np.absolute(fr_tot)**2
-        fresnel_coefficients_transmission[angle_ind] = np.absolute(ft_tot)**2 * np.real(n[-1] * np.cos(theta[-1])) / np.real(n[0] * np.cos(theta[0]))
-        fresnel_coefficients_absorption[angle_ind] = 1 - fresnel_coefficients_reflection[angle_ind] - fresnel_coefficients_transmission[angle_ind]
+    fresnel_coefficients_reflection, fresnel_coefficients_transmission, fresnel_coefficients_absorption = _fresnel_coefficients(angles, wavelength, layer_thicknesses, n, polarization, layer_stack=layer_stack)
 
     # Return fresnel coefficients or residuals depending on if fitting is performed against ydata
     if ydata is None:
@@ -141,36 +91,1029 @@ def fresnel_calculation(fitted_var=None,
             return fresnel_residuals
 
 
-def TIR_determination(xdata, ydata, SPR_TIR_fitting_parameters):
+def fresnel_jacobian(fitted_var,
+                     fitted_layer_index=(2, 3),
+                     angles=np.linspace(39, 50, 1567),
+                     wavelength=670,
+                     layer_thicknesses=np.array([np.nan, 2, 50, 4, np.nan]),
+                     n_re=np.array([1.5202, 3.3105, 0.2238, 1.5, 1.0003]),
+                     n_im=np.array([0, 3.4556, 3.9259, 0, 0]),
+                     ydata=None,
+                     ydata_type='R',
+                     weights=None,
+                     polarization=1.0,
+                     ydata_offset=0,
+                     layer_stack=None,
+                     ):
+
+    """
+    Analytic Jacobian of fresnel_calculation() with respect to the fitted variables (the main fitted layer parameter,
+    the intensity offset and the prism extinction value). The derivatives are propagated alongside the transfer matrix,
+    so this replaces the finite difference evaluations of scipy.optimize.least_squares when passed as its jac argument.
+    It takes the same arguments as fresnel_calculation(). Use FresnelLeastSquares to get the residuals and the
+    Jacobian of a fit from the same transfer-matrix calculation.
+
+    :param fitted_var: variable to be fitted
+    :return: ndarray, Jacobian of shape (n_angles, len(fitted_var))
+    """
+
+    return fresnel_calculation_and_jacobian(fitted_var, fitted_layer_index, angles, wavelength, layer_thicknesses, n_re, n_im,
+                                            ydata=ydata, ydata_type=ydata_type, weights=weights, polarization=polarization,
+                                            ydata_offset=ydata_offset, layer_stack=layer_stack)[1]
+
+
+def fresnel_calculation_and_jacobian(fitted_var, fitted_layer_index, angles, wavelength, layer_thicknesses, n_re, n_im, ydata=None, ydata_type='R', weights=None, polarization=1.0, ydata_offset=0, layer_stack=None):
+
+    """
+    Calculates the result of fresnel_calculation() (fresnel coefficients or residuals) and fresnel_jacobian() from a
+    single transfer-matrix calculation, since the derivatives are propagated alongside the fresnel coefficients anyway.
+
+    :param fitted_var: variable to be fitted
+    :return: ndarray of shape (n_angles,) as from fresnel_calculation(), ndarray of shape (n_angles, len(fitted_var))
+    """
+
+    fitted_var = np.atleast_1d(fitted_var)
+    jacobian = np.zeros((len(angles), len(fitted_var)))
+
+    # Directions in (layer thickness, refractive index) space for the main fitted layer and the prism extinction value
+    tangent_count = 2 if len(fitted_var) == 3 else 1
+    d_layer_thicknesses = np.zeros((tangent_count, len(n_re)))
+    d_n = np.zeros((tangent_count, len(n_re)), dtype=np.complex128)
+
+    # Selecting main layer to fit
+    match fitted_layer_index[1]:
+        case 0:
+            print('Invalid fitting variable!')
+            return 0, jacobian
+        case 1:
+            d_layer_thicknesses[0, fitted_layer_index[0]] = 1
+        case 2:
+            d_n[0, fitted_layer_index[0]] = 1
+        case 3:
+            d_n[0, fitted_layer_index[0]] = 1j
+
+    # Include fitting prism extinction value
+    if len(fitted_var) == 3:
+        d_n[1, 0] = 1j
+
+    layer_thicknesses, n_re, n_im, ydata_offset = apply_fitted_var(fitted_var, fitted_layer_index, layer_thicknesses, n_re, n_im, ydata_offset)
+
+    reflection, transmission, absorption, d_reflection, d_transmission, d_absorption = _fresnel_coefficients(angles, wavelength, layer_thicknesses, n_re + 1j * n_im, polarization, layer_tangents=(d_layer_thicknesses, d_n), layer_stack=layer_stack)
+
+    match ydata_type:
+        case 'R':
+            fresnel_coefficients = reflection - ydata_offset
+            jacobian[:, 0] = d_reflection[0]
+            if len(fitted_var) == 3:
+                jacobian[:, 2] = d_reflection[1]
+        case 'T':
+            fresnel_coefficients = transmission - ydata_offset
+            jacobian[:, 0] = d_transmission[0]
+            if len(fitted_var) == 3:
+                jacobian[:, 2] = d_transmission[1]
+        case 'A':
+            fresnel_coefficients = absorption - ydata_offset
+            jacobian[:, 0] = d_absorption[0]
+            if len(fitted_var) == 3:
+                jacobian[:, 2] = d_absorption[1]
+
+    # Include fitting intensity offset
+    if len(fitted_var) >= 2:
+        jacobian[:, 1] = -1
+
+    if ydata is not None:
+        fresnel_coefficients = fresnel_coefficients - ydata
+
+    if weights is not None:
+        return fresnel_coefficients*weights, jacobian*np.asarray(weights)[:, np.newaxis]
+    else:
+        return fresnel_coefficients, jacobian
+
+
+class FresnelLeastSquares:
+
+    """
+    Residual and Jacobian functions of a fresnel fit for scipy.optimize.least_squares (as fun and jac). least_squares
+    evaluates the Jacobian at the same variables as the residuals of an accepted step, so both are calculated together
+    with fresnel_calculation_and_jacobian() and the last evaluation is kept. This needs one transfer-matrix calculation
+    per new set of variables, instead of one for the residuals and another one for the Jacobian.
+
+    The keyword arguments are the same as for fresnel_calculation() (apart from fitted_var).
+    """
+
+    def __init__(self, **fresnel_kwargs):
+        self.fresnel_kwargs = fresnel_kwargs
+        self.fitted_var = None
+        self.residuals = None
+        self.jacobian = None
+        self.calculations = 0
+
+    def _evaluate(self, fitted_var):
+        fitted_var = np.array(np.atleast_1d(fitted_var), dtype=np.float64)
+        if self.fitted_var is None or not np.array_equal(fitted_var, self.fitted_var):
+            self.residuals, self.jacobian = fresnel_calculation_and_jacobian(fitted_var, **self.fresnel_kwargs)
+            self.fitted_var = fitted_var
+            self.calculations += 1
+
+    def fun(self, fitted_var):
+        self._evaluate(fitted_var)
+        return self.residuals
+
+    def jac(self, fitted_var):
+        self._evaluate(fitted_var)
+        return self.jacobian
+
+
+def apply_fitted_var(fitted_var, fitted_layer_index, layer_thicknesses, n_re, n_im, ydata_offset=0):
+
+    """
+    Substitutes the fitted variables into copies of the layer arrays. The input arrays are left unchanged, so the same
+    sensor arrays can be shared between calculations.
+
+    :param fitted_var: ndarray, the main fitted layer variable, optionally followed by the intensity offset and the
+                       prism extinction value
+    :param fitted_layer_index: tuple, (layer index, 1 for thickness, 2 for n or 3 for k)
+    :param layer_thicknesses: ndarray
+    :param n_re: ndarray
+    :param n_im: ndarray
+    :param ydata_offset: float, returned unchanged unless the intensity offset is fitted
+    :return: tuple of layer_thicknesses, n_re, n_im (new ndarrays) and ydata_offset
+    """
+
+    layer_thicknesses = np.array(layer_thicknesses, dtype=np.float64)
+    n_re = np.array(n_re, dtype=np.float64)
+    n_im = np.array(n_im, dtype=np.float64)
+
+    # Selecting main layer to fit
+    match fitted_layer_index[1]:
+        case 1:
+            layer_thicknesses[fitted_layer_index[0]] = fitted_var[0]
+        case 2:
+            n_re[fitted_layer_index[0]] = fitted_var[0]
+        case 3:
+            n_im[fitted_layer_index[0]] = fitted_var[0]
+
+    # Include fitting intensity offset
+    if len(fitted_var) >= 2:
+        ydata_offset = fitted_var[1]
+
+    # Include fitting prism extinction value
+    if len(fitted_var) == 3:
+        n_im[0] = fitted_var[2]
+
+    return layer_thicknesses, n_re, n_im, ydata_offset
+
+
+def fresnel_calculation_batch(angles,
+                              wavelength,
+                              layer_thicknesses,
+                              n_re,
+                              n_im,
+                              ydata_type='R',
+                              polarization=1.0,
+                              ydata_offset=0,
+                              layer_stack=None,
+                              chunk_points=FRESNEL_BATCH_CHUNK_POINTS,
+                              ):
+
+    """
+    Batched companion to fresnel_calculation(). Calculates the fresnel coefficients of a stack of K layer
+    configurations (for instance different thicknesses, refractive indices, bulk refractive indices or intensity
+    offsets). The configurations are calculated together in chunks of about chunk_points (configuration, angle) points.
+    For short angle ranges (a few hundred angles or less) this saves the per-call overhead of separate calls, for longer
+    angle ranges the time per curve is about the same as with separate fresnel_calculation() calls.
+
+    :param angles: ndarray, shape (n_angles,) shared by all configurations, or (K, n_angles) for individual angle ranges
+    :param wavelength: int
+    :param layer_thicknesses: ndarray, shape (K, n_layers) (or (n_layers,) if shared by all configurations)
+    :param n_re: ndarray, shape (K, n_layers) (or (n_layers,) if shared by all configurations)
+    :param n_im: ndarray, shape (K, n_layers) (or (n_layers,) if shared by all configurations)
+    :param ydata_type: string, specify if reflectivity ('R'), transmission ('T') or absorption ('A') is calculated
+    :param polarization: float, 1 (default) or 0
+    :param ydata_offset: float or ndarray of shape (K,)
+    :param layer_stack: LayerStack (default None), reuses the precalculated layers below the varied layer
+    :param chunk_points: int (default FRESNEL_BATCH_CHUNK_POINTS), number of points calculated at a time
+    :return: ndarray, fresnel coefficients of shape (K, n_angles)
+    """
+
+    angles = np.asarray(angles, dtype=np.float64)
+    layer_thicknesses, n_re, n_im = np.broadcast_arrays(np.asarray(layer_thicknesses, dtype=np.float64),
+                                                        np.asarray(n_re, dtype=np.float64),
+                                                        np.asarray(n_im, dtype=np.float64))
+    ydata_offset = np.asarray(ydata_offset, dtype=np.float64)[..., np.newaxis]
+    channel_index = {'R': 0, 'T': 1, 'A': 2}[ydata_type]
+
+    # All configurations flattened to one batch axis, shape (K, n_layers) and (n_angles,) or (K, n_angles)
+    batch_shape = np.broadcast_shapes(layer_thicknesses.shape[:-1], angles.shape[:-1])
+    configuration_count = int(np.prod(batch_shape))
+    angle_count = angles.shape[-1]
+    if configuration_count * angle_count <= chunk_points:
+        return _fresnel_coefficients(angles, wavelength, layer_thicknesses, n_re + 1j * n_im, polarization, layer_stack=layer_stack)[channel_index] - ydata_offset
+
+    layer_count = layer_thicknesses.shape[-1]
+    layer_thicknesses = np.broadcast_to(layer_thicknesses, batch_shape + (layer_count,)).reshape(configuration_count, layer_count)
+    n = np.broadcast_to(n_re + 1j * n_im, batch_shape + (layer_count,)).reshape(configuration_count, layer_count)
+    if angles.ndim > 1:
+        angles = np.broadcast_to(angles, batch_shape + (angle_count,)).reshape(configuration_count, angle_count)
+
+    fresnel_coefficients = np.empty((configuration_count, angle_count))
+    chunk_configurations = max(chunk_points // angle_count, 1)
+    for first in range(0, configuration_count, chunk_configurations):
+        chunk = slice(first, first + chunk_configurations)
+        chunk_angles = angles[chunk] if angles.ndim > 1 else angles
+        fresnel_coefficients[chunk] = _fresnel_coefficients(chunk_angles, wavelength, layer_thicknesses[chunk], n[chunk], polarization, layer_stack=layer_stack)[channel_index]
+
+    return fresnel_coefficients.reshape(batch_shape + (angle_count,)) - ydata_offset
+
+
+class FresnelCurveCache:
+
+    """
+    Bounded least recently used cache of calculated fresnel curves, for interactive callbacks that repeatedly ask for
+    the same curves (for instance hovering back and forth over the same points). Curves are keyed by a hash of all
+    arguments, and the returned arrays are read-only since they are shared between calls.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._curves = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._curves)
+
+    @staticmethod
+    def curve_key(angles, wavelength, layer_thicknesses, n_re, n_im, ydata_type, polarization, ydata_offset):
+
+        key_hash = hashlib.sha1()
+        for key_array in (angles, layer_thicknesses, n_re, n_im, ydata_offset):
+            key_array = np.ascontiguousarray(key_array, dtype=np.float64)
+            key_hash.update(repr(key_array.shape).encode())
+            key_hash.update(key_array.tobytes())
+        key_hash.update(repr((wavelength, ydata_type, float(polarization))).encode())
+
+        return key_hash.hexdigest()
+
+    def calculate(self, angles, wavelength, layer_thicknesses, n_re, n_im, ydata_type='R', polarization=1.0, ydata_offset=0):
+
+        """
+        Returns the fresnel coefficients from the cache, or calculates them with fresnel_calculation_batch() (so the layer
+        arrays may also hold several configurations) and stores them.
+
+        :return: ndarray (read-only), fresnel coefficients of shape (n_angles,) or (K, n_angles)
+        """
+
+        key = self.curve_key(angles, wavelength, layer_thicknesses, n_re, n_im, ydata_type, polarization, ydata_offset)
+        if key in self._curves:
+            self.hits += 1
+            self._curves.move_to_end(key)
+            return self._curves[key]
+
+        self.misses += 1
+        fresnel_coefficients = fresnel_calculation_batch(angles, wavelength, layer_thicknesses, n_re, n_im, ydata_type=ydata_type, polarization=polarization, ydata_offset=ydata_offset)
+        fresnel_coefficients.flags.writeable = False
+        self._curves[key] = fresnel_coefficients
+        if len(self._curves) > self.maxsize:
+            self._curves.popitem(last=False)
+
+        return fresnel_coefficients
+
+    def info(self):
+
+        """
+        :return: dict with hits, misses, current size and maximum size of the cache
+        """
+
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._curves), 'maxsize': self.maxsize}
+
+    def clear(self):
+        self._curves.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# Shared cache used by cached_fresnel_calculation()
+fresnel_curve_cache = FresnelCurveCache()
+
+
+def cached_fresnel_calculation(angles, wavelength, layer_thicknesses, n_re, n_im, ydata_type='R', polarization=1.0, ydata_offset=0):
+
+    """
+    fresnel_calculation_batch() through the shared fresnel_curve_cache, for callbacks that recalculate the same curves.
+
+    :param angles: ndarray, shape (n_angles,) or (K, n_angles)
+    :param wavelength: int
+    :param layer_thicknesses: ndarray, shape (n_layers,) or (K, n_layers)
+    :param n_re: ndarray, shape (n_layers,) or (K, n_layers)
+    :param n_im: ndarray, shape (n_layers,) or (K, n_layers)
+    :param ydata_type: string, specify if reflectivity ('R'), transmission ('T') or absorption ('A') is calculated
+    :param polarization: float
+    :param ydata_offset: float or ndarray of shape (K,)
+    :return: ndarray (read-only), fresnel coefficients of shape (n_angles,) or (K, n_angles)
+    """
+
+    return fresnel_curve_cache.calculate(angles, wavelength, layer_thicknesses, n_re, n_im, ydata_type=ydata_type, polarization=polarization, ydata_offset=ydata_offset)
+
+
+def fresnel_calculation_channels(angles,
+                                 wavelength,
+                                 layer_thicknesses,
+                                 n_re,
+                                 n_im,
+                                 layer_stack=None,
+                                 ):
+
+    """
+    Calculates every output channel of the transfer-matrix method in a single pass: reflection, transmission and
+    absorption for both s and p polarization, and the complex total reflection and transmission amplitudes. The layer
+    arrays may have leading batch dimensions as in fresnel_calculation_batch(). Partially polarized curves are then
+    formed from the result with mix_polarization().
+
+    :param angles: ndarray, shape (n_angles,) or (..., n_angles)
+    :param wavelength: int
+    :param layer_thicknesses: ndarray, shape (..., n_layers)
+    :param n_re: ndarray, shape (..., n_layers)
+    :param n_im: ndarray, shape (..., n_layers)
+    :param layer_stack: LayerStack (default None), needs to be built with polarization=None to be reused
+    :return: structured ndarray of shape (..., n_angles) with the fields 'R_s', 'R_p', 'T_s', 'T_p', 'A_s', 'A_p' (float)
+             and 'r_s', 'r_p', 't_s', 't_p' (complex)
+    """
+
+    layer_thicknesses, n_re, n_im = np.broadcast_arrays(np.asarray(layer_thicknesses, dtype=np.float64),
+                                                        np.asarray(n_re, dtype=np.float64),
+                                                        np.asarray(n_im, dtype=np.float64))
+
+    reflection, transmission, absorption, fr_tot, ft_tot = _fresnel_coefficients(angles, wavelength, layer_thicknesses, n_re + 1j * n_im, None, layer_stack=layer_stack, return_amplitudes=True)
+
+    channels = np.empty(reflection.shape[1:], dtype=FRESNEL_CHANNELS_DTYPE)
+    for polarization_index, polarization_label in enumerate(('s', 'p')):
+        channels['R_' + polarization_label] = reflection[polarization_index]
+        channels['T_' + polarization_label] = transmission[polarization_index]
+        channels['A_' + polarization_label] = absorption[polarization_index]
+        channels['r_' + polarization_label] = fr_tot[polarization_index]
+        channels['t_' + polarization_label] = ft_tot[polarization_index]
+
+    return channels
+
+
+def mix_polarization(channels, polarization=1.0, ydata_type='R', ydata_offset=0):
+
+    """
+    Forms the intensity of partially polarized light from the output of fresnel_calculation_channels(), as the
+    incoherent sum of the s and p polarized intensities. For polarization 0 or 1 this equals fresnel_calculation(), while
+    fresnel_calculation() mixes the polarizations at the amplitude level in between.
+
+    :param channels: structured ndarray from fresnel_calculation_channels()
+    :param polarization: float, 0-1 for the degree of s (=0) and p (=1) polarization
+    :param ydata_type: string, specify if reflectivity ('R'), transmission ('T') or absorption ('A') is returned
+    :param ydata_offset: float
+    :return: ndarray, shape of channels
+    """
+
+    return (1 - polarization) * channels[ydata_type + '_s'] + polarization * channels[ydata_type + '_p'] - ydata_offset
+
+
+class ReflectivitySurrogate:
+
+    """
+    Precomputed table of fresnel coefficients R(thickness, n, angle) for one layer of a fixed sensor stack (by default
+    the surface layer), calculated with fresnel_calculation_batch(). Curves for any thickness and refractive index
+    within the grid are then interpolated from the table instead of solving the transfer matrix, which is used to find
+    close initial guesses before an exact fit. Tables are saved as .npz files, keyed by a hash of everything they
+    depend on, so they can be stored with the session and reused.
+    """
+
+    def __init__(self, angles, wavelength, layer_thicknesses, n_re, n_im, thickness_grid, n_grid, varied_layer_index=-2, ydata_type='R', polarization=1.0, table=None):
+        self.angles = np.asarray(angles, dtype=np.float64)
+        self.wavelength = wavelength
+        self.layer_thicknesses = np.array(layer_thicknesses, dtype=np.float64)
+        self.n_re = np.array(n_re, dtype=np.float64)
+        self.n_im = np.array(n_im, dtype=np.float64)
+        self.thickness_grid = np.asarray(thickness_grid, dtype=np.float64)
+        self.n_grid = np.asarray(n_grid, dtype=np.float64)
+        self.varied_layer_index = varied_layer_index
+        self.ydata_type = ydata_type
+        self.polarization = polarization
+        self.key = self.table_key(self.angles, wavelength, self.layer_thicknesses, self.n_re, self.n_im, self.thickness_grid, self.n_grid, varied_layer_index, ydata_type, polarization)
+
+        if table is None:
+            table = self._calculate_table()
+        self.table = table
+
+    @staticmethod
+    def table_key(angles, wavelength, layer_thicknesses, n_re, n_im, thickness_grid, n_grid, varied_layer_index, ydata_type, polarization):
+
+        """
+        Hash identifying a table. The thickness and refractive index of the varied layer itself are not part of the key.
+
+        :return: string
+        """
+
+        varied_layer_index = varied_layer_index % len(n_re)
+        key_hash = hashlib.sha1()
+        for key_array in (angles, np.delete(layer_thicknesses, varied_layer_index), np.delete(n_re, varied_layer_index), n_im, thickness_grid, n_grid):
+            key_hash.update(np.ascontiguousarray(key_array, dtype=np.float64).tobytes())
+        key_hash.update(repr((wavelength, int(varied_layer_index), ydata_type, float(polarization))).encode())
+
+        return key_hash.hexdigest()
+
+    def _calculate_table(self, chunk_points=250000):
+
+        # Every (thickness, n) combination as one configuration of a batched calculation, in chunks to limit memory use
+        layer_stack = LayerStack(self.angles, self.wavelength, self.layer_thicknesses, self.n_re, self.n_im, self.varied_layer_index, polarization=self.polarization)
+        table = np.empty((len(self.thickness_grid), len(self.n_grid), len(self.angles)))
+        chunk_rows = max(chunk_points // (len(self.n_grid) * len(self.angles)), 1)
+        for first_row in range(0, len(self.thickness_grid), chunk_rows):
+            chunk_thicknesses = self.thickness_grid[first_row:first_row + chunk_rows]
+            layer_thicknesses = np.tile(self.layer_thicknesses, (len(chunk_thicknesses), len(self.n_grid), 1))
+            layer_thicknesses[..., self.varied_layer_index] = chunk_thicknesses[:, np.newaxis]
+            n_re = np.tile(self.n_re, (len(chunk_thicknesses), len(self.n_grid), 1))
+            n_re[..., self.varied_layer_index] = self.n_grid
+            table[first_row:first_row + chunk_rows] = fresnel_calculation_batch(self.angles, self.wavelength, layer_thicknesses, n_re, self.n_im,
+                                                                                ydata_type=self.ydata_type, polarization=self.polarization, layer_stack=layer_stack)
+
+        return table
+
+    @classmethod
+    def load_or_calculate(cls, folder, angles, wavelength, layer_thicknesses, n_re, n_im, thickness_grid, n_grid, varied_layer_index=-2, ydata_type='R', polarization=1.0):
+
+        """
+        Loads a matching table from a folder (such as the surrogate table folder of a session), or calculates and saves
+        it if there is none.
+
+        :param folder: string, or None to only calculate the table
+        :return: ReflectivitySurrogate
+        """
+
+        if folder is None:
+            return cls(angles, wavelength, layer_thicknesses, n_re, n_im, thickness_grid, n_grid, varied_layer_index, ydata_type, polarization)
+
+        key = cls.table_key(np.asarray(angles, dtype=np.float64), wavelength, np.asarray(layer_thicknesses, dtype=np.float64), np.asarray(n_re, dtype=np.float64),
+                            np.asarray(n_im, dtype=np.float64), thickness_grid, n_grid, varied_layer_index, ydata_type, polarization)
+        table_path = folder + '/R table {key}.npz'.format(key=key)
+        table = None
+        if os.path.exists(table_path):
+            try:
+                with np.load(table_path) as table_file:
+                    table = table_file['table']
+            except (OSError, ValueError, KeyError):
+                print('Warning! Could not read surrogate table, recalculating it.')
+
+        surrogate = cls(angles, wavelength, layer_thicknesses, n_re, n_im, thickness_grid, n_grid, varied_layer_index, ydata_type, polarization, table=table)
+        if table is None:
+            surrogate.save(folder)
+
+        return surrogate
+
+    def save(self, folder):
+
+        """
+        Saves the table to a folder. The file is written under a temporary name first, so that other processes never
+        read a partially written table.
+
+        :param folder: string
+        :return: string, path of the saved table
+        """
+
+        os.makedirs(folder, exist_ok=True)
+        table_path = folder + '/R table {key}.npz'.format(key=self.key)
+        temporary_path = folder + '/R table {key}.{pid}.tmp.npz'.format(key=self.key, pid=os.getpid())
+        np.savez(temporary_path, table=self.table, angles=self.angles, thickness_grid=self.thickness_grid, n_grid=self.n_grid)
+        os.replace(temporary_path, table_path)
+
+        return table_path
+
+    def _thickness_rows(self, thickness):
+
+        # Linear interpolation between the two closest thickness rows, shape (n_grid, n_angles)
+        upper_row = int(np.clip(np.searchsorted(self.thickness_grid, thickness), 1, len(self.thickness_grid) - 1))
+        fraction = (thickness - self.thickness_grid[upper_row - 1]) / (self.thickness_grid[upper_row] - self.thickness_grid[upper_row - 1])
+
+        return (1 - fraction) * self.table[upper_row - 1] + fraction * self.table[upper_row]
+
+    def evaluate(self, thickness, n, ydata_offset=0):
+
+        """
+        Interpolates a curve from the table (bilinear in thickness and refractive index).
+
+        :param thickness: float
+        :param n: float
+        :param ydata_offset: float
+        :return: ndarray, shape (n_angles,)
+        """
+
+        n_rows = self._thickness_rows(thickness) if len(self.thickness_grid) > 1 else self.table[0]
+        upper_column = int(np.clip(np.searchsorted(self.n_grid, n), 1, len(self.n_grid) - 1))
+        fraction = (n - self.n_grid[upper_column - 1]) / (self.n_grid[upper_column] - self.n_grid[upper_column - 1])
+
+        return (1 - fraction) * n_rows[upper_column - 1] + fraction * n_rows[upper_column] - ydata_offset
+
+    def estimate_n(self, ydata, thickness, ydata_offset=0):
+
+        """
+        Estimates the refractive index of the varied layer from a measured curve at a given thickness, from the least
+        squares residuals of all tabulated refractive indices refined with a parabola around the best one. Meant as an
+        initial guess for an exact fit with fresnel_calculation().
+
+        :param ydata: ndarray, measured curve at the table angles
+        :param thickness: float
+        :param ydata_offset: float
+        :return: float
+        """
+
+        n_rows = self._thickness_rows(thickness) if len(self.thickness_grid) > 1 else self.table[0]
+        squared_residuals = np.sum((n_rows - ydata_offset - np.asarray(ydata)) ** 2, axis=-1)
+        best_column = int(np.argmin(squared_residuals))
+        if best_column == 0 or best_column == len(self.n_grid) - 1:
+            return float(self.n_grid[best_column])
+
+        # Vertex of the parabola through the best grid point and its neighbours
+        lower, middle, upper = squared_residuals[best_column - 1:best_column + 2]
+        curvature = lower - 2 * middle + upper
+        step = 0.5 * (lower - upper) / curvature if curvature > 0 else 0
+
+        return float(self.n_grid[best_column] + step * (self.n_grid[best_column + 1] - self.n_grid[best_column]))
+
+
+class LayerStack:
+
+    """
+    Precompiled layer stack for repeated fresnel calculations where only one layer (and the layers above it) changes
+    between calls, such as the fitted layer during curve fitting or the surface layer in exclusion height calculations.
+    The Snell angles of the fixed layers below the varied layer and the transfer matrix product of their interfaces
+    are calculated once, and are then reused by fresnel_calculation(), fresnel_jacobian() and
+    fresnel_calculation_batch() when passed as their layer_stack argument.
+
+    The fixed layers, angles, wavelength and polarization are checked on every call, and the full calculation is
+    performed if they differ from the ones the stack was built from.
+    """
+
+    def __init__(self, angles, wavelength, layer_thicknesses, n_re, n_im, varied_layer_index, polarization=1.0):
+        self.angles = np.asarray(angles, dtype=np.float64)
+        self.wavelength = wavelength
+        self.polarization = polarization
+        self.layer_count = len(n_re)
+        self.varied_layer_index = varied_layer_index % self.layer_count  # Supports negative indexing, e.g. -2 for the surface layer
+        self.first_interface = max(self.varied_layer_index - 1, 0)
+        self.fixed_layer_thicknesses = np.array(layer_thicknesses[1:self.varied_layer_index], dtype=np.float64)  # Prism thickness is not used
+        self.fixed_n = np.array(n_re[:self.varied_layer_index], dtype=np.float64) + 1j * np.array(n_im[:self.varied_layer_index], dtype=np.float64)
+        self.theta = None
+        self.transfer_prefix = None
+
+        # Fill in the cached Snell angles and transfer matrix product with one full calculation
+        _fresnel_coefficients(self.angles, wavelength, np.array(layer_thicknesses, dtype=np.float64), np.array(n_re) + 1j * np.array(n_im), polarization, layer_stack=self)
+
+    @classmethod
+    def from_sensor(cls, sensor_object, angles, varied_layer_index=None, polarization=1.0):
+
+        """
+        Builds a layer stack from the current layers of a sensor object.
+
+        :param sensor_object: Sensor
+        :param angles: ndarray
+        :param varied_layer_index: int (default None), index of the varied layer, defaults to the fitted layer of the sensor
+        :param polarization: float
+        :return: LayerStack
+        """
+
+        if varied_layer_index is None:
+            varied_layer_index = sensor_object.fitted_layer_index[0]
+
+        return cls(angles, sensor_object.wavelength, sensor_object.layer_thicknesses, sensor_object.refractive_indices,
+                   sensor_object.extinction_coefficients, varied_layer_index, polarization=polarization)
+
+    def matches(self, angles, wavelength, layer_thicknesses, n, polarization):
+
+        """
+        Checks if a calculation can reuse the cached layers of the stack.
+
+        :param angles: ndarray, shape (..., n_angles)
+        :param wavelength: int
+        :param layer_thicknesses: ndarray, shape (..., n_layers)
+        :param n: ndarray, complex refractive indices, shape (..., n_layers)
+        :param polarization: float
+        :return: bool
+        """
+
+        if wavelength != self.wavelength or polarization != self.polarization or np.shape(n)[-1] != self.layer_count:
+            return False
+        if angles is not self.angles and (np.shape(angles)[-1] != self.angles.shape[-1] or not np.all(angles == self.angles)):
+            return False
+
+        return bool(np.all(n[..., :self.varied_layer_index] == self.fixed_n)
+                    and np.all(layer_thicknesses[..., 1:self.varied_layer_index] == self.fixed_layer_thicknesses))
+
+
+def _fresnel_coefficients(angles, wavelength, layer_thicknesses, n, polarization, layer_tangents=None, layer_stack=None, return_amplitudes=False):
+
+    """
+    Angle-vectorized transfer-matrix calculation. Snell angles, fresnel coefficients, phase shift factors and the
+    stacked 2x2 layer matrices are calculated as arrays over the whole angle axis at once, so that only the (few)
+    layers are looped over in Python. Any leading batch dimensions of the angles and layer arrays are broadcast
+    against each other, which is used by fresnel_calculation_batch() to evaluate many layer configurations at once.
+
+    If layer_tangents is provided, the derivatives of the intensities along each of the P given directions in
+    (layer thickness, complex refractive index) space are propagated through every step of the calculation
+    (forward-mode differentiation) and returned as well.
+
+    If a LayerStack is provided and its fixed layers match, the Snell angles and transfer matrix product of the layers
+    below its varied layer are taken from the stack instead of being recalculated.
+
+    :param angles: ndarray or pd.Series, incident angles in degrees, shape (..., n_angles)
+    :param wavelength: int
+    :param layer_thicknesses: ndarray, shape (..., n_layers)
+    :param n: ndarray, complex refractive indices, shape (..., n_layers)
+    :param polarization: float, or None to calculate s and p polarization as separate channels along a new leading axis
+                         of size 2 (not combined with layer_tangents)
+    :param layer_tangents: tuple of ndarrays (thickness directions, refractive index directions), each of shape (P, ..., n_layers)
+    :param layer_stack: LayerStack (default None)
+    :param return_amplitudes: bool (default False), also return the complex total reflection and transmission amplitudes
+    :return: ndarrays of reflection, transmission and absorption, shape (..., n_angles), followed by the complex
+             amplitudes if return_amplitudes is True, or their derivatives with shape (P, ..., n_angles) if
+             layer_tangents is provided
+    """
+
+    angles = np.asarray(angles, dtype=np.float64)
+    n = np.asarray(n, dtype=np.complex128)[..., np.newaxis, :]  # (..., 1, n_layers) to broadcast against the angles
+    layer_thicknesses = np.asarray(layer_thicknesses, dtype=np.float64)[..., np.newaxis, :]
+    layer_count = n.shape[-1]
+
+    calculate_derivatives = layer_tangents is not None
+    if calculate_derivatives:
+        d_layer_thicknesses = np.asarray(layer_tangents[0], dtype=np.float64)[..., np.newaxis, :]
+        d_n = np.asarray(layer_tangents[1], dtype=np.complex128)[..., np.newaxis, :]
+
+        # Derivatives are zero below the first varied layer, so they are only propagated from there on
+        tangent_axes = tuple(range(d_n.ndim - 1))
+        varied_n_layers = np.flatnonzero(np.any(d_n != 0, axis=tangent_axes))
+        varied_thickness_layers = np.flatnonzero(np.any(d_layer_thicknesses != 0, axis=tuple(range(d_layer_thicknesses.ndim - 1))))
+        first_varied_n = varied_n_layers[0] if len(varied_n_layers) > 0 else layer_count
+        first_varied_thickness = varied_thickness_layers[0] if len(varied_thickness_layers) > 0 else layer_count
+
+    # A precompiled layer stack is either filled in by this calculation, or used to skip the layers below its varied
+    # layer if they (and the angles) are the same as the ones it was built from
+    build_layer_stack = layer_stack is not None and layer_stack.theta is None
+    use_layer_stack = layer_stack is not None and not build_layer_stack \
+                      and layer_stack.matches(angles, wavelength, layer_thicknesses, n, polarization) \
+                      and (not calculate_derivatives or min(first_varied_n, first_varied_thickness) >= layer_stack.varied_layer_index)
+    start_interface = layer_stack.first_interface if use_layer_stack else 0
+
+    # Snell's law, shape (..., n_angles, n_layers)
+    theta = np.zeros(np.broadcast_shapes(angles.shape, n.shape[:-1]) + (layer_count,), dtype=np.complex128)
+    theta[..., 0] = angles * np.pi / 180
+    if use_layer_stack:
+        theta[..., :start_interface + 1] = layer_stack.theta
+    sin_arguments = [None] * start_interface
+    for a in range(start_interface, layer_count - 1):
+        sin_arguments.append(n[..., a] / n[..., a + 1] * np.sin(theta[..., a]))
+        theta_arcsin = np.arcsin(sin_arguments[a])
+        theta[..., a + 1] = np.real(theta_arcsin) - 1j * np.abs(np.imag(theta_arcsin))
+    if build_layer_stack:
+        layer_stack.theta = theta[..., :layer_stack.first_interface + 1].copy()
+
+    prism_cos_theta = np.cos(theta[..., 0])
+    prism_factor = np.real(n[..., 0] * prism_cos_theta)
+    if calculate_derivatives:
+        d_prism_factor = np.real(d_n[..., 0] * prism_cos_theta)  # The incident angles are fixed
+
+    # Only the layers from the first recalculated interface and up are needed from here on
+    if start_interface > 0:
+        theta = theta[..., start_interface:]
+        n = n[..., start_interface:]
+        layer_thicknesses = layer_thicknesses[..., start_interface:]
+        sin_arguments = sin_arguments[start_interface:]
+        layer_count -= start_interface
+        if calculate_derivatives:
+            d_n = d_n[..., start_interface:]
+            d_layer_thicknesses = d_layer_thicknesses[..., start_interface:]
+            first_varied_n -= start_interface
+            first_varied_thickness -= start_interface
+    if calculate_derivatives:
+        first_varied_interface = max(min(first_varied_n, first_varied_thickness, layer_count - 1) - 1, 0)
+
+    cos_theta = np.cos(theta)
+
+    if calculate_derivatives:
+        sin_theta = np.sin(theta)
+        d_theta = np.zeros(d_n.shape[:1] + theta.shape, dtype=np.complex128)
+        for a in range(max(first_varied_n - 1, 0), layer_count - 1):
+            d_sin_argument = (d_n[..., a] / n[..., a + 1] - n[..., a] * d_n[..., a + 1] / n[..., a + 1]**2) * sin_theta[..., a] \
+                             + n[..., a] / n[..., a + 1] * cos_theta[..., a] * d_theta[..., a]
+            # Where the arcsin has a positive imaginary part, theta is its complex conjugate and so is the derivative. For
+            # (numerically) real arguments this is instead set by the direction of the change, giving the one-sided
+            # derivative across the branch cut or the kink of the absolute value.
+            conjugated = np.where(np.abs(np.imag(sin_arguments[a])) > 1e-12, np.imag(sin_arguments[a]) > 0, np.imag(d_sin_argument) > 0)
+            d_theta[..., a + 1] = np.where(conjugated, np.conj(d_sin_argument), d_sin_argument) / cos_theta[..., a + 1]
+
+    # Calculating fresnel coefficients for all interfaces, shape (..., n_angles, n_layers - 1)
+    n_cos_lower = n[..., :-1] * cos_theta[..., :-1]  # n[a] * cos(theta[a])
+    n_cos_upper = n[..., 1:] * cos_theta[..., 1:]  # n[a + 1] * cos(theta[a + 1])
+    n_cos_lower_cross = n[..., :-1] * cos_theta[..., 1:]  # n[a] * cos(theta[a + 1])
+    n_cos_upper_cross = n[..., 1:] * cos_theta[..., :-1]  # n[a + 1] * cos(theta[a])
+
+    # formulas for s polarization
+    s_reflection = (n_cos_lower - n_cos_upper) / (n_cos_lower + n_cos_upper)
+    s_transmission = 2 * n_cos_lower / (n_cos_lower + n_cos_upper)
+
+    # formulas for p polarization
+    p_reflection = (n_cos_lower_cross - n_cos_upper_cross) / (n_cos_lower_cross + n_cos_upper_cross)
+    p_transmission = 2 * n_cos_lower / (n_cos_lower_cross + n_cos_upper_cross)
+
+    # Blend s and p polarization, or keep them as separate channels along a new leading axis
+    if polarization is None:
+        s_weight = np.array([1.0, 0.0]).reshape((2,) + (1,) * s_reflection.ndim)
+        p_weight = np.array([0.0, 1.0]).reshape((2,) + (1,) * s_reflection.ndim)
+    else:
+        s_weight = polarization - 1
+        p_weight = polarization
+
+    fresnel_reflection = s_reflection*s_weight + p_reflection*p_weight
+    fresnel_transmission = s_transmission*s_weight + p_transmission*p_weight
+
+    if calculate_derivatives and first_varied_n == layer_count:
+        d_cos_theta = d_theta  # All zeros
+        d_fresnel_reflection = 0
+        d_fresnel_transmission = 0
+
+    elif calculate_derivatives:
+        d_cos_theta = -sin_theta * d_theta
+        d_n_cos_lower = d_n[..., :-1] * cos_theta[..., :-1] + n[..., :-1] * d_cos_theta[..., :-1]
+        d_n_cos_upper = d_n[..., 1:] * cos_theta[..., 1:] + n[..., 1:] * d_cos_theta[..., 1:]
+        d_n_cos_lower_cross = d_n[..., :-1] * cos_theta[..., 1:] + n[..., :-1] * d_cos_theta[..., 1:]
+        d_n_cos_upper_cross = d_n[..., 1:] * cos_theta[..., :-1] + n[..., 1:] * d_cos_theta[..., :-1]
+
+        d_s_reflection = (d_n_cos_lower - d_n_cos_upper - s_reflection * (d_n_cos_lower + d_n_cos_upper)) / (n_cos_lower + n_cos_upper)
+        d_s_transmission = (2 * d_n_cos_lower - s_transmission * (d_n_cos_lower + d_n_cos_upper)) / (n_cos_lower + n_cos_upper)
+        d_p_reflection = (d_n_cos_lower_cross - d_n_cos_upper_cross - p_reflection * (d_n_cos_lower_cross + d_n_cos_upper_cross)) / (n_cos_lower_cross + n_cos_upper_cross)
+        d_p_transmission = (2 * d_n_cos_lower - p_transmission * (d_n_cos_lower_cross + d_n_cos_upper_cross)) / (n_cos_lower_cross + n_cos_upper_cross)
+
+        d_fresnel_reflection = d_s_reflection*s_weight + d_p_reflection*p_weight
+        d_fresnel_transmission = d_s_transmission*s_weight + d_p_transmission*p_weight
+
+    # Phase shift factors (the final interface into the bulk has no phase shift), shape (..., n_angles, n_layers - 1)
+    phase_down = np.ones(fresnel_reflection.shape, dtype=np.complex128)
+    phase_up = np.ones(fresnel_reflection.shape, dtype=np.complex128)
+    delta = 2 * np.pi * layer_thicknesses[..., 1:-1] / wavelength * n[..., 1:-1] * cos_theta[..., 1:-1]
+    phase_down[..., :-1] = np.exp(-1j * delta)
+    phase_up[..., :-1] = np.exp(1j * delta)
+
+    # Stacked layer matrices 1/t * [[1, r], [r, 1]] * [[exp(-i*delta), 0], [0, exp(i*delta)]], shape (..., n_angles, n_layers - 1, 2, 2)
+    inverse_transmission = 1 / fresnel_transmission
+    layer_matrices = np.empty(fresnel_reflection.shape + (2, 2), dtype=np.complex128)
+    layer_matrices[..., 0, 0] = inverse_transmission * phase_down
+    layer_matrices[..., 0, 1] = inverse_transmission * fresnel_reflection * phase_up
+    layer_matrices[..., 1, 0] = inverse_transmission * fresnel_reflection * phase_down
+    layer_matrices[..., 1, 1] = inverse_transmission * phase_up
+
+    if calculate_derivatives:
+        d_delta = 2 * np.pi / wavelength * (d_layer_thicknesses[..., 1:-1] * n[..., 1:-1] * cos_theta[..., 1:-1]
+                                            + layer_thicknesses[..., 1:-1] * d_n[..., 1:-1] * cos_theta[..., 1:-1]
+                                            + layer_thicknesses[..., 1:-1] * n[..., 1:-1] * d_cos_theta[..., 1:-1])
+        d_phase_down = np.zeros(d_n.shape[:1] + fresnel_reflection.shape, dtype=np.complex128)
+        d_phase_up = np.zeros(d_n.shape[:1] + fresnel_reflection.shape, dtype=np.complex128)
+        d_phase_down[..., :-1] = -1j * d_delta * phase_down[..., :-1]
+        d_phase_up[..., :-1] = 1j * d_delta * phase_up[..., :-1]
+
+        d_inverse_transmission = -d_fresnel_transmission * inverse_transmission**2
+        d_layer_matrices = np.empty(d_phase_down.shape + (2, 2), dtype=np.complex128)
+        d_layer_matrices[..., 0, 0] = d_inverse_transmission * phase_down + inverse_transmission * d_phase_down
+        d_layer_matrices[..., 0, 1] = (d_inverse_transmission * fresnel_reflection + inverse_transmission * d_fresnel_reflection) * phase_up + inverse_transmission * fresnel_reflection * d_phase_up
+        d_layer_matrices[..., 1, 0] = (d_inverse_transmission * fresnel_reflection + inverse_transmission * d_fresnel_reflection) * phase_down + inverse_transmission * fresnel_reflection * d_phase_down
+        d_layer_matrices[..., 1, 1] = d_inverse_transmission * phase_up + inverse_transmission * d_phase_up
+
+    # Build up transfer matrix, shape (..., n_angles, 2, 2)
+    if use_layer_stack and start_interface > 0:
+        transfer_prefix = layer_stack.transfer_prefix
+        if polarization is None:  # The polarization channel axis stays in front of any batch dimensions
+            transfer_prefix = np.expand_dims(transfer_prefix, tuple(range(1, layer_matrices.ndim - transfer_prefix.ndim)))
+        transfer_matrix = _matmul_2x2(transfer_prefix, layer_matrices[..., 0, :, :])
+        if calculate_derivatives and first_varied_interface == 0:
+            d_transfer_matrix = _matmul_2x2(transfer_prefix, d_layer_matrices[..., 0, :, :])
+    else:
+        transfer_matrix = layer_matrices[..., 0, :, :]
+        if calculate_derivatives and first_varied_interface == 0:
+            d_transfer_matrix = d_layer_matrices[..., 0, :, :]
+    for a in range(1, layer_count - 1):
+        if build_layer_stack and a == layer_stack.first_interface:
+            layer_stack.transfer_prefix = transfer_matrix.copy()
+        if calculate_derivatives and a == first_varied_interface:
+            d_transfer_matrix = _matmul_2x2(transfer_matrix, d_layer_matrices[..., a, :, :])
+        elif calculate_derivatives and a > first_varied_interface:
+            d_transfer_matrix = _matmul_2x2(d_transfer_matrix, layer_matrices[..., a, :, :]) + _matmul_2x2(transfer_matrix, d_layer_matrices[..., a, :, :])
+        transfer_matrix = _matmul_2x2(transfer_matrix, layer_matrices[..., a, :, :])
+
+    # Total fresnel coefficients:
+    fr_tot = transfer_matrix[..., 1, 0] / transfer_matrix[..., 0, 0]
+    ft_tot = 1 / transfer_matrix[..., 0, 0]
+    if calculate_derivatives:
+        d_fr_tot = (d_transfer_matrix[..., 1, 0] - fr_tot * d_transfer_matrix[..., 0, 0]) / transfer_matrix[..., 0, 0]
+        d_ft_tot = -d_transfer_matrix[..., 0, 0] * ft_tot**2
+
+    # Special case of single interface:
+    if layer_count == 2 and start_interface == 0:
+        fr_tot = fresnel_reflection[..., 0]
+        ft_tot = fresnel_transmission[..., 0]
+        if calculate_derivatives:
+            d_fr_tot = (d_layer_matrices[..., 0, 1, 0] - fr_tot * d_layer_matrices[..., 0, 0, 0]) / layer_matrices[..., 0, 0, 0]
+            d_ft_tot = -d_layer_matrices[..., 0, 0, 0] * ft_tot**2
+
+    # Total fresnel coefficients in intensity:
+    bulk_factor = np.real(n[..., -1] * cos_theta[..., -1])
+    fresnel_coefficients_reflection = np.absolute(fr_tot)**2
+    fresnel_coefficients_transmission = np.absolute(ft_tot)**2 * bulk_factor / prism_factor
+    fresnel_coefficients_absorption = 1 - fresnel_coefficients_reflection - fresnel_coefficients_transmission
+
+    if return_amplitudes:
+        return fresnel_coefficients_reflection, fresnel_coefficients_transmission, fresnel_coefficients_absorption, fr_tot, ft_tot
+    elif not calculate_derivatives:
+        return fresnel_coefficients_reflection, fresnel_coefficients_transmission, fresnel_coefficients_absorption
+
+    d_bulk_factor = np.real(d_n[..., -1] * cos_theta[..., -1] + n[..., -1] * d_cos_theta[..., -1])
+    d_reflection = 2 * np.real(np.conj(fr_tot) * d_fr_tot)
+    d_transmission = 2 * np.real(np.conj(ft_tot) * d_ft_tot) * bulk_factor / prism_factor \
+                     + np.absolute(ft_tot)**2 * (d_bulk_factor * prism_factor - bulk_factor * d_prism_factor) / prism_factor**2
+    d_absorption = -d_reflection - d_transmission
+
+    return fresnel_coefficients_reflection, fresnel_coefficients_transmission, fresnel_coefficients_absorption, d_reflection, d_transmission, d_absorption
+
+
+def _matmul_2x2(matrix_a, matrix_b):
+
+    """
+    Matrix product of two (broadcastable) stacks of 2x2 matrices. Written out element-wise since np.matmul is slow for
+    a large number of tiny matrices.
+
+    :param matrix_a: ndarray, shape (..., 2, 2)
+    :param matrix_b: ndarray, shape (..., 2, 2)
+    :return: ndarray, shape (..., 2, 2)
+    """
+
+    product = np.empty(np.broadcast_shapes(matrix_a.shape, matrix_b.shape), dtype=np.complex128)
+    product[..., 0, 0] = matrix_a[..., 0, 0] * matrix_b[..., 0, 0] + matrix_a[..., 0, 1] * matrix_b[..., 1, 0]
+    product[..., 0, 1] = matrix_a[..., 0, 0] * matrix_b[..., 0, 1] + matrix_a[..., 0, 1] * matrix_b[..., 1, 1]
+    product[..., 1, 0] = matrix_a[..., 1, 0] * matrix_b[..., 0, 0] + matrix_a[..., 1, 1] * matrix_b[..., 1, 0]
+    product[..., 1, 1] = matrix_a[..., 1, 0] * matrix_b[..., 0, 1] + matrix_a[..., 1, 1] * matrix_b[..., 1, 1]
+
+    return product
+
+
+def cubic_extremum(poly_c, x_low, x_high, extremum='max'):
+
+    """
+    Location of the maximum or minimum of cubic polynomials within [x_low, x_high], found analytically from the roots of
+    the derivative (and the window edges) instead of evaluating the polynomials on a dense grid.
+
+    :param poly_c: ndarray, shape (..., 4), polynomial coefficients with the highest power first (as from np.polyfit)
+    :param x_low: float or ndarray, shape (...), lower limit of the window
+    :param x_high: float or ndarray, shape (...), upper limit of the window
+    :param extremum: 'max' or 'min'
+    :return: ndarray, shape (...), x value of the extremum
+    """
+
+    poly_c = np.asarray(poly_c, dtype=np.float64)
+    x_low, x_high, _ = np.broadcast_arrays(np.asarray(x_low, dtype=np.float64), np.asarray(x_high, dtype=np.float64), poly_c[..., 0])
+
+    # Roots of the derivative 3a*x^2 + 2b*x + c, solved around the window center (x = x_center + u) for accuracy
+    x_center = 0.5 * (x_low + x_high)
+    A = 3 * poly_c[..., 0]
+    B = 6 * poly_c[..., 0] * x_center + 2 * poly_c[..., 1]
+    C = (3 * poly_c[..., 0] * x_center + 2 * poly_c[..., 1]) * x_center + poly_c[..., 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q = -0.5 * (B + np.copysign(np.sqrt(B ** 2 - 4 * A * C), B))
+        root_1 = np.where(A != 0, q / A, -C / B)
+        root_2 = C / q
+        candidates = np.stack((x_low, x_high, x_center + root_1, x_center + root_2), axis=-1)
+
+        # Pick the candidate with the largest (smallest) value within the window
+        inside = (candidates >= x_low[..., np.newaxis]) & (candidates <= x_high[..., np.newaxis])
+        values = ((poly_c[..., 0:1] * candidates + poly_c[..., 1:2]) * candidates + poly_c[..., 2:3]) * candidates + poly_c[..., 3:4]
+    match extremum:
+        case 'max':
+            extremum_index = np.argmax(np.where(inside, values, -np.inf), axis=-1)
+        case 'min':
+            extremum_index = np.argmin(np.where(inside, values, np.inf), axis=-1)
+
+    return np.take_along_axis(candidates, extremum_index[..., np.newaxis], axis=-1)[..., 0]
+
+
+def cubic_fit_curve(poly_c, x_low, x_high, fit_points):
+
+    """
+    Evaluates cubic polynomials on fit_points evenly spaced points within [x_low, x_high], for plotting fits.
+
+    :param poly_c: ndarray, shape (..., 4), polynomial coefficients with the highest power first (as from np.polyfit)
+    :param x_low: float or ndarray, shape (...), lower limit of the window
+    :param x_high: float or ndarray, shape (...), upper limit of the window
+    :param fit_points: int
+    :return: fit_x, fit_y, ndarrays of shape (..., fit_points)
+    """
+
+    poly_c = np.asarray(poly_c, dtype=np.float64)
+    fit_x = np.linspace(x_low, x_high, fit_points, axis=-1)
+    fit_y = ((poly_c[..., 0:1] * fit_x + poly_c[..., 1:2]) * fit_x + poly_c[..., 2:3]) * fit_x + poly_c[..., 3:4]
+
+    return fit_x, fit_y
+
+
+def TIR_derivative(xdata, ydata, SPR_TIR_fitting_parameters):
+
+    """
+    Smoothed angular derivative of the reflectivity within the TIR range, used for determining the TIR angle.
+
+    :param xdata: ndarray (or pd.Series), shape (n_angles,)
+    :param ydata: ndarray (or pd.Series/pd.DataFrame), shape (n_angles,) or (n_scans, n_angles)
+    :param SPR_TIR_fitting_parameters: dict
+    :return: TIR_xdata_filtered (n_TIR_points,), deriv_ydata (n_TIR_points,) or (n_scans, n_TIR_points)
+    """
 
     # Convert to numpy array first if necessary
     if isinstance(xdata, pd.Series):
         xdata = xdata.to_numpy()
 
-    if isinstance(ydata, pd.Series):
+    if isinstance(ydata, (pd.Series, pd.DataFrame)):
         ydata = ydata.to_numpy()
 
-    TIR_ydata = ydata[(xdata >= SPR_TIR_fitting_parameters['TIR range'][0]) & (xdata <= SPR_TIR_fitting_parameters['TIR range'][1])]
-    TIR_xdata = xdata[(xdata >= SPR_TIR_fitting_parameters['TIR range'][0]) & (xdata <= SPR_TIR_fitting_parameters['TIR range'][1])]
+    xdata = np.asarray(xdata, dtype=np.float64)
+    ydata = np.asarray(ydata)
+    TIR_range_mask = (xdata >= SPR_TIR_fitting_parameters['TIR range'][0]) & (xdata <= SPR_TIR_fitting_parameters['TIR range'][1])
+    TIR_ydata = ydata[..., TIR_range_mask].astype(np.float64)  # Only the TIR range is upcast (single precision data)
+    TIR_xdata = xdata[TIR_range_mask]
 
     # Filter the data with a moving-average filter to smoothen the signal
-    TIR_ydata_filtered = bottleneck.move_mean(TIR_ydata, window=SPR_TIR_fitting_parameters['TIR window count'], min_count=1)
+    TIR_ydata_filtered = bottleneck.move_mean(TIR_ydata, window=SPR_TIR_fitting_parameters['TIR window count'], min_count=1, axis=-1)
     TIR_xdata_filtered = bottleneck.move_mean(TIR_xdata, window=SPR_TIR_fitting_parameters['TIR window count'], min_count=1)
 
+    # Angular derivative
+    diff_ydata = np.diff(TIR_ydata_filtered, axis=-1)
+    deriv_ydata = np.concatenate((diff_ydata[..., :1], diff_ydata), axis=-1)  # Add extra value for dimensions
+
+    return TIR_xdata_filtered, deriv_ydata
+
+
+def TIR_determination(xdata, ydata, SPR_TIR_fitting_parameters):
+
     # Find maximum derivative
-    deriv_ydata = np.concatenate(([np.diff(TIR_ydata_filtered)[0]], np.diff(TIR_ydata_filtered)))  # Add extra value for dimensions
+    TIR_xdata_filtered, deriv_ydata = TIR_derivative(xdata, ydata, SPR_TIR_fitting_parameters)
     dTIR_i = np.argmax(deriv_ydata)
 
     # Fit against the derivative spike where the derivative is max, considering also nearest neighbors
     poly_c = np.polyfit(TIR_xdata_filtered[dTIR_i - SPR_TIR_fitting_parameters['points_below_TIR_peak']:dTIR_i + SPR_TIR_fitting_parameters['points_above_TIR_peak'] + 1],
                         deriv_ydata[dTIR_i - SPR_TIR_fitting_parameters['points_below_TIR_peak']:dTIR_i + SPR_TIR_fitting_parameters['points_above_TIR_peak'] + 1], 3)
 
+    # Find TIR from max of deriv fit
+    TIR_theta = cubic_extremum(poly_c, TIR_xdata_filtered[dTIR_i - SPR_TIR_fitting_parameters['points_below_TIR_peak']], TIR_xdata_filtered[dTIR_i + SPR_TIR_fitting_parameters['points_above_TIR_peak']], extremum='max')
+
     # Recreate the curve with a lot more points
-    deriv_TIR_fit_x = np.linspace(TIR_xdata_filtered[dTIR_i - SPR_TIR_fitting_parameters['points_below_TIR_peak']], TIR_xdata_filtered[dTIR_i + SPR_TIR_fitting_parameters['points_above_TIR_peak']], SPR_TIR_fitting_parameters['TIR fit points'])
+    deriv_TIR_fit_x, deriv_TIR_fit_y = cubic_fit_curve(poly_c, TIR_xdata_filtered[dTIR_i - SPR_TIR_fitting_parameters['points_below_TIR_peak']], TIR_xdata_filtered[dTIR_i + SPR_TIR_fitting_parameters['points_above_TIR_peak']], SPR_TIR_fitting_parameters['TIR fit points'])
+
+    return TIR_theta, TIR_xdata_filtered, deriv_ydata, deriv_TIR_fit_x, deriv_TIR_fit_y
+
+
+def TIR_determination_batch(xdata, ydata, SPR_TIR_fitting_parameters):
+
+    """
+    TIR_determination() for a whole block of scans at once. The smoothing, derivative and peak search are done for all
+    scans together, and the cubic fits are solved together for all scans sharing the same fitting window. Instead of
+    dense fit curves, the fit coefficients and fitting windows are returned (see cubic_fit_curve()).
+
+    :param xdata: ndarray (or pd.Series), shape (n_angles,), angles shared by all scans
+    :param ydata: ndarray (or pd.DataFrame), shape (n_scans, n_angles)
+    :param SPR_TIR_fitting_parameters: dict
+    :return: TIR_theta (n_scans,), poly_c (n_scans, 4), fit_range (n_scans, 2). Scans where no TIR angle could be
+             determined are NaN.
+    """
+
+    TIR_xdata_filtered, deriv_ydata = TIR_derivative(xdata, np.atleast_2d(ydata), SPR_TIR_fitting_parameters)
+    scan_count = deriv_ydata.shape[0]
+    points_below = SPR_TIR_fitting_parameters['points_below_TIR_peak']
+    points_above = SPR_TIR_fitting_parameters['points_above_TIR_peak']
+
+    TIR_theta = np.full(scan_count, np.nan)
+    TIR_poly_c = np.full((scan_count, 4), np.nan)
+    TIR_fit_range = np.full((scan_count, 2), np.nan)
+    if TIR_xdata_filtered.size < 2:
+        return TIR_theta, TIR_poly_c, TIR_fit_range
+
+    # Find maximum derivative
+    dTIR_i = np.argmax(deriv_ydata, axis=1)
+
+    # The fitting window must lie within the TIR range and contain finite values only
+    window_offsets = np.arange(-points_below, points_above + 1)
+    valid_scans = (dTIR_i - points_below >= 0) & (dTIR_i + points_above < TIR_xdata_filtered.size)
+    window_indices = np.clip(dTIR_i[:, np.newaxis] + window_offsets, 0, TIR_xdata_filtered.size - 1)
+    valid_scans &= np.all(np.isfinite(np.take_along_axis(deriv_ydata, window_indices, axis=1)), axis=1)
+    valid_scans &= np.all(np.isfinite(TIR_xdata_filtered[window_indices]), axis=1)
+
+    # Fit against the derivative spike where the derivative is max, considering also nearest neighbors. Scans with the
+    # same peak index share the fitting window, so their cubic fits are solved together.
+    for peak_index in np.unique(dTIR_i[valid_scans]):
+        scans = np.flatnonzero(valid_scans & (dTIR_i == peak_index))
+        window = slice(peak_index - points_below, peak_index + points_above + 1)
+        TIR_poly_c[scans] = np.polyfit(TIR_xdata_filtered[window], deriv_ydata[scans, window].T, 3).T
+        TIR_fit_range[scans] = [TIR_xdata_filtered[peak_index - points_below], TIR_xdata_filtered[peak_index + points_above]]
 
     # Find TIR from max of deriv fit
-    deriv_TIR_fit_y = np.polyval(poly_c, deriv_TIR_fit_x)
-    dTIR_final = np.argmax(deriv_TIR_fit_y)
-    TIR_theta = deriv_TIR_fit_x[dTIR_final]
+    TIR_theta[valid_scans] = cubic_extremum(TIR_poly_c[valid_scans], TIR_fit_range[valid_scans, 0], TIR_fit_range[valid_scans, 1], extremum='max')
 
-    return TIR_theta, TIR_xdata_filtered, deriv_ydata, deriv_TIR_fit_x, deriv_TIR_fit_y
+    return TIR_theta, TIR_poly_c, TIR_fit_range